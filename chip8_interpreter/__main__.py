@@ -0,0 +1,371 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+from chip8_interpreter.analysis import PROGRAM_START, analyze
+from chip8_interpreter.audio import SoundTimerWatch
+from chip8_interpreter.cache import DEFAULT_CACHE_LIMIT, ArtifactCache, prepare, save_artifacts
+from chip8_interpreter.chip8 import DEFAULT_QUIRKS, QUIRK_PROFILES, Chip8
+from chip8_interpreter.compiler import BlockCompiler
+from chip8_interpreter.conformance import (CASES, DEFAULT_DUMP_DIR, DEFAULT_GOLDEN, VARIANTS, load_golden,
+                                           run_suite, save_golden)
+from chip8_interpreter.headless import frame_hash, load_input_script, load_rom, run_headless
+from chip8_interpreter.profiler import Profiler
+from chip8_interpreter.trace import Tracer, diff_report
+from chip8_interpreter.replay import load_input_log, rom_hash
+from chip8_interpreter.scheduler import INSTRUCTIONS_PER_FRAME
+
+
+def cmd_run(args):
+    try:
+        rom = load_rom(args.rom)
+    except OSError as error:
+        print(f"error: cannot read ROM {args.rom}: {error.strerror}", file=sys.stderr)
+        return 2
+    except Exception as error:
+        print(f"error: {error}", file=sys.stderr)
+        return 2
+    seed, ipf, cycles = args.seed, args.ipf, args.cycles
+    inputs = load_input_script(args.input_script) if args.input_script else ()
+    if args.replay:
+        # The recorded session decides seed, speed, inputs and by default its length
+        log = load_input_log(args.replay)
+        if log.rom_hash != rom_hash(rom):
+            raise Exception(f"{args.replay} was recorded with a different ROM than {args.rom}")
+        seed, ipf, inputs = log.seed, log.instructions_per_frame, log.events
+        if cycles is None:
+            cycles = log.cycles
+    if cycles is None:
+        cycles = 100000
+
+    mychip8 = Chip8(quirks=args.quirks)
+    mychip8.load_program_to_memory(rom)
+    if args.load_state:
+        mychip8.load_state(args.load_state)
+    if seed is not None:
+        mychip8.rng.seed(seed)
+    mychip8.fast_forward = not args.no_fast_forward
+    compiler = BlockCompiler(mychip8) if args.engine == "compiled" else None
+    cache = ArtifactCache(args.cache_dir, args.cache_limit << 20) if args.cache_dir else None
+    if args.predecode or cache is not None:
+        prepare_start = time.perf_counter()
+        rom_map, artifacts = prepare(mychip8, rom, compiler, cache)
+        prepare_seconds = time.perf_counter() - prepare_start
+    profiler = None
+    tracer = None
+    if (args.profile or args.flamegraph or args.trace) and compiler is not None:
+        raise Exception("Profiling and tracing need --engine interpreter, compiled blocks run their instructions inline")
+    if args.profile or args.flamegraph:
+        profiler = Profiler(mychip8, args.profile_sample)
+        profiler.install()
+    if args.trace:
+        tracer = Tracer(mychip8, args.trace)
+        tracer.install()
+    beeps = SoundTimerWatch(mychip8) if args.beeps else None
+    shared = None
+    if args.share:
+        from chip8_interpreter.shared import SharedMachine
+
+        shared = SharedMachine(mychip8, args.share)
+        print(f"sharing the machine as {shared.name}, attach with: python -m chip8_interpreter watch {shared.name}",
+              file=sys.stderr)
+    try:
+        result = run_headless(mychip8, cycles, compiler, ipf, inputs, beeps, shared)
+    finally:
+        # Also when the ROM fails, the end of the trace is what explains it
+        if tracer is not None:
+            tracer.uninstall()
+        if profiler is not None:
+            profiler.uninstall()
+        if shared is not None:
+            shared.close()
+    if profiler is not None:
+        if args.flamegraph:
+            profiler.write_folded(args.flamegraph)
+        if args.profile:
+            print(profiler.report(), file=sys.stderr)
+    if args.save_state:
+        mychip8.save_state(args.save_state)
+    if cache is not None:
+        warm = artifacts.rom_map is not None
+        stored = save_artifacts(cache, rom, mychip8, rom_map, artifacts, compiler)
+        print(f"artifact cache: {'warm' if warm else 'cold'} start, prepared in {prepare_seconds * 1e3:.2f} ms"
+              f"{', stored' if stored else ''}", file=sys.stderr)
+
+    dumps = args.dump or ["hash"]
+    if args.json:
+        report = {
+            "rom": args.rom,
+            "cycles": result.cycles,
+            "seconds": result.seconds,
+            "ips": result.ips,
+            "skipped": mychip8.skipped,
+            "frame_hash": frame_hash(mychip8),
+        }
+        if "registers" in dumps:
+            report["registers"] = {"pc": mychip8.pc, "i": mychip8.i, "v": list(mychip8.v)}
+        if beeps is not None:
+            report["beeps"] = [list(interval) for interval in beeps.intervals]
+        print(json.dumps(report))
+        return 0
+
+    if beeps is not None:
+        print("\n".join(beeps.report() or ["no beeps"]))
+    if "vram" in dumps:
+        mychip8.draw_vram()
+    if "registers" in dumps:
+        mychip8.print_registers()
+    if "memory" in dumps:
+        mychip8.dump_memory()
+    if "hash" in dumps:
+        print(f"frame hash: {frame_hash(mychip8)}")
+    print(f"cycles: {result.cycles}")
+    if mychip8.skipped:
+        print(f"skipped in idle loops: {mychip8.skipped} ({mychip8.skipped / result.cycles:.1%})")
+    print(f"wall time: {result.seconds:.4f} s")
+    print(f"instructions per second: {result.ips:.0f}")
+    return 0
+
+
+def cmd_analyze(args):
+    rom_map = analyze(load_rom(args.rom), args.entry, args.quirks)
+    if args.json:
+        print(json.dumps(rom_map.to_json()))
+        return 0
+    print("\n".join(rom_map.summary()))
+    if args.listing:
+        print()
+        print("\n".join(rom_map.listing()))
+    return 0
+
+
+def cmd_fleet(args):
+    from chip8_interpreter.fleet import FleetJob, run_fleet
+
+    inputs = tuple(load_input_script(args.input_script)) if args.input_script else ()
+    jobs = [FleetJob(rom, args.cycles, seed, inputs, args.engine, args.ipf, args.state, args.quirks)
+            for rom in args.roms for seed in range(args.seed_start, args.seed_start + args.seeds)]
+
+    cache = ArtifactCache(args.cache_dir, args.cache_limit << 20) if args.cache_dir else None
+    start = time.perf_counter()
+    total_cycles = 0
+    for result in run_fleet(jobs, args.workers, cache):
+        total_cycles += result.cycles
+        report = result._asdict()
+        report["ips"] = result.ips
+        print(json.dumps(report), flush=True)
+    seconds = time.perf_counter() - start
+    print(f"{len(jobs)} jobs, {total_cycles} cycles in {seconds:.3f} s "
+          f"({total_cycles / seconds:.0f} instructions per second, {args.workers or os.cpu_count()} workers)",
+          file=sys.stderr)
+    return 0
+
+
+def cmd_bench(args):
+    from chip8_interpreter.bench import (ENGINES, compare, engine_mismatches, find_roms, load_baseline, run_suite,
+                                         save_baseline)
+
+    inputs = load_input_script(args.input_script) if args.input_script else None
+    engines = ENGINES if args.engine == "both" else (args.engine,)
+    current = run_suite(find_roms(args.roms or ["roms", "."]), args.cycles, args.seed, inputs, args.ipf,
+                        engines, args.repeat, args.frames)
+    if args.output:
+        save_baseline(args.output, current)
+    if not args.compare:
+        mismatches = engine_mismatches(current)
+        for line in mismatches:
+            print(f"MISMATCH {line}")
+        return 1 if mismatches else 0
+
+    regressions = compare(load_baseline(args.compare), current, args.threshold)
+    for line in regressions:
+        print(f"REGRESSION {line}")
+    if regressions:
+        return 1
+    print(f"no regressions beyond {args.threshold:.0%} against {args.compare}")
+    return 0
+
+
+def cmd_conformance(args):
+    cases = [case for case in CASES if not args.cases or case.name in args.cases]
+    unknown = set(args.cases) - {case.name for case in CASES}
+    if unknown:
+        raise Exception(f"Unknown conformance cases {', '.join(sorted(unknown))}, "
+                        f"expected some of {', '.join(case.name for case in CASES)}")
+    variants = [variant for variant in VARIANTS if args.engine == "both" or variant.engine == args.engine]
+    golden = load_golden(args.golden)
+    start = time.perf_counter()
+    results, failures = run_suite(cases, variants, None if args.update else golden, args.dump_dir)
+    seconds = time.perf_counter() - start
+    if args.update:
+        if failures:
+            print("\n".join(f"FAIL {line}" for line in failures))
+            print(f"not updating {args.golden}, the engines disagree")
+            return 1
+        for result in results:
+            golden[result.case.name] = result.hashes
+        save_golden(args.golden, golden)
+        print(f"recorded {sum(len(case.checkpoints) for case in cases)} frame hashes of {len(cases)} cases "
+              f"to {args.golden}")
+        return 0
+
+    for line in failures:
+        print(f"FAIL {line}")
+    checkpoints = sum(len(result.hashes) for result in results)
+    outcome = f"{len(failures)} failures" if failures else f"all frames match {args.golden}"
+    print(f"{len(cases)} cases on {len(variants)} engine variants, {checkpoints} checkpoints in {seconds:.2f} s: {outcome}")
+    return 1 if failures else 0
+
+
+def cmd_watch(args):
+    from chip8_interpreter.shared import SharedMachineView
+
+    view = SharedMachineView(args.name)
+    last = None
+    last_time = 0.0
+    shown = 0
+    try:
+        while args.count is None or shown < args.count:
+            snapshot = view.read()
+            now = time.perf_counter()
+            if snapshot is None:
+                print(f"{args.name} kept running for a second, no consistent state could be read", file=sys.stderr)
+            elif last is None or snapshot.sequence != last.sequence:
+                lines = [] if args.registers else snapshot.display_lines()
+                lines.extend(snapshot.register_lines())
+                line = f"cycle {snapshot.cycles}  frame {snapshot.frames}"
+                if last is not None and snapshot.cycles > last.cycles:
+                    line += f"  {(snapshot.cycles - last.cycles) / (now - last_time):.0f} instructions per second"
+                lines.append(line)
+                if sys.stdout.isatty() and not args.registers:
+                    # Redraw in place
+                    print("\x1b[H\x1b[J", end="")
+                print("\n".join(lines), flush=True)
+                last = snapshot
+                last_time = now
+                shown += 1
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        view.close()
+    return 0
+
+
+def cmd_trace_diff(args):
+    index, lines = diff_report(args.trace_a, args.trace_b, args.context)
+    print("\n".join(lines))
+    return 0 if index is None else 1
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog="python -m chip8_interpreter", description="Headless CHIP-8 tools")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run = commands.add_parser("run", help="run a ROM without a display")
+    run.add_argument("rom")
+    run.add_argument("--cycles", type=int, help="number of instructions to execute (default: 100000, or the length of the replayed session)")
+    run.add_argument("--engine", choices=["interpreter", "compiled"], default="interpreter")
+    run.add_argument("--ipf", type=int, default=INSTRUCTIONS_PER_FRAME, help="instructions per emulated 60Hz frame")
+    run.add_argument("--quirks", choices=list(QUIRK_PROFILES), default=DEFAULT_QUIRKS, help="interpreter behaviour to emulate")
+    run.add_argument("--seed", type=int, help="seed for the random number generator")
+    run.add_argument("--input-script", help="file with '<cycle> <hex key mask>' lines")
+    run.add_argument("--replay", help="input log recorded by chipy.py, sets the seed, ipf and inputs")
+    run.add_argument("--dump", action="append", choices=["hash", "vram", "registers", "memory"],
+                     help="what to print after the run, may be repeated (default: hash)")
+    run.add_argument("--json", action="store_true", help="print a single JSON report line")
+    run.add_argument("--load-state", help="save state file to start from, the ROM is loaded first")
+    run.add_argument("--save-state", help="write a save state file after the run")
+    run.add_argument("--profile", action="store_true", help="print per instruction class and per address counts to stderr")
+    run.add_argument("--profile-sample", type=int, default=16, help="time one in this many calls of each handler")
+    run.add_argument("--flamegraph", help="write subroutine stacks in folded format, weighted by instructions")
+    run.add_argument("--trace", help="write a binary record of every executed instruction to this file")
+    run.add_argument("--beeps", action="store_true",
+                     help="log the intervals the sound timer beeps, in emulated frames")
+    run.add_argument("--no-fast-forward", action="store_true",
+                     help="interpret idle loops instruction by instruction instead of skipping them")
+    run.add_argument("--predecode", action="store_true",
+                     help="analyze the ROM and decode (or compile) all of its code before running")
+    run.add_argument("--cache-dir", help="keep the ROM analysis and compiled blocks in this directory "
+                                         "across runs, implies --predecode")
+    run.add_argument("--cache-limit", type=int, default=DEFAULT_CACHE_LIMIT >> 20,
+                     help="size limit of the cache directory in MiB, least recently used entries are deleted")
+    run.add_argument("--share", metavar="NAME",
+                     help="keep memory, display and registers in a shared memory segment of this name for watch")
+    run.set_defaults(func=cmd_run)
+
+    analyze_ = commands.add_parser("analyze", help="disassemble a ROM and map its code, data and store targets")
+    analyze_.add_argument("rom")
+    analyze_.add_argument("--entry", type=lambda text: int(text, 0), default=PROGRAM_START,
+                          help="address to start disassembling at (default: 0x200)")
+    analyze_.add_argument("--quirks", choices=list(QUIRK_PROFILES), default=DEFAULT_QUIRKS,
+                          help="interpreter behaviour, decides how FX55/FX65 move I")
+    analyze_.add_argument("--listing", action="store_true", help="print the disassembly after the summary")
+    analyze_.add_argument("--json", action="store_true", help="print the map as a single JSON document")
+    analyze_.set_defaults(func=cmd_analyze)
+
+    fleet = commands.add_parser("fleet", help="run many ROM/seed combinations on a process pool")
+    fleet.add_argument("roms", nargs="+")
+    fleet.add_argument("--cycles", type=int, default=100000, help="instructions per job")
+    fleet.add_argument("--seeds", type=int, default=1, help="number of seeds to run per ROM")
+    fleet.add_argument("--seed-start", type=int, default=0)
+    fleet.add_argument("--workers", type=int, help="worker processes (default: one per CPU)")
+    fleet.add_argument("--engine", choices=["interpreter", "compiled"], default="interpreter")
+    fleet.add_argument("--ipf", type=int, default=INSTRUCTIONS_PER_FRAME, help="instructions per emulated 60Hz frame")
+    fleet.add_argument("--quirks", choices=list(QUIRK_PROFILES), default=DEFAULT_QUIRKS, help="interpreter behaviour to emulate")
+    fleet.add_argument("--input-script", help="file with '<cycle> <hex key mask>' lines, used by every job")
+    fleet.add_argument("--state", help="save state file every job starts from, e.g. after the boot sequence")
+    fleet.add_argument("--cache-dir", help="prepare every ROM from, and into, this artifact cache directory")
+    fleet.add_argument("--cache-limit", type=int, default=DEFAULT_CACHE_LIMIT >> 20,
+                       help="size limit of the cache directory in MiB")
+    fleet.set_defaults(func=cmd_fleet)
+
+    bench = commands.add_parser("bench", help="benchmark the ROM corpus and compare against a stored baseline")
+    bench.add_argument("roms", nargs="*", help="ROM files or directories (default: roms and the current directory)")
+    bench.add_argument("--cycles", type=int, default=200000, help="instructions per run")
+    bench.add_argument("--seed", type=int, default=1)
+    bench.add_argument("--ipf", type=int, default=INSTRUCTIONS_PER_FRAME, help="instructions per emulated 60Hz frame")
+    bench.add_argument("--input-script", help="file with '<cycle> <hex key mask>' lines (default: a built-in pattern)")
+    bench.add_argument("--engine", choices=["interpreter", "compiled", "both"], default="both")
+    bench.add_argument("--repeat", type=int, default=3, help="runs per ROM and engine, the best is kept")
+    bench.add_argument("--frames", type=int, default=600, help="frames for the frontend frame time")
+    bench.add_argument("--output", help="write the results as a JSON baseline")
+    bench.add_argument("--compare", help="baseline to compare against, exits with 1 on regressions")
+    bench.add_argument("--threshold", type=float, default=0.10, help="relative change that counts as a regression")
+    bench.set_defaults(func=cmd_bench)
+
+    conformance = commands.add_parser("conformance", help="check display hashes of the test ROMs against golden ones")
+    conformance.add_argument("cases", nargs="*", help="cases to run (default: all)")
+    conformance.add_argument("--golden", default=DEFAULT_GOLDEN, help=f"golden hash file (default: {DEFAULT_GOLDEN})")
+    conformance.add_argument("--engine", choices=["interpreter", "compiled", "both"], default="both",
+                             help="engines to check, each with idle loop skipping off and on")
+    conformance.add_argument("--update", action="store_true",
+                             help="record the hashes of the selected cases as the golden ones")
+    conformance.add_argument("--dump-dir", default=DEFAULT_DUMP_DIR,
+                             help=f"where diverging frames are written as text (default: {DEFAULT_DUMP_DIR})")
+    conformance.set_defaults(func=cmd_conformance)
+
+    watch = commands.add_parser("watch", help="show the display and registers of a machine run with --share")
+    watch.add_argument("name", help="name of the shared memory segment")
+    watch.add_argument("--interval", type=float, default=0.1, help="seconds between reads")
+    watch.add_argument("--count", type=int, help="stop after this many states (default: until interrupted)")
+    watch.add_argument("--registers", action="store_true", help="print only the registers, one state after another")
+    watch.set_defaults(func=cmd_watch)
+
+    trace_diff = commands.add_parser("trace-diff", help="find the first differing record of two trace files")
+    trace_diff.add_argument("trace_a")
+    trace_diff.add_argument("trace_b")
+    trace_diff.add_argument("--context", type=int, default=5, help="records to show before the difference")
+    trace_diff.set_defaults(func=cmd_trace_diff)
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
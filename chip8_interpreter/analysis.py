@@ -0,0 +1,430 @@
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+from chip8_interpreter.chip8 import DEFAULT_QUIRKS, QUIRK_PROFILES, Chip8
+from chip8_interpreter.compiler import BlockCompiler
+
+PROGRAM_START = 0x200
+MEMORY_SIZE = 4096
+
+# Flags of every byte in RomMap.flags, a byte can be several at once,
+# e.g. a sprite that is also executed
+CODE = 0x01
+DATA = 0x02
+# A FX33/FX55 may store into it
+WRITTEN = 0x04
+
+# How a basic block ends
+EXIT_FALL = "fall"
+EXIT_JUMP = "jump"
+EXIT_CALL = "call"
+EXIT_SKIP = "skip"
+EXIT_RETURN = "return"
+EXIT_INDIRECT = "indirect"
+EXIT_HALT = "halt"
+
+# Value of I when it cannot be known statically
+UNKNOWN = -1
+
+# Assembly names of the 8xyN and Fxkk instructions
+ALU_MNEMONICS = {0x0: "LD", 0x1: "OR", 0x2: "AND", 0x3: "XOR", 0x4: "ADD", 0x5: "SUB", 0x6: "SHR", 0x7: "SUBN", 0xE: "SHL"}
+F_MNEMONICS = {
+    0x07: "LD V{x:X}, DT", 0x0A: "LD V{x:X}, K", 0x15: "LD DT, V{x:X}", 0x18: "LD ST, V{x:X}", 0x1E: "ADD I, V{x:X}",
+    0x29: "LD F, V{x:X}", 0x33: "LD B, V{x:X}", 0x55: "LD [I], V{x:X}", 0x65: "LD V{x:X}, [I]",
+}
+
+
+class BasicBlock(NamedTuple):
+    start: int
+    # First address after the last instruction
+    end: int
+    exit: str
+    # Addresses control can continue at. A call lists the subroutine and the
+    # return address, returns and Bnnn jumps are indirect and list nothing.
+    successors: Tuple[int, ...]
+
+
+def mnemonic(opcode: int) -> str:
+    """ Assembly text of one instruction, in the syntax of Cowgod's reference. """
+    x = (opcode >> 8) & 0xF
+    y = (opcode >> 4) & 0xF
+    n = opcode & 0xF
+    nn = opcode & 0xFF
+    nnn = opcode & 0xFFF
+    group = opcode >> 12
+    if opcode == 0x00E0:
+        return "CLS"
+    if opcode == 0x00EE:
+        return "RET"
+    if opcode == 0x0000:
+        return "HALT"
+    if group == 0x0:
+        return f"SYS {nnn:03x}"
+    if group == 0x1:
+        return f"JP {nnn:03x}"
+    if group == 0x2:
+        return f"CALL {nnn:03x}"
+    if group == 0x3:
+        return f"SE V{x:X}, {nn:02x}"
+    if group == 0x4:
+        return f"SNE V{x:X}, {nn:02x}"
+    # The engines ignore the low nibble of 5xyN and 9xyN
+    if group == 0x5:
+        return f"SE V{x:X}, V{y:X}"
+    if group == 0x6:
+        return f"LD V{x:X}, {nn:02x}"
+    if group == 0x7:
+        return f"ADD V{x:X}, {nn:02x}"
+    if group == 0x8 and n in ALU_MNEMONICS:
+        return f"{ALU_MNEMONICS[n]} V{x:X}, V{y:X}"
+    if group == 0x9:
+        return f"SNE V{x:X}, V{y:X}"
+    if group == 0xA:
+        return f"LD I, {nnn:03x}"
+    if group == 0xB:
+        return f"JP V0, {nnn:03x}"
+    if group == 0xC:
+        return f"RND V{x:X}, {nn:02x}"
+    if group == 0xD:
+        return f"DRW V{x:X}, V{y:X}, {n:x}"
+    if group == 0xE and nn == 0x9E:
+        return f"SKP V{x:X}"
+    if group == 0xE and nn == 0xA1:
+        return f"SKNP V{x:X}"
+    if group == 0xF and nn in F_MNEMONICS:
+        return F_MNEMONICS[nn].format(x=x)
+    return f"DW {opcode:04x}"
+
+
+def is_known(opcode: int) -> bool:
+    """ Whether the interpreter has a handler for opcode, anything else is ignored like SYS. """
+    return not mnemonic(opcode).startswith(("DW", "SYS"))
+
+
+def is_skip(opcode: int) -> bool:
+    group = opcode >> 12
+    return group in (0x3, 0x4, 0x5, 0x9) or (group == 0xE and opcode & 0xFF in (0x9E, 0xA1))
+
+
+class RomMap:
+    """
+    What a static look at a ROM tells about it, built by analyze():
+
+        instructions  address: opcode of every instruction reachable from the entry
+        blocks        start address: BasicBlock, the control flow graph
+        flags         CODE / DATA / WRITTEN flags of every memory byte
+        subroutines   entry addresses of the called subroutines
+        references    addresses loaded into I by ANNN
+        indirect      addresses of RET and Bnnn, whose targets are not followed
+        unknown       addresses of reached opcodes the interpreter does not know
+        writes        address of every FX33/FX55: (start, end) of the bytes it
+                      stores to, or None when I is not known there
+
+    Only what can be reached by following jumps, calls and skips is code.
+    Bytes read by DXYN and FX65 with a known I, the font after FX29 and the
+    first byte of every reference are data. Sprites read through an I that
+    was advanced by FX1E are not found, their start still is a reference.
+    """
+
+    def __init__(self, rom: bytes, entry: int, quirks: str):
+        self.rom = bytes(rom)
+        self.entry = entry
+        self.quirks = QUIRK_PROFILES[quirks]
+        self.memory = bytearray(MEMORY_SIZE)
+        self.memory[:len(Chip8.fontset)] = Chip8.fontset
+        self.memory[PROGRAM_START:PROGRAM_START + len(rom)] = rom
+        self.flags = bytearray(MEMORY_SIZE)
+        self.instructions: Dict[int, int] = {}
+        self.blocks: Dict[int, BasicBlock] = {}
+        self.subroutines: Set[int] = set()
+        self.references: Set[int] = set()
+        self.indirect: List[int] = []
+        self.unknown: List[int] = []
+        self.writes: Dict[int, Optional[Tuple[int, int]]] = {}
+
+    @property
+    def self_modifying(self) -> bool:
+        """ Whether some store may write into code, so decoded instructions must be checked for writes. """
+        if any(target is None for target in self.writes.values()):
+            return True
+        return any(flag & CODE and flag & WRITTEN for flag in self.flags)
+
+    def code_ranges(self) -> List[Tuple[int, int]]:
+        """ (start, end) of every run of code bytes. """
+        return _runs(self.flags, CODE)
+
+    def data_ranges(self) -> List[Tuple[int, int]]:
+        return _runs(self.flags, DATA)
+
+    def write_ranges(self) -> List[Tuple[int, int]]:
+        return _runs(self.flags, WRITTEN)
+
+    def summary(self) -> List[str]:
+        code = sum(1 for flag in self.flags if flag & CODE)
+        data = sum(1 for flag in self.flags if flag & DATA)
+        lines = [f"{len(self.rom)} bytes, {len(self.instructions)} instructions in {len(self.blocks)} blocks, "
+                 f"{len(self.subroutines)} subroutines",
+                 f"code {code} bytes, data {data} bytes, "
+                 f"self modifying: {'yes' if self.self_modifying else 'no'}"]
+        for address in self.indirect:
+            lines.append(f"indirect  {address:03x}  {mnemonic(self.instructions[address])}")
+        for address in self.unknown:
+            lines.append(f"unknown   {address:03x}  {self.instructions[address]:04x}")
+        for address, target in sorted(self.writes.items()):
+            where = f"{target[0]:03x}-{target[1] - 1:03x}" if target else "anywhere, I unknown"
+            lines.append(f"store     {address:03x}  {mnemonic(self.instructions[address]):14s} -> {where}")
+        return lines
+
+    def listing(self) -> List[str]:
+        """ Disassembly of the ROM: instructions by block, everything else as data bytes. """
+        lines = []
+        address = PROGRAM_START
+        end = PROGRAM_START + len(self.rom)
+        memory = self.memory
+        while address < end:
+            if address in self.blocks:
+                block = self.blocks[address]
+                label = "sub" if address in self.subroutines else "block"
+                successors = ", ".join(f"{successor:03x}" for successor in block.successors)
+                lines.append(f"{label}_{address:03x}:  ; {block.exit} {successors}".rstrip())
+            if address in self.references:
+                lines.append(f"data_{address:03x}:")
+            if address in self.instructions:
+                opcode = self.instructions[address]
+                lines.append(f"    {address:03x}  {opcode:04x}  {mnemonic(opcode)}")
+                address += 2
+                continue
+            # A run of non code bytes, up to 8 per line
+            start = address
+            address += 1
+            while (address < end and address - start < 8 and address not in self.instructions
+                   and address not in self.references):
+                address += 1
+            kind = "data" if any(flag & DATA for flag in self.flags[start:address]) else "not code"
+            lines.append(f"    {start:03x}  {memory[start:address].hex(' '):23s}  ; {kind}")
+        return lines
+
+    def to_json(self) -> dict:
+        return {
+            "entry": self.entry,
+            "instructions": len(self.instructions),
+            "blocks": [{"start": block.start, "end": block.end, "exit": block.exit,
+                        "successors": list(block.successors)} for block in self.blocks.values()],
+            "subroutines": sorted(self.subroutines),
+            "references": sorted(self.references),
+            "indirect": self.indirect,
+            "unknown": self.unknown,
+            "writes": [{"address": address, "target": list(target) if target else None}
+                       for address, target in sorted(self.writes.items())],
+            "code": self.code_ranges(),
+            "data": self.data_ranges(),
+            "written": self.write_ranges(),
+            "self_modifying": self.self_modifying,
+        }
+
+
+def _runs(flags: bytearray, flag: int) -> List[Tuple[int, int]]:
+    runs = []
+    start = None
+    for address, value in enumerate(flags):
+        if value & flag:
+            if start is None:
+                start = address
+        elif start is not None:
+            runs.append((start, address))
+            start = None
+    if start is not None:
+        runs.append((start, len(flags)))
+    return runs
+
+
+def analyze(rom: bytes, entry: int = PROGRAM_START, quirks: str = DEFAULT_QUIRKS) -> RomMap:
+    """
+    Disassembles rom recursively from entry, following jumps, calls and both
+    ways of every skip, splits what was reached into basic blocks and follows
+    the value of I through them to find the sprites and the store targets.
+    """
+    rom_map = RomMap(rom, entry, quirks)
+    _disassemble(rom_map)
+    _build_blocks(rom_map)
+    _track_index(rom_map)
+    return rom_map
+
+
+def _disassemble(rom_map: RomMap):
+    memory = rom_map.memory
+    instructions = rom_map.instructions
+    pending = [rom_map.entry]
+    while pending:
+        address = pending.pop()
+        # Falls through until something ends the straight line code
+        while address not in instructions and address + 1 < MEMORY_SIZE:
+            opcode = memory[address] << 8 | memory[address + 1]
+            instructions[address] = opcode
+            rom_map.flags[address] |= CODE
+            rom_map.flags[address + 1] |= CODE
+            group = opcode >> 12
+            if opcode == 0x00EE or group == 0xB:
+                rom_map.indirect.append(address)
+                break
+            if opcode == 0x0000:
+                break
+            if not is_known(opcode):
+                rom_map.unknown.append(address)
+            if group == 0x1:
+                pending.append(opcode & 0xFFF)
+                break
+            if group == 0x2:
+                rom_map.subroutines.add(opcode & 0xFFF)
+                pending.append(opcode & 0xFFF)
+            elif is_skip(opcode):
+                pending.append(address + 4)
+            address += 2
+    rom_map.indirect.sort()
+    rom_map.unknown.sort()
+
+
+def _exit(address: int, opcode: int) -> Optional[Tuple[str, Tuple[int, ...]]]:
+    """ How an instruction ends its block, None when it does not. """
+    group = opcode >> 12
+    if opcode == 0x00EE:
+        return EXIT_RETURN, ()
+    if opcode == 0x0000:
+        return EXIT_HALT, ()
+    if group == 0xB:
+        return EXIT_INDIRECT, ()
+    if group == 0x1:
+        return EXIT_JUMP, (opcode & 0xFFF,)
+    if group == 0x2:
+        return EXIT_CALL, (opcode & 0xFFF, address + 2)
+    if is_skip(opcode):
+        return EXIT_SKIP, (address + 2, address + 4)
+    return None
+
+
+def _build_blocks(rom_map: RomMap):
+    instructions = rom_map.instructions
+    leaders = {rom_map.entry}
+    for address, opcode in instructions.items():
+        exit_ = _exit(address, opcode)
+        if exit_ is not None:
+            leaders.update(exit_[1])
+    for start in sorted(leaders):
+        if start not in instructions:
+            continue
+        address = start
+        while True:
+            exit_ = _exit(address, instructions[address])
+            if exit_ is not None:
+                rom_map.blocks[start] = BasicBlock(start, address + 2, *exit_)
+                break
+            address += 2
+            if address in leaders or address not in instructions:
+                successors = (address,) if address in instructions else ()
+                rom_map.blocks[start] = BasicBlock(start, address, EXIT_FALL, successors)
+                break
+
+
+def _track_index(rom_map: RomMap):
+    """
+    Forward data flow of I over the blocks: a block starts with the value all
+    its predecessors agree on, or UNKNOWN. After a call I is UNKNOWN, the
+    subroutine may have changed it. I is 0 at power on.
+    """
+    blocks = rom_map.blocks
+    entry_index: Dict[int, int] = {rom_map.entry: 0}
+    pending = [rom_map.entry]
+    while pending:
+        start = pending.pop()
+        if start not in blocks:
+            continue
+        block = blocks[start]
+        index = _run_block(rom_map, block, entry_index[start], record=False)
+        for position, successor in enumerate(block.successors):
+            value = UNKNOWN if block.exit == EXIT_CALL and position == 1 else index
+            previous = entry_index.get(successor)
+            merged = value if previous is None or previous == value else UNKNOWN
+            if merged != previous:
+                entry_index[successor] = merged
+                pending.append(successor)
+
+    for start, block in blocks.items():
+        # Blocks only reached through RET or Bnnn have no known I
+        _run_block(rom_map, block, entry_index.get(start, UNKNOWN), record=True)
+
+
+def _run_block(rom_map: RomMap, block: BasicBlock, index: int, record: bool) -> int:
+    """ Value of I at the end of block. With record, flags the bytes its instructions read and write. """
+    flags = rom_map.flags
+    load_store_index = rom_map.quirks.load_store_index
+
+    def mark(start: int, end: int, flag: int):
+        for address in range(start, min(end, MEMORY_SIZE)):
+            flags[address] |= flag
+
+    for address in range(block.start, block.end, 2):
+        opcode = rom_map.instructions[address]
+        group = opcode >> 12
+        x = (opcode >> 8) & 0xF
+        low = opcode & 0xFF
+        if group == 0xA:
+            index = opcode & 0xFFF
+            if record:
+                rom_map.references.add(index)
+                mark(index, index + 1, DATA)
+        elif group == 0xD:
+            if record and index != UNKNOWN:
+                mark(index, index + (opcode & 0xF), DATA)
+        elif group == 0xF and low == 0x1E:
+            index = UNKNOWN
+        elif group == 0xF and low == 0x29:
+            if record:
+                mark(0, len(Chip8.fontset), DATA)
+            index = UNKNOWN
+        elif group == 0xF and low in (0x33, 0x55, 0x65):
+            length = 3 if low == 0x33 else x + 1
+            if record:
+                target = (index, min(index + length, MEMORY_SIZE)) if index != UNKNOWN else None
+                if low == 0x65:
+                    if target:
+                        mark(*target, DATA)
+                else:
+                    rom_map.writes[address] = target
+                    if target:
+                        mark(*target, WRITTEN)
+            if low != 0x33 and index != UNKNOWN:
+                if load_store_index == "x":
+                    index += x
+                elif load_store_index == "x+1":
+                    index += x + 1
+    return index
+
+
+def predecode(chip8: Chip8, rom_map: RomMap) -> int:
+    """
+    Decodes every instruction of rom_map into the decoded instruction cache
+    of chip8, so running the program does not decode anything the analysis
+    found. Returns the number of instructions decoded. Entries dropped by
+    writes are decoded again on use as usual.
+    """
+    decode = chip8.decode
+    for address in rom_map.instructions:
+        decode(address)
+    return len(rom_map.instructions)
+
+
+def precompile(compiler: BlockCompiler, rom_map: RomMap) -> int:
+    """
+    Compiles the blocks of compiler that cover the basic blocks of rom_map
+    ahead of running. A compiled block ends at skips it cannot follow or at
+    the code a jump or call takes it to, so each basic block may take
+    several. Returns the number of blocks compiled.
+    """
+    compiled = 0
+    for block in rom_map.blocks.values():
+        address = block.start
+        while address < block.end:
+            if address not in compiler.blocks:
+                compiler.compile(address)
+                compiled += 1
+            address = compiler.blocks[address][1]
+    return compiled
@@ -0,0 +1,118 @@
+from array import array
+from typing import List, NamedTuple, Optional
+import time
+
+from chip8_interpreter.chip8 import Chip8
+from chip8_interpreter.scheduler import FRAME_RATE
+from chip8_interpreter.stats import Timings
+
+TONE_FREQUENCY = 441
+SAMPLE_RATE = 44100
+# Mixer buffer in samples, the output latency it adds is MIXER_BUFFER / SAMPLE_RATE (~11.6 ms)
+MIXER_BUFFER = 512
+TONE_VOLUME = 0.25
+
+
+class BeepInterval(NamedTuple):
+    # chip8.frames when the beep was first seen on and first seen off
+    start_frame: int
+    end_frame: int
+
+    @property
+    def seconds(self) -> float:
+        return (self.end_frame - self.start_frame) / FRAME_RATE
+
+
+def square_wave(frequency: int = TONE_FREQUENCY, sample_rate: int = SAMPLE_RATE,
+                volume: float = TONE_VOLUME, periods: int = 10) -> bytes:
+    """
+    Signed 16 bit mono samples of a square wave, a whole number of periods
+    long so it loops without a click. Computed once, played in a loop.
+    """
+    period = round(sample_rate / frequency)
+    high = int(volume * 32767)
+    half = period // 2
+    samples = array("h", [high] * half + [-high] * (period - half)) * periods
+    return samples.tobytes()
+
+
+class SoundTimerWatch:
+    """
+    Turns the sound timer into beeps. update() is called once per emulated
+    frame, or batch of frames, by the frontend and compares the sound timer
+    with the last call: start() and stop() run on the transitions, the
+    instructions themselves are not touched at all.
+
+    The timer is read after the frame ended, so a sound timer set to 1 does
+    not beep, like on the COSMAC VIP. This class only logs the intervals,
+    e.g. for headless runs; MixerBeeper plays them.
+    """
+
+    def __init__(self, chip8: Chip8):
+        self.chip8 = chip8
+        self.beeping = False
+        self.start_frame = 0
+        self.intervals: List[BeepInterval] = []
+
+    def update(self, active: bool = True):
+        """ Follows the sound timer, active=False silences the beep, e.g. while paused. """
+        beeping = active and self.chip8.sound_timer > 0
+        if beeping == self.beeping:
+            return
+        self.beeping = beeping
+        if beeping:
+            self.start_frame = self.chip8.frames
+            self.start()
+        else:
+            self.intervals.append(BeepInterval(self.start_frame, self.chip8.frames))
+            self.stop()
+
+    def close(self):
+        self.update(False)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def report(self) -> List[str]:
+        return [f"beep  frames {interval.start_frame}-{interval.end_frame}  ({interval.seconds:.3f} s)"
+                for interval in self.intervals]
+
+
+class MixerBeeper(SoundTimerWatch):
+    """
+    Plays a looping square wave through the pygame mixer while the sound
+    timer runs. The tone is built once, start() and stop() only tell the
+    mixer to play or stop it, which returns right away. The time of those
+    calls goes to timings as "audio start" / "audio stop"; output_latency
+    is what the mixer buffer adds on top.
+    Raises pygame.error when there is no audio device.
+    """
+
+    def __init__(self, chip8: Chip8, timings: Optional[Timings] = None):
+        super().__init__(chip8)
+        import pygame
+
+        if pygame.mixer.get_init() is None:
+            pygame.mixer.init(SAMPLE_RATE, -16, 1, MIXER_BUFFER)
+        frequency, _, channels = pygame.mixer.get_init()
+        # The tone must match the mixer format, it may have opened with other settings
+        tone = square_wave(sample_rate=frequency)
+        if channels > 1:
+            mono = array("h", tone)
+            tone = array("h", (sample for sample in mono for _ in range(channels))).tobytes()
+        self.sound = pygame.mixer.Sound(buffer=tone)
+        self.output_latency = MIXER_BUFFER / frequency
+        self.timings = timings if timings is not None else Timings()
+
+    def start(self):
+        start = time.perf_counter()
+        self.sound.play(loops=-1)
+        self.timings.add("audio start", time.perf_counter() - start)
+
+    def stop(self):
+        start = time.perf_counter()
+        self.sound.stop()
+        self.timings.add("audio stop", time.perf_counter() - start)
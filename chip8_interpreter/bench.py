@@ -0,0 +1,246 @@
+from typing import Dict, List, Optional, Sequence, Tuple
+import glob
+import json
+import math
+import os
+import platform
+import time
+
+from chip8_interpreter.chip8 import Chip8
+from chip8_interpreter.compiler import BlockCompiler
+from chip8_interpreter.display import dirty_band, upload_rows
+from chip8_interpreter.headless import InputScript, frame_hash, load_rom, run_headless
+from chip8_interpreter.replay import InputReplayer
+from chip8_interpreter.scheduler import FIXED, INSTRUCTIONS_PER_FRAME, Scheduler
+
+BASELINE_VERSION = 2
+ENGINES = ("interpreter", "compiled")
+# The window of chipy.py at its default scale of 10
+WINDOW_SIZE = (640, 320)
+
+# Metrics compared against a baseline and whether higher values are better,
+# every engine's instructions per second on its own
+METRICS = {
+    **{f"ips_{engine}": True for engine in ENGINES},
+    "speedup": True,
+    "draw_us": False,
+    "frame_us": False,
+}
+
+
+def find_roms(paths: Sequence[str] = ("roms", ".")) -> List[str]:
+    """ The .ch8 files in the given directories, or the given files themselves. """
+    roms = []
+    for path in paths:
+        if os.path.isdir(path):
+            roms.extend(sorted(glob.glob(os.path.join(path, "*.ch8"))))
+        else:
+            roms.append(path)
+    return roms
+
+
+def default_input_script(cycles: int, period: int = 300) -> List[Tuple[int, int]]:
+    """ Deterministic key presses: every period cycles a different key mask, every third period none. """
+    return [(start, (step * 2654435761) & 0xFFFF if step % 3 else 0)
+            for step, start in enumerate(range(0, cycles, period))]
+
+
+def _power_on(rom: bytes, seed: int) -> Chip8:
+    machine = Chip8(seed)
+    machine.load_program_to_memory(rom)
+    return machine
+
+
+def measure_ips(rom: bytes, engine: str, cycles: int, seed: int, inputs: InputScript,
+                instructions_per_frame: int, repeat: int) -> Tuple[float, str]:
+    """ Best instructions per second of repeat runs on fresh machines, and the final frame hash. """
+    best = 0.0
+    for _ in range(repeat):
+        machine = _power_on(rom, seed)
+        compiler = BlockCompiler(machine) if engine == "compiled" else None
+        result = run_headless(machine, cycles, compiler, instructions_per_frame, inputs)
+        best = max(best, result.ips)
+    return best, frame_hash(machine)
+
+
+def measure_speedup(rom: bytes, cycles: int, seed: int, inputs: InputScript,
+                    instructions_per_frame: int, repeat: int) -> float:
+    """
+    Instructions per second of the compiled engine over the interpreter's
+    once both are warm: every run continues a machine that already ran
+    cycles instructions, so blocks are compiled and instructions decoded.
+    Idle loops are not skipped, both engines execute every instruction.
+    """
+    best = {}
+    for engine in ENGINES:
+        best[engine] = 0.0
+        for _ in range(repeat):
+            machine = _power_on(rom, seed)
+            machine.fast_forward = False
+            compiler = BlockCompiler(machine) if engine == "compiled" else None
+            run_headless(machine, cycles, compiler, instructions_per_frame, inputs)
+            result = run_headless(machine, cycles, compiler, instructions_per_frame, inputs)
+            best[engine] = max(best[engine], result.ips)
+    return best["compiled"] / best["interpreter"]
+
+
+def measure_draws(rom: bytes, cycles: int, seed: int, inputs: InputScript,
+                  instructions_per_frame: int) -> Tuple[int, float]:
+    """ Number of DXYN and 00E0 instructions in the run and their mean cost in microseconds. """
+    machine = _power_on(rom, seed)
+    totals = [0, 0.0]
+
+    def timed(handler):
+        def draw(x, y, n, nn, nnn):
+            start = time.perf_counter()
+            handler(x, y, n, nn, nnn)
+            totals[1] += time.perf_counter() - start
+            totals[0] += 1
+        return draw
+
+    # Nothing at the program addresses is decoded yet, every draw goes through the wrappers
+    machine.optable[0xD000] = timed(machine.draw_to_vram)
+    machine.optable_0[0x00E0] = timed(machine.clear_screen)
+    machine.invalidate_decoded(0, len(machine.memory))
+    run_headless(machine, cycles, None, instructions_per_frame, inputs)
+    draws, seconds = totals
+    return draws, seconds / draws * 1e6 if draws else 0.0
+
+
+def measure_frames(rom: bytes, frames: int, seed: int, inputs: InputScript,
+                   instructions_per_frame: int) -> Tuple[float, float]:
+    """
+    Mean and 95th percentile wall time of one frontend frame in microseconds:
+    one emulated frame, then uploading the dirty rows to an RGB buffer and,
+    when pygame is installed, scaling the dirty band to a surface of the
+    size of chipy's window.
+    """
+    try:
+        import pygame
+    except ImportError:
+        pygame = None
+
+    machine = _power_on(rom, seed)
+    scheduler = Scheduler(machine, instructions_per_frame, FIXED, inputs=InputReplayer(inputs) if inputs else None)
+    frame_buffer = bytearray(64 * 32 * 3)
+    if pygame is not None:
+        screen = pygame.image.frombuffer(frame_buffer, (64, 32), "RGB")
+        width, height = WINDOW_SIZE
+        window = pygame.Surface(WINDOW_SIZE)
+        row_height = height // 32
+
+    times = []
+    for _ in range(frames):
+        start = time.perf_counter()
+        scheduler.run_frame()
+        dirty_rows = machine.take_dirty_rows()
+        if dirty_rows:
+            upload_rows(frame_buffer, machine.vram, dirty_rows)
+            if pygame is not None:
+                top, bottom = dirty_band(dirty_rows)
+                band = pygame.Rect(0, top * row_height, width, (bottom - top) * row_height)
+                window.blit(pygame.transform.scale(screen.subsurface((0, top, 64, bottom - top)), band.size), band)
+        times.append(time.perf_counter() - start)
+
+    times.sort()
+    return sum(times) / len(times) * 1e6, times[int(len(times) * 0.95)] * 1e6
+
+
+def run_suite(roms: Sequence[str], cycles: int = 200000, seed: int = 1, inputs: Optional[InputScript] = None,
+              instructions_per_frame: int = INSTRUCTIONS_PER_FRAME, engines: Sequence[str] = ENGINES,
+              repeat: int = 3, frames: int = 600, report=print) -> dict:
+    """ Runs every benchmark on every ROM and returns the results as a baseline document. """
+    if inputs is None:
+        inputs = default_input_script(cycles)
+    results = {}
+    for path in roms:
+        rom = load_rom(path)
+        name = os.path.basename(path)
+        entry: Dict[str, object] = {}
+        for engine in engines:
+            ips, final_hash = measure_ips(rom, engine, cycles, seed, inputs, instructions_per_frame, repeat)
+            entry[f"ips_{engine}"] = ips
+            entry[f"frame_hash_{engine}"] = final_hash
+        if set(ENGINES) <= set(engines):
+            entry["speedup"] = measure_speedup(rom, cycles, seed, inputs, instructions_per_frame, repeat)
+        entry["draws"], entry["draw_us"] = measure_draws(rom, cycles, seed, inputs, instructions_per_frame)
+        entry["frame_us"], entry["frame_us_p95"] = measure_frames(rom, frames, seed, inputs, instructions_per_frame)
+        results[name] = entry
+        report(f"{name:24s} " + "  ".join(f"{engine} {entry[f'ips_{engine}']:10.0f} ips" for engine in engines) +
+               (f"  warm speedup {entry['speedup']:5.2f}x" if "speedup" in entry else "") +
+               f"  draw {entry['draw_us']:6.2f} us x{entry['draws']}"
+               f"  frame {entry['frame_us']:7.1f} us (p95 {entry['frame_us_p95']:.1f})")
+    speedups = [entry["speedup"] for entry in results.values() if "speedup" in entry]
+    if speedups:
+        report(f"compiled engine warm speedup: geometric mean {math.exp(sum(map(math.log, speedups)) / len(speedups)):.2f}x, "
+               f"lowest {min(speedups):.2f}x")
+
+    return {
+        "version": BASELINE_VERSION,
+        "settings": {
+            "cycles": cycles,
+            "seed": seed,
+            "instructions_per_frame": instructions_per_frame,
+            "engines": list(engines),
+            "repeat": repeat,
+            "frames": frames,
+            "inputs": len(inputs),
+        },
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "results": results,
+    }
+
+
+def save_baseline(path: str, baseline: dict):
+    with open(path, "w") as out_file:
+        json.dump(baseline, out_file, indent=2, sort_keys=True)
+        out_file.write("\n")
+
+
+def load_baseline(path: str) -> dict:
+    with open(path) as in_file:
+        baseline = json.load(in_file)
+    if baseline.get("version") != BASELINE_VERSION:
+        raise Exception(f"Unsupported baseline version {baseline.get('version')}, expected {BASELINE_VERSION}")
+    return baseline
+
+
+def engine_mismatches(current: dict) -> List[str]:
+    """ One line per ROM whose engines end the run on different frames. """
+    mismatches = []
+    for name, entry in sorted(current["results"].items()):
+        hashes = {engine: entry[f"frame_hash_{engine}"] for engine in ENGINES if f"frame_hash_{engine}" in entry}
+        if len(set(hashes.values())) > 1:
+            mismatches.append(f"{name}: engines end on different frames, " +
+                              ", ".join(f"{engine} {value}" for engine, value in hashes.items()))
+    return mismatches
+
+
+def compare(baseline: dict, current: dict, threshold: float = 0.10) -> List[str]:
+    """
+    Returns one line per metric that got worse than the baseline by more than
+    threshold (relative), plus frame hash changes, which mean the workload changed,
+    and engines that end a run on different frames. ROMs missing from the
+    baseline are only checked for the latter.
+    """
+    regressions = engine_mismatches(current)
+    if baseline["settings"] != current["settings"]:
+        regressions.append(f"settings differ from the baseline: {baseline['settings']} -> {current['settings']}")
+    for name, entry in sorted(current["results"].items()):
+        old = baseline["results"].get(name)
+        if old is None:
+            continue
+        for engine in ENGINES:
+            before, value = old.get(f"frame_hash_{engine}"), entry.get(f"frame_hash_{engine}")
+            if before is not None and value is not None and before != value:
+                regressions.append(f"{name}: {engine} frame hash changed, {before} -> {value}")
+        for metric, higher_is_better in METRICS.items():
+            before, after = old.get(metric), entry.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            worse = -change if higher_is_better else change
+            if worse > threshold:
+                regressions.append(f"{name}: {metric} {before:.2f} -> {after:.2f} ({change:+.1%})")
+    return regressions
@@ -0,0 +1,255 @@
+from base64 import b64decode, b64encode
+from typing import Dict, List, Optional, Tuple
+import hashlib
+import json
+import os
+import sys
+import tempfile
+
+from chip8_interpreter.analysis import BasicBlock, RomMap, analyze, precompile, predecode
+from chip8_interpreter.chip8 import Chip8
+from chip8_interpreter.compiler import BlockCompiler, CachedBlock
+
+# Layout of the cache files
+CACHE_VERSION = 3
+CACHE_SUFFIX = ".ch8a"
+# Modules whose code decides what decoding, the analysis and the block
+# compiler produce. Their hash is part of every key, so entries written by
+# another version of the engine are never read.
+ENGINE_SOURCES = ("chip8.py", "analysis.py", "compiler.py")
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "chipy")
+DEFAULT_CACHE_LIMIT = 64 << 20
+
+_engine_hash: Optional[str] = None
+
+
+def engine_hash() -> str:
+    """ Short SHA-256 of ENGINE_SOURCES, read once per process. """
+    global _engine_hash
+    if _engine_hash is None:
+        digest = hashlib.sha256()
+        for name in ENGINE_SOURCES:
+            with open(os.path.join(os.path.dirname(__file__), name), "rb") as in_file:
+                digest.update(in_file.read())
+        _engine_hash = digest.hexdigest()[:16]
+    return _engine_hash
+
+
+def map_to_dict(rom_map: RomMap) -> dict:
+    """ What analyze() found in rom_map, as JSON types. """
+    return {
+        "entry": rom_map.entry,
+        "flags": b64encode(rom_map.flags).decode("ascii"),
+        "instructions": sorted(rom_map.instructions.items()),
+        "blocks": [[block.start, block.end, block.exit, list(block.successors)] for block in rom_map.blocks.values()],
+        "subroutines": sorted(rom_map.subroutines),
+        "references": sorted(rom_map.references),
+        "indirect": rom_map.indirect,
+        "unknown": rom_map.unknown,
+        "writes": [[address, list(target) if target else None] for address, target in rom_map.writes.items()],
+    }
+
+
+def map_from_dict(rom: bytes, quirks: str, data: dict) -> RomMap:
+    """ The RomMap of rom written by map_to_dict(). """
+    rom_map = RomMap(rom, int(data["entry"]), quirks)
+    flags = b64decode(data["flags"], validate=True)
+    if len(flags) != len(rom_map.flags):
+        raise ValueError(f"{len(flags)} flags, expected {len(rom_map.flags)}")
+    rom_map.flags[:] = flags
+    rom_map.instructions = {int(address): int(opcode) for address, opcode in data["instructions"]}
+    rom_map.blocks = {int(start): BasicBlock(int(start), int(end), str(exit_), tuple(map(int, successors)))
+                      for start, end, exit_, successors in data["blocks"]}
+    rom_map.subroutines = {int(address) for address in data["subroutines"]}
+    rom_map.references = {int(address) for address in data["references"]}
+    rom_map.indirect = [int(address) for address in data["indirect"]]
+    rom_map.unknown = [int(address) for address in data["unknown"]]
+    rom_map.writes = {int(address): (int(target[0]), int(target[1])) if target else None
+                      for address, target in data["writes"]}
+    return rom_map
+
+
+def block_to_dict(block: CachedBlock) -> dict:
+    return {"ranges": [list(run) for run in block.ranges], "length": block.length,
+            "source": b64encode(block.source).decode("ascii"),
+            "code": b64encode(block.code).decode("ascii"), "handlers": list(block.handlers)}
+
+
+def block_from_dict(data: dict) -> CachedBlock:
+    return CachedBlock(tuple((int(start), int(end)) for start, end in data["ranges"]), int(data["length"]),
+                       b64decode(data["source"], validate=True), b64decode(data["code"], validate=True),
+                       tuple(map(int, data["handlers"])))
+
+
+class RomArtifacts:
+    """
+    What the cache holds for one ROM: its RomMap and compiled blocks.
+    The file is read on first access, an entry that is missing, unreadable or
+    of another version reads as empty. The code of the blocks stays
+    marshalled until BlockCompiler.compile() uses it.
+    """
+
+    def __init__(self, path: str, rom: bytes, quirks: str):
+        self.path = path
+        self.rom = rom
+        self.quirks = quirks
+        self.loaded = False
+        self._rom_map: Optional[RomMap] = None
+        self._blocks: Dict[int, CachedBlock] = {}
+
+    def _load(self):
+        self.loaded = True
+        try:
+            with open(self.path, "rb") as in_file:
+                entry = json.load(in_file)
+            if not isinstance(entry, dict) or entry.get("version") != CACHE_VERSION:
+                return
+            rom_map = map_from_dict(self.rom, self.quirks, entry["map"])
+            blocks = {int(address): block_from_dict(block) for address, block in entry["blocks"].items()}
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError, KeyError, TypeError, IndexError) as error:
+            print(f"ignoring unreadable cache entry {self.path}: {error}", file=sys.stderr)
+            return
+        self._rom_map = rom_map
+        self._blocks = blocks
+
+    @property
+    def rom_map(self) -> Optional[RomMap]:
+        if not self.loaded:
+            self._load()
+        return self._rom_map
+
+    @property
+    def blocks(self) -> Dict[int, CachedBlock]:
+        if not self.loaded:
+            self._load()
+        return self._blocks
+
+
+class ArtifactCache:
+    """
+    Directory of per ROM artifacts, one file per ROM, quirk profile and
+    engine version, named by the SHA-256 of the ROM and the engine_hash().
+    The Python version is part of the name as well, marshalled code only
+    loads in the version that wrote it.
+
+    Entries are JSON, so reading one runs nothing. The blocks in them are
+    marshalled code that runs when the ROM gets there, so a directory should
+    only be shared with users trusted to run code as you.
+
+    Files are written to a temporary file and renamed over the entry, so
+    concurrent writers never leave a partial file and readers see either
+    the old or the new entry. Reading an entry marks it as used, and after
+    every write the least recently used entries are deleted until the
+    directory is below limit bytes.
+    """
+
+    def __init__(self, directory: str = DEFAULT_CACHE_DIR, limit: int = DEFAULT_CACHE_LIMIT):
+        self.directory = directory
+        self.limit = limit
+
+    def key(self, rom: bytes, quirks: str) -> str:
+        return f"{hashlib.sha256(rom).hexdigest()}-{quirks}-{engine_hash()}-{sys.implementation.cache_tag}"
+
+    def path(self, rom: bytes, quirks: str) -> str:
+        return os.path.join(self.directory, self.key(rom, quirks) + CACHE_SUFFIX)
+
+    def open(self, rom: bytes, quirks: str) -> RomArtifacts:
+        path = self.path(rom, quirks)
+        try:
+            # The modification time is the last use for eviction
+            os.utime(path)
+        except OSError:
+            pass
+        return RomArtifacts(path, rom, quirks)
+
+    def store(self, rom: bytes, quirks: str, rom_map: RomMap, blocks: Dict[int, CachedBlock]):
+        os.makedirs(self.directory, exist_ok=True)
+        entry = {"version": CACHE_VERSION, "map": map_to_dict(rom_map),
+                 "blocks": {str(address): block_to_dict(block) for address, block in blocks.items()}}
+        data = json.dumps(entry, separators=(",", ":")).encode("ascii")
+        descriptor, temp_path = tempfile.mkstemp(dir=self.directory, prefix=".", suffix=".tmp")
+        try:
+            with os.fdopen(descriptor, "wb") as out_file:
+                out_file.write(data)
+            os.replace(temp_path, self.path(rom, quirks))
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        self.evict()
+
+    def entries(self) -> List[Tuple[float, int, str]]:
+        """ (last use, size, path) of every entry, least recently used first. """
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return entries
+        for name in names:
+            if not name.endswith(CACHE_SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                status = os.stat(path)
+            except FileNotFoundError:
+                # Evicted by another process meanwhile
+                continue
+            entries.append((status.st_mtime, status.st_size, path))
+        entries.sort()
+        return entries
+
+    def evict(self) -> int:
+        """ Deletes least recently used entries until the cache fits in limit, returns how many. """
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        evicted = 0
+        for _, size, path in entries:
+            if total <= self.limit:
+                break
+            try:
+                os.unlink(path)
+                evicted += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        return evicted
+
+
+def prepare(chip8: Chip8, rom: bytes, compiler: Optional[BlockCompiler] = None,
+            cache: Optional[ArtifactCache] = None) -> Tuple[RomMap, Optional[RomArtifacts]]:
+    """
+    Does the ROM preparation ahead of running: analyzes rom, which must be
+    loaded in chip8, and decodes all of its code, or compiles it when a
+    compiler is given. With a cache, the map and compiled blocks of an
+    earlier run are used instead where there are any, and the compiler
+    records what it translates for save_artifacts().
+    """
+    artifacts = cache.open(rom, chip8.quirk_profile) if cache is not None else None
+    rom_map = artifacts.rom_map if artifacts is not None else None
+    if rom_map is None:
+        rom_map = analyze(rom, quirks=chip8.quirk_profile)
+    if compiler is not None:
+        if artifacts is not None:
+            compiler.cached = artifacts.blocks
+            compiler.record_blocks = True
+        precompile(compiler, rom_map)
+    else:
+        predecode(chip8, rom_map)
+    return rom_map, artifacts
+
+
+def save_artifacts(cache: ArtifactCache, rom: bytes, chip8: Chip8, rom_map: RomMap, artifacts: RomArtifacts,
+                   compiler: Optional[BlockCompiler] = None) -> bool:
+    """ Stores the map and the compiled blocks when the cache does not have them all yet. Returns whether it wrote. """
+    blocks = dict(artifacts.blocks)
+    if compiler is not None:
+        new = {entry: block for entry, block in compiler.recorded.items() if blocks.get(entry) != block}
+        blocks.update(new)
+    else:
+        new = {}
+    if artifacts.rom_map is not None and not new:
+        return False
+    cache.store(rom, chip8.quirk_profile, rom_map, blocks)
+    return True
@@ -1,9 +1,60 @@
 
-from typing import List
+from array import array
+from functools import partial
+from typing import Callable, List, NamedTuple, Optional, Tuple
 import random
+import struct
+
+# 480 instructions per second at 60 frames per second
+INSTRUCTIONS_PER_FRAME = 8
+
+# Reasons for Chip8.run to return
+STOP_CYCLES = "cycles"
+STOP_FRAME = "frame"
+STOP_DRAW = "draw"
+STOP_UNTIL = "until"
+
+# Save state blob written by Chip8.snapshot(), big endian:
+#   magic, version, memory, 32 display rows, V0-VF, I, PC, opcode,
+#   delay timer, sound timer, sp, 16 stack entries, key mask,
+#   cycles, frames, frame_cycles, then the state of the RNG used by Cxkk:
+#   625 Mersenne Twister words, has gauss_next, gauss_next
+SNAPSHOT_MAGIC = b"CH8S"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_FORMAT = struct.Struct(">4sH4096s32Q16sIHHBBB16HHQQI625I?d")
+
+
+class Quirks(NamedTuple):
+    # 8XY6/8XYE shift VY and store the result in VX, instead of shifting VX
+    shift_vy: bool
+    # BNNN works as BXNN: jump to XNN + VX instead of NNN + V0
+    jump_vx: bool
+    # Where FX55/FX65 leave I: "unchanged", "x" (I += X) or "x+1" (I += X + 1)
+    load_store_index: str
+    # 8XY1/8XY2/8XY3 set VF to 0
+    vf_reset: bool
+
+
+# Behaviour of the interpreters of each era, chosen per machine at construction
+QUIRK_PROFILES = {
+    "cosmac-vip": Quirks(shift_vy=True, jump_vx=False, load_store_index="x+1", vf_reset=True),
+    "chip-48": Quirks(shift_vy=False, jump_vx=True, load_store_index="x", vf_reset=False),
+    "super-chip": Quirks(shift_vy=False, jump_vx=True, load_store_index="unchanged", vf_reset=False),
+    "modern": Quirks(shift_vy=False, jump_vx=False, load_store_index="unchanged", vf_reset=False),
+}
+DEFAULT_QUIRKS = "modern"
 
 class Chip8:
 
+    # Fixed instance layout, no per-instance __dict__
+    __slots__ = (
+        "opcode", "memory", "v", "i", "pc", "vram", "delay_timer", "sound_timer",
+        "stack", "sp", "keys", "paused", "instructions_per_frame", "cycles", "frames",
+        "frame_cycles", "draw_screen", "dirty_rows", "decoded", "write_listeners", "debug",
+        "rng", "quirk_profile", "quirks", "optable", "optable_0", "optable_8", "optable_e", "optable_f", "grouptable",
+        "effects", "fast_forward", "idle_pc", "idle_effects", "idle_signature", "idle_cycle", "skipped",
+    )
+
     fontset: bytearray = bytearray([
         0xF0, 0x90, 0x90, 0x90, 0xF0, # 0/ 0
         0x20, 0x60, 0x20, 0x20, 0x70, # 1/ 5
@@ -23,9 +74,21 @@ class Chip8:
         0xF0, 0x80, 0xF0, 0x80, 0x80  # F
     ])
 
+    # sprite_rows[x][line] is the 8 pixel sprite line drawn at column x, as a
+    # 64 bit display row (leftmost pixel in the high bit), wrapped around the right edge.
+    sprite_rows: List[List[int]] = [
+        [(((line << 56) >> x) | ((line << 56) << (64 - x))) & 0xFFFFFFFFFFFFFFFF for line in range(256)]
+        for x in range(64)
+    ]
+
+    blank_vram = memoryview(bytes(32 * 8)).cast('Q')
+    all_rows = 0xFFFFFFFF
+    stack_size = 16
+
     def initialize_optable(self):
+        # One handler per opcode class. Classes 0, 8, E and F hold several
+        # instructions and are resolved through the group tables below.
         self.optable = {
-            0x0000: self.opcode_group_0,
             0x1000: self.jump_to_address_nnn,
             0x2000: self.call_at_nnn,
             0x3000: self.skip_ins_vx_eq_nn,
@@ -33,22 +96,80 @@ class Chip8:
             0x5000: self.skip_ins_vx_eq_vy,
             0x6000: self.set_vx_to_nn,
             0x7000: self.add_nn_to_vx,
-            0x8000: self.opcode_group_8,
             0x9000: self.skip_ins_vx_neq_vy,
             0xA000: self.set_index_to_nnn,
             0xB000: self.jump_to_address_nnn_v0,
             0xC000: self.rnd_vx_nn,
             0xD000: self.draw_to_vram,
-            0xE000: self.opcode_group_e,
-            0xF000: self.opcode_group_f,
         }
+        self.optable_0 = {
+            0x00E0: self.clear_screen,
+            0x00EE: self.return_from_subroutine,
+            0x0000: self.halt,
+        }
+        self.optable_8 = {
+            0x0: self.set_vx_to_vy,
+            0x1: self.or_vx_vy,
+            0x2: self.and_vx_vy,
+            0x3: self.xor_vx_vy,
+            0x4: self.add_vy_to_vx,
+            0x5: self.sub_vy_from_vx,
+            0x6: self.shift_vx_right,
+            0x7: self.subn_vx_from_vy,
+            0xE: self.shift_vx_left,
+        }
+        self.optable_e = {
+            0x9E: self.skip_ins_key_vx_pressed,
+            0xA1: self.skip_ins_key_vx_not_pressed,
+        }
+        self.optable_f = {
+            0x07: self.set_vx_to_delay_timer,
+            0x0A: self.wait_for_key,
+            0x15: self.set_delay_timer_to_vx,
+            0x18: self.set_sound_timer_to_vx,
+            0x1E: self.add_vx_to_index,
+            0x29: self.set_index_to_font_vx,
+            0x33: self.store_bcd_vx,
+            0x55: self.store_v0_to_vx,
+            0x65: self.load_v0_to_vx,
+        }
+        # opcode class: (mask selecting the instruction, table)
+        self.grouptable = {
+            0x0000: (0xFFFF, self.optable_0),
+            0x8000: (0x000F, self.optable_8),
+            0xE000: (0x00FF, self.optable_e),
+            0xF000: (0x00FF, self.optable_f),
+        }
+
+        # The quirk profile picks specialized handlers once, the handlers
+        # themselves never check which profile is active.
+        quirks = self.quirks
+        if quirks.shift_vy:
+            self.optable_8[0x6] = self.shift_vy_right
+            self.optable_8[0xE] = self.shift_vy_left
+        if quirks.vf_reset:
+            self.optable_8[0x1] = self.or_vx_vy_reset_vf
+            self.optable_8[0x2] = self.and_vx_vy_reset_vf
+            self.optable_8[0x3] = self.xor_vx_vy_reset_vf
+        if quirks.jump_vx:
+            self.optable[0xB000] = self.jump_to_address_xnn_vx
+        if quirks.load_store_index == "x":
+            self.optable_f[0x55] = self.store_v0_to_vx_index_x
+            self.optable_f[0x65] = self.load_v0_to_vx_index_x
+        elif quirks.load_store_index == "x+1":
+            self.optable_f[0x55] = self.store_v0_to_vx_index_x1
+            self.optable_f[0x65] = self.load_v0_to_vx_index_x1
 
-    def __init__(self):
-        self.opcode: int
+    def __init__(self, seed: Optional[int] = None, quirks: str = DEFAULT_QUIRKS):
+        if quirks not in QUIRK_PROFILES:
+            raise Exception(f"Unknown quirk profile {quirks}, expected one of {', '.join(QUIRK_PROFILES)}")
+        self.quirk_profile = quirks
+        self.quirks = QUIRK_PROFILES[quirks]
+        self.opcode: int = 0
         self.memory = bytearray([0x00] * 4096)
 
-        # CPU Registers V0 - VF
-        self.v: List[int] = [0] * 16
+        # CPU Registers V0 - VF, one byte each
+        self.v = bytearray(16)
 
         # Index register
         self.i: int = 0x0
@@ -58,41 +179,61 @@ class Chip8:
         # 0x050-0x0A0 - Used for the built in 4x5 pixel font set (0-F)
         # 0x200-0xFFF - Program ROM and work RAM
 
-        # Screen is 64x32 pixels. Each pixel is one bit. but using a full int.
-        self.vram: List[int] = [0] * (64*32)
+        # Screen is 64x32 pixels, one bit each. Every row is packed in a
+        # 64 bit int with the leftmost pixel in the high bit.
+        self.vram = memoryview(bytearray(32 * 8)).cast('Q')
 
         # 1 byte
         self.delay_timer: int = 0x0
         # 1 byte
         self.sound_timer: int = 0x0
 
-        self.stack: List[int] = []
+        # Fixed size stack, sp is the number of return addresses on it
+        self.stack: List[int] = [0] * Chip8.stack_size
         self.sp: int = 0
-        self.keyboard = {
-            0x00: False,
-            0x01: False,
-            0x02: False,
-            0x03: False,
-            0x04: False,
-            0x05: False,
-            0x06: False,
-            0x07: False,
-            0x08: False,
-            0x09: False,
-            0x0A: False,
-            0x0B: False,
-            0x0C: False,
-            0x0D: False,
-            0x0E: False,
-            0x0F: False,
-        }
+        # Keypad state, bit k is set while key k is held
+        self.keys: int = 0
+
+        # Random numbers for Cxkk. Seeded, two machines draw the same sequence.
+        # Without a seed the sequence differs from run to run.
+        self.rng = random.Random(seed)
 
         self.paused = False
-        self.timers_interval = 1/60
-        self.last_ticks = 0
+        # Emulated time: instructions executed, 60Hz frames completed and
+        # instructions executed in the current frame. Kept by run().
+        self.instructions_per_frame = INSTRUCTIONS_PER_FRAME
+        self.cycles = 0
+        self.frames = 0
+        self.frame_cycles = 0
+
         self.draw_screen = False
-        self.load_fontset()
+        # Bit n is set when display row n changed since the last take_dirty_rows().
+        # Starts with every row set, nothing has been presented yet.
+        self.dirty_rows = Chip8.all_rows
+        # Decoded instruction cache, one entry per address: (opcode, handler)
+        # with the operands already bound. Entries are dropped when the bytes
+        # they were decoded from are written.
+        self.decoded: List[Optional[Tuple[int, Callable[[], None]]]] = [None] * 4096
+        # Counts what an instruction does outside the registers, timers and
+        # stack pointer: drawing, memory writes, random numbers. Together with
+        # those it tells idle_skip() whether a loop changed anything.
+        self.effects = 0
+        # Skip idle loops in run(), see idle_skip()
+        self.fast_forward = True
+        # Target of the last backward jump and effects then. Only a loop that
+        # keeps coming back to the same address without effects is worth
+        # comparing the whole state for.
+        self.idle_pc = -1
+        self.idle_effects = 0
+        self.idle_signature: Optional[tuple] = None
+        self.idle_cycle = 0
+        # Instructions skipped by fast forward so far, they are counted in cycles as well
+        self.skipped = 0
+        # Called with (start, end) whenever memory in [start, end) is written
+        # by the program or a loader, e.g. to drop compiled blocks.
+        self.write_listeners: List[Callable[[int, int], None]] = []
         self.initialize_optable()
+        self.load_fontset()
         self.debug = False
 
     def toggle_debug(self):
@@ -100,34 +241,260 @@ class Chip8:
 
     def reset(self):
         self.opcode = 0
-        self.v = [0] * 16
+        self.v[:] = bytes(16)
         self.i = 0x0
         self.pc: int = 0x200
         self.delay_timer = 0
         self.sound_timer = 0
-        self.stack = []
+        self.stack[:] = [0] * Chip8.stack_size
         self.sp = 0
         self.paused = False
+        self.cycles = 0
+        self.frames = 0
+        self.frame_cycles = 0
+        self.idle_signature = None
         self.load_fontset()
-        self.last_ticks = 0
+
+    def snapshot(self) -> bytes:
+        """ Captures the machine, emulated time and RNG state into a save state blob. """
+        rng_version, rng_words, gauss_next = self.rng.getstate()
+        return SNAPSHOT_FORMAT.pack(
+            SNAPSHOT_MAGIC, SNAPSHOT_VERSION, bytes(self.memory), *self.vram, bytes(self.v),
+            self.i, self.pc, self.opcode, self.delay_timer, self.sound_timer, self.sp, *self.stack,
+            self.keys, self.cycles, self.frames, self.frame_cycles,
+            *rng_words, gauss_next is not None, gauss_next or 0.0)
+
+    def restore(self, blob: bytes):
+        """ Puts the machine back in the state captured by snapshot().
+            Only the memory pages that differ are written, so decoded instructions
+            and compiled blocks survive restoring the same state many times.
+        """
+        if len(blob) != SNAPSHOT_FORMAT.size or blob[:4] != SNAPSHOT_MAGIC:
+            raise Exception("Not a CHIP-8 save state")
+        version = struct.unpack_from(">H", blob, 4)[0]
+        if version != SNAPSHOT_VERSION:
+            raise Exception(f"Unsupported save state version {version}, expected {SNAPSHOT_VERSION}")
+        fields = SNAPSHOT_FORMAT.unpack(blob)
+        memory = fields[2]
+        vram = fields[3:35]
+        v, i, pc, opcode, delay_timer, sound_timer, sp = fields[35:42]
+        stack = fields[42:58]
+        keys, cycles, frames, frame_cycles = fields[58:62]
+        rng_words = fields[62:687]
+        has_gauss, gauss_next = fields[687:]
+        if sp > Chip8.stack_size:
+            raise Exception(f"Corrupt save state: sp is {sp}")
+
+        for start in range(0, len(self.memory), 256):
+            end = start + 256
+            if self.memory[start:end] != memory[start:end]:
+                self.memory[start:end] = memory[start:end]
+                self.invalidate_decoded(start, end)
+        self.vram[:] = array('Q', vram)
+        self.v[:] = v
+        self.i = i
+        self.pc = pc
+        self.opcode = opcode
+        self.delay_timer = delay_timer
+        self.sound_timer = sound_timer
+        self.sp = sp
+        self.stack[:] = stack
+        self.keys = keys
+        self.cycles = cycles
+        self.frames = frames
+        self.frame_cycles = frame_cycles
+        self.rng.setstate((3, rng_words, gauss_next if has_gauss else None))
+        self.idle_signature = None
+        self.dirty_rows = Chip8.all_rows
+        self.draw_screen = True
+
+    def save_state(self, path: str):
+        with open(path, "wb") as out_file:
+            out_file.write(self.snapshot())
+
+    def load_state(self, path: str):
+        with open(path, "rb") as in_file:
+            self.restore(in_file.read())
+
+    def set_keys(self, mask: int):
+        """ Sets the state of all 16 keys at once, bit k of mask is key k. """
+        self.keys = mask & 0xFFFF
+        # A loop seen before may take another path with other keys
+        self.idle_signature = None
 
     def load_fontset(self):
         self.memory[0x00:len(Chip8.fontset)] = Chip8.fontset
+        self.invalidate_decoded(0x00, len(Chip8.fontset))
 
     def load_program_to_memory(self, program: bytearray):
         self.memory[0x200:0x200+len(program)] = program
+        self.invalidate_decoded(0x200, 0x200+len(program))
+
+    def invalidate_decoded(self, start: int, end: int):
+        """ Drops the decoded instructions that read any byte in [start, end).
+            An instruction at address a is decoded from a and a+1, so the entry
+            just before start is dropped as well.
+        """
+        self.effects += 1
+        for listener in self.write_listeners:
+            listener(start, end)
+        start = max(start - 1, 0)
+        end = min(end, len(self.decoded))
+        if start < end:
+            self.decoded[start:end] = [None] * (end - start)
 
-    def cycle(self, ticks):
-        # Fetch
-        self.opcode = self.memory[self.pc] << 8 | self.memory[self.pc+1]
+    def run(self, max_cycles: int, until=None) -> Tuple[str, int]:
+        """
+        Executes up to max_cycles instructions and returns (stop reason, instructions executed).
+        Every instructions_per_frame instructions the frame ends and the timers tick.
+
+        until selects an extra stop condition:
+            STOP_FRAME  stop at the end of the current frame
+            STOP_DRAW   stop right after an instruction that draws (DXYN, 00E0)
+            a callable  predicate(chip8) checked after every instruction, stops when true
+        The reason is STOP_CYCLES when the budget ran out first.
+
+        With fast_forward on, idle loops are skipped up to the end of the frame
+        or the budget, see idle_skip(). Not while a predicate is given, it
+        has to see every instruction.
+        """
+        if self.debug:
+            # Slow path, cycle() prints every instruction
+            return self._run_debug(max_cycles, until)
+
+        # Hot state is kept in locals and written back on exit
+        decoded = self.decoded
+        decode = self.decode
+        frame_length = self.instructions_per_frame
+        frame_cycles = self.frame_cycles
+        stop_frame = until == STOP_FRAME
+        stop_draw = until == STOP_DRAW
+        predicate = until if callable(until) else None
+        fast_forward = self.fast_forward and predicate is None
+        reason = STOP_CYCLES
+        executed = 0
+
+        while executed < max_cycles:
+            pc = self.pc
+            entry = decoded[pc]
+            if entry is None:
+                entry = decode(pc)
+            opcode = self.opcode = entry[0]
+            self.pc = pc + 2
+            entry[1]()
+            executed += 1
+
+            frame_cycles += 1
+            if fast_forward and self.pc <= pc:
+                # A backward jump or a wait, the program may be idling
+                if self.pc != self.idle_pc or self.effects != self.idle_effects:
+                    self.idle_pc = self.pc
+                    self.idle_effects = self.effects
+                else:
+                    available = frame_length - frame_cycles
+                    if max_cycles - executed < available:
+                        available = max_cycles - executed
+                    skip = self.idle_skip(self.cycles + executed, available)
+                    executed += skip
+                    frame_cycles += skip
+            if frame_cycles >= frame_length:
+                self.frame_cycles = frame_cycles = 0
+                self.end_frame()
+                if stop_frame:
+                    reason = STOP_FRAME
+                    break
+            if stop_draw and (opcode & 0xF000 == 0xD000 or opcode == 0x00E0):
+                reason = STOP_DRAW
+                break
+            if predicate is not None and predicate(self):
+                reason = STOP_UNTIL
+                break
+
+        self.frame_cycles = frame_cycles
+        self.cycles += executed
+        return reason, executed
+
+    def _run_debug(self, max_cycles: int, until=None) -> Tuple[str, int]:
+        executed = 0
+        while executed < max_cycles:
+            self.cycle()
+            executed += 1
+            self.cycles += 1
+            self.frame_cycles += 1
+            if self.frame_cycles >= self.instructions_per_frame:
+                self.frame_cycles = 0
+                self.end_frame()
+                if until == STOP_FRAME:
+                    return STOP_FRAME, executed
+            if until == STOP_DRAW and (self.opcode & 0xF000 == 0xD000 or self.opcode == 0x00E0):
+                return STOP_DRAW, executed
+            if callable(until) and until(self):
+                return STOP_UNTIL, executed
+        return STOP_CYCLES, executed
+
+    def idle_skip(self, cycle: int, available: int) -> int:
+        """
+        Called by the engines after an instruction that moved PC backwards or
+        kept it in place (loops, FX0A waiting, 0000) to the same address as
+        the one before, without effects since, cycle being the instruction
+        count after it. Returns how many instructions can be
+        skipped, up to available, and counts them in skipped.
+
+        When two such visits in a row find PC, V0-VF, I, the stack, the timers and
+        effects unchanged in the same frame with the same keys, everything in
+        between was a loop that changed nothing and depends only on that
+        state. Until the frame ends, or keys are set, every further pass is
+        the same, so whole passes are skipped and the engine runs the rest.
+        This covers polling the delay timer (FX07, 3xkk, 1nnn), FX0A and the
+        0000 halt. The machine after a skip is the same as if the passes had
+        run, at any cycle count a run can stop at.
+        """
+        signature = (self.pc, bytes(self.v), self.i, tuple(self.stack[:self.sp]), self.delay_timer,
+                     self.sound_timer, self.frames, self.effects)
+        if signature != self.idle_signature:
+            self.idle_signature = signature
+            self.idle_cycle = cycle
+            return 0
+        period = cycle - self.idle_cycle
+        skip = available - available % period
+        self.idle_cycle = cycle + skip
+        self.skipped += skip
+        return skip
+
+    def end_frame(self):
+        """ Ends an emulated 60Hz frame: the timers tick once. """
+        self.update_timers()
+        self.frames += 1
+
+    def cycle(self):
+        """ Executes a single instruction. Frames and timers are left to run() or the caller. """
+        # Fetch and decode, both cached per address
+        entry = self.decoded[self.pc]
+        if entry is None:
+            entry = self.decode(self.pc)
+        self.opcode, f = entry
         if self.debug:
             print(f"Opcode: {self.opcode:04x}")
         # increment PC
         self.pc += 2
 
-        # Decode
+        # Execute
+        f()
+
+    def decode(self, address: int) -> Tuple[int, Callable[[], None]]:
+        """ Decodes the instruction at address into (opcode, handler), where the
+            handler is specialized for the instruction and has its operands bound.
+            The result is stored in the decoded instruction cache.
+        """
+        opcode = self.memory[address] << 8 | self.memory[address+1]
+
         # Get the function to execute from opcode table
-        f = self.optable[self.opcode & 0xF000]
+        group = opcode & 0xF000
+        if group in self.grouptable:
+            mask, table = self.grouptable[group]
+            f = table.get(opcode & mask, self.unknown_opcode)
+        else:
+            f = self.optable[group]
         """
             X: The second nibble. Used to look up one of the 16 registers (VX) from V0 through VF.
             Y: The third nibble. Also used to look up one of the 16 registers (VY) from V0 through VF.
@@ -136,26 +503,22 @@ class Chip8:
             NNN: The second, third and fourth nibbles. A 12-bit immediate memory address.
         """
         # Get the second nibble
-        x = (self.opcode >> 8) & 0x0F
+        x = (opcode >> 8) & 0x0F
         # Get the third nibble
-        y = (self.opcode >> 4) & 0x0F
+        y = (opcode >> 4) & 0x0F
         # Get the fourth nibble
-        n = self.opcode & 0x000F
+        n = opcode & 0x000F
         # The second byte
-        nn = self.opcode & 0x00FF
+        nn = opcode & 0x00FF
         # The second, third and fourth nibbles
-        nnn = self.opcode & 0x0FFF
-
-        # Execute
-        f(x, y, n, nn, nnn)
+        nnn = opcode & 0x0FFF
 
-        # Update Timers
-        elapsed_ticks = ticks - self.last_ticks
-        if elapsed_ticks > self.timers_interval:
-            self.update_timers()
-        self.last_ticks = ticks
+        entry = (opcode, partial(f, x, y, n, nn, nnn))
+        self.decoded[address] = entry
+        return entry
 
     def update_timers(self):
+        """ Decrements the delay and sound timers, called once per emulated 60Hz frame. """
         if self.delay_timer > 0:
             self.delay_timer -= 1
         
@@ -167,42 +530,51 @@ class Chip8:
             print("NOPE!")
         return
 
-    def opcode_group_0(self, x, y, n, nn, nnn):
+    def unknown_opcode(self, x, y, n, nn, nnn):
         """
         0nnn - SYS addr
             Jump to a machine code routine at nnn.
             This instruction is only used on the old computers on which Chip-8 was originally implemented. It is ignored by modern interpreters.
+        Also used for any opcode that is not in the group tables.
+        """
+        print(f"Unknow opcode: {self.opcode:04x}")
+        self.effects += 1
 
+    def clear_screen(self, x, y, n, nn, nnn):
+        """
         00E0 - CLS
             Clear the display.
+        """
+        if self.debug:
+            print("Clearing the screen")
+        # Clear the screen
+        self.vram[:] = Chip8.blank_vram
+        self.dirty_rows = Chip8.all_rows
+        self.draw_screen = True
+        self.effects += 1
+        return
 
+    def return_from_subroutine(self, x, y, n, nn, nnn):
+        """
         00EE - RET
             Return from a subroutine.
             The interpreter sets the program counter to the address at the top of the stack, then subtracts 1 from the stack pointer.
-        
+        """
+        if self.debug:
+            print("return from subroutine")
+        if self.sp == 0:
+            raise Exception(f"Stack underflow: RET at {self.pc - 2:04x} with an empty stack")
+        self.sp -= 1
+        self.pc = self.stack[self.sp]
+        return
+
+    def halt(self, x, y, n, nn, nnn):
+        """
         0000 - HALT?
             Halts execution
         """
-        if self.opcode == 0x0E0:
-            if self.debug:
-                print("Clearing the screen")
-            # Clear the screen
-            self.vram = [0] * (64 * 32)
-            self.draw_screen = True
-            return
-
-        if self.opcode == 0x00EE:
-            if self.debug:
-                print("return from subroutine")
-            self.pc = self.stack.pop()
-            self.sp -= 1
-            return
-        
-        if self.opcode == 0x000:
-            self.pc -= 2
-            return
-        
-        print(f"Unknow opcode: {self.opcode:04x}")
+        self.pc -= 2
+        return
 
     def jump_to_address_nnn(self, x, y, n, nn, nnn):
         """
@@ -221,11 +593,12 @@ class Chip8:
             Call subroutine at nnn.
             The interpreter increments the stack pointer, then puts the current PC on the top of the stack. The PC is then set to nnn.
         """
+        if self.sp == Chip8.stack_size:
+            raise Exception(f"Stack overflow: CALL {nnn:03x} at {self.pc - 2:04x} with {self.sp} return addresses on the stack")
+        self.stack[self.sp] = self.pc
         self.sp += 1
-        self.stack.append(self.pc)
         self.pc = nnn
-        # // Stack size is 16 so we need to wrap
-        return 
+        return
 
     def skip_ins_vx_eq_nn(self, x, y, n, nn, nnn):
         """
@@ -282,94 +655,139 @@ class Chip8:
             print(f"v[{x}] = {self.v[x]:04x}")
         return
 
-    def opcode_group_8(self, x, y, n, nn, nnn):
+    def set_vx_to_vy(self, x, y, n, nn, nnn):
         """
         8xy0 - LD Vx, Vy
             Set Vx = Vy.
             Stores the value of register Vy in register Vx.
-        
+        """
+        self.v[x] = self.v[y]
+
+    def or_vx_vy(self, x, y, n, nn, nnn):
+        """
         8xy1 - OR Vx, Vy
             Set Vx = Vx OR Vy.
             Performs a bitwise OR on the values of Vx and Vy, then stores the result in Vx. 
-        
+        """
+        self.v[x] |= self.v[y]
+
+    def and_vx_vy(self, x, y, n, nn, nnn):
+        """
         8xy2 - AND Vx, Vy
             Set Vx = Vx AND Vy.
             Performs a bitwise AND on the values of Vx and Vy, then stores the result in Vx. 
-        
+        """
+        self.v[x] &= self.v[y]
+
+    def xor_vx_vy(self, x, y, n, nn, nnn):
+        """
         8xy3 - XOR Vx, Vy
             Set Vx = Vx XOR Vy.
             Performs a bitwise exclusive OR on the values of Vx and Vy, then stores the result in Vx.
-        
+        """
+        self.v[x] ^= self.v[y]
+
+    def or_vx_vy_reset_vf(self, x, y, n, nn, nnn):
+        """ 8xy1 - OR Vx, Vy (COSMAC VIP): VF is set to 0 afterwards. """
+        self.v[x] |= self.v[y]
+        self.v[0xF] = 0
+
+    def and_vx_vy_reset_vf(self, x, y, n, nn, nnn):
+        """ 8xy2 - AND Vx, Vy (COSMAC VIP): VF is set to 0 afterwards. """
+        self.v[x] &= self.v[y]
+        self.v[0xF] = 0
+
+    def xor_vx_vy_reset_vf(self, x, y, n, nn, nnn):
+        """ 8xy3 - XOR Vx, Vy (COSMAC VIP): VF is set to 0 afterwards. """
+        self.v[x] ^= self.v[y]
+        self.v[0xF] = 0
+
+    def add_vy_to_vx(self, x, y, n, nn, nnn):
+        """
         8xy4 - ADD Vx, Vy
             Set Vx = Vx + Vy, set VF = carry.
             The values of Vx and Vy are added together. 
             If the result is greater than 8 bits (i.e., > 255,) VF is set to 1, 
             otherwise 0. Only the lowest 8 bits of the result are kept, and stored in Vx.
-        
+        """
+        sum = self.v[x] + self.v[y]
+        self.v[x] = sum & 0xFF
+        if sum > 0xFF:
+            self.v[0xF] = 1
+        else:
+            self.v[0xF] = 0
+
+    def sub_vy_from_vx(self, x, y, n, nn, nnn):
+        """
         8xy5 - SUB Vx, Vy
             Set Vx = Vx - Vy, set VF = NOT borrow. 
             If Vx > Vy, then VF is set to 1, otherwise 0. 
             Then Vy is subtracted from Vx, and the results stored in Vx.
+        """
+        xval = self.v[x]
+        yval = self.v[y]
+        if xval > yval:
+            self.v[0xF] = 1
+        else:
+            self.v[0xF] = 0
+        self.v[x] = (self.v[x] - self.v[y]) & 0xFF
 
+    def shift_vx_right(self, x, y, n, nn, nnn):
+        """
         8xy6 - SHR Vx {, Vy}
             Set Vx = Vx SHR 1.
             If the least-significant bit of Vx is 1, then VF is set to 1, otherwise 0. 
             Then Vx is divided by 2.
+        """
+        # The COSMAC VIP shifts Vy instead, see shift_vy_right
+        self.v[0xF] = self.v[x] & 0x1
+        self.v[x] = (self.v[x] >> 1) & 0xFF
+
+    def shift_vy_right(self, x, y, n, nn, nnn):
+        """
+        8xy6 - SHR Vx, Vy (COSMAC VIP)
+            Set Vx = Vy SHR 1.
+            VF is set to the least-significant bit of Vy before the shift.
+        """
+        value = self.v[y]
+        self.v[0xF] = value & 0x1
+        self.v[x] = value >> 1
 
+    def subn_vx_from_vy(self, x, y, n, nn, nnn):
+        """
         8xy7 - SUBN Vx, Vy
             Set Vx = Vy - Vx, set VF = NOT borrow.
             If Vy > Vx, then VF is set to 1, otherwise 0. 
             Then Vx is subtracted from Vy, and the results stored in Vx.
+        """
+        xval = self.v[x]
+        yval = self.v[y]
+        if yval > xval:
+            self.v[0xF] = 1
+        else:
+            self.v[0xF] = 0
+        self.v[x] = (self.v[y] - self.v[x]) & 0xFF
 
+    def shift_vx_left(self, x, y, n, nn, nnn):
+        """
         8xyE - SHL Vx {, Vy}
             Set Vx = Vx SHL 1.
             If the most-significant bit of Vx is 1, then VF is set to 1, 
             otherwise to 0. Then Vx is multiplied by 2.
         """
-        if n == 0x0:
-            self.v[x] = self.v[y]
-        elif n == 0x1:
-            self.v[x] |= self.v[y]
-        elif n == 0x2:
-            self.v[x] &= self.v[y]
-        elif n == 0x3:
-            self.v[x] ^= self.v[y]
-        elif n == 0x4:
-            sum = self.v[x] + self.v[y]
-            self.v[x] = sum & 0xFF
-            if sum > 0xFF:
-                self.v[0xF] = 1
-            else:
-                self.v[0xF] = 0
-        elif n == 0x5:
-            xval = self.v[x]
-            yval = self.v[y]
-            if xval > yval:
-                self.v[0xF] = 1
-            else:
-                self.v[0xF] = 0
-            self.v[x] = (self.v[x] - self.v[y]) & 0xFF
-        elif n == 0x6:
-            #quirk
-            # self.v[x] = self.v[y]
-            self.v[0xF] = self.v[x] & 0x1
-            self.v[x] = (self.v[x] >> 1) & 0xFF
-        elif n == 0x7:
-            xval = self.v[x]
-            yval = self.v[y]
-            if yval > xval:
-                self.v[0xF] = 1
-            else:
-                self.v[0xF] = 0
-            self.v[x] = (self.v[y] - self.v[x]) & 0xFF
-        elif n == 0xE:
-            #quirk
-            # self.v[x] = self.v[y]
-            self.v[0xF] = self.v[x] >> 7
-            self.v[x] = (self.v[x] << 1) & 0xFF
-        else:
-            print(f"Unknow opcode: {self.opcode:04x}")
+        # The COSMAC VIP shifts Vy instead, see shift_vy_left
+        self.v[0xF] = self.v[x] >> 7
+        self.v[x] = (self.v[x] << 1) & 0xFF
 
+    def shift_vy_left(self, x, y, n, nn, nnn):
+        """
+        8xyE - SHL Vx, Vy (COSMAC VIP)
+            Set Vx = Vy SHL 1.
+            VF is set to the most-significant bit of Vy before the shift.
+        """
+        value = self.v[y]
+        self.v[0xF] = value >> 7
+        self.v[x] = (value << 1) & 0xFF
 
     def skip_ins_vx_neq_vy(self, x, y, n, nn, nnn):
         """
@@ -408,6 +826,16 @@ class Chip8:
             print(f"pc = {self.pc:04x}")
         return
 
+    def jump_to_address_xnn_vx(self, x, y, n, nn, nnn):
+        """
+        BXNN - JP Vx, addr (CHIP-48, SUPER-CHIP)
+            Jump to location xnn + Vx.
+        """
+        self.pc = nnn + self.v[x]
+        if self.debug:
+            print(f"pc = {self.pc:04x}")
+        return
+
     def rnd_vx_nn(self, x, y, n, nn, nnn):
         """ 
         Cxkk - RND Vx, byte
@@ -417,7 +845,8 @@ class Chip8:
             The results are stored in Vx. 
             See instruction 8xy2 for more information on AND.
         """
-        self.v[x] = int(random.random()*255) & nn
+        self.v[x] = int(self.rng.random()*255) & nn
+        self.effects += 1
         return
 
     def draw_to_vram(self, x, y, n, nn, nnn):
@@ -434,107 +863,170 @@ class Chip8:
             and to 0 if that doesn’t happen 
         """
         self.v[0xF] = 0
-        sprite_x_pos = self.v[x]
-        sprite_y_pos = self.v[y]
+        # Every sprite line becomes one 64 bit row already shifted to Vx
+        rows = Chip8.sprite_rows[self.v[x] % 64]
+        row_index = self.v[y] % 32
+        memory = self.memory
+        vram = self.vram
+        collision = 0
+        dirty = 0
 
-        for y_offset in range(n):
+        for address in range(self.i, self.i + n):
             # Get the sprite line from memory
-            sprite_line = self.memory[self.i + y_offset]
-            for x_offset in range(8):
-                pixel_index = ((sprite_x_pos+x_offset)%64) + (((sprite_y_pos+y_offset)%32)*64)
-                pixel_value = sprite_line & (0x080 >> x_offset)
-                # XOR
-                if pixel_value:
-                    if self.vram[pixel_index]:
-                        self.v[0xF] = 1 
-                    self.vram[pixel_index] ^= 0xFFFFFF
-                    
-        
+            sprite_row = rows[memory[address]]
+            if sprite_row:
+                pixels = vram[row_index]
+                # XOR, any bit set in both is a pixel that gets unset
+                if pixels & sprite_row:
+                    collision = 1
+                vram[row_index] = pixels ^ sprite_row
+                dirty |= 1 << row_index
+            row_index = (row_index + 1) % 32
+
+        if collision:
+            self.v[0xF] = 1
+        self.dirty_rows |= dirty
         self.draw_screen = True
+        self.effects += 1
         return
 
-    def opcode_group_e(self, x, y, n, nn, nnn):
+    def skip_ins_key_vx_pressed(self, x, y, n, nn, nnn):
         """
             Ex9E - SKP Vx
                 Skip next instruction if key with the value of Vx is pressed.
                 Checks the keyboard, and if the key corresponding to the value of Vx is currently in the down position, PC is increased by 2.
+        """
+        if self.keys >> (self.v[x] & 0xF) & 1:
+            self.pc += 2
+
+    def skip_ins_key_vx_not_pressed(self, x, y, n, nn, nnn):
+        """
             ExA1 - SKNP Vx
                 Skip next instruction if key with the value of Vx is not pressed.
                 Checks the keyboard, and if the key corresponding to the value of Vx is currently in the up position, PC is increased by 2.
         """
-        key = self.v[x]
-        if nn == 0x9E:
-            if self.keyboard[key]:
-                self.pc += 2
-        if nn == 0xA1:
-            if not self.keyboard[key]:
-                self.pc += 2
-        else:
-            print(f"Unknow opcode: {self.opcode:04x}")
+        if not self.keys >> (self.v[x] & 0xF) & 1:
+            self.pc += 2
 
-    def opcode_group_f(self, x, y, n, nn, nnn):
+    def set_vx_to_delay_timer(self, x, y, n, nn, nnn):
+        """ FX07 sets VX to the current value of the delay timer """
+        self.v[x] = self.delay_timer
+
+    def set_delay_timer_to_vx(self, x, y, n, nn, nnn):
+        """ FX15 sets the delay timer to the value in VX """
+        self.delay_timer = self.v[x]
+
+    def set_sound_timer_to_vx(self, x, y, n, nn, nnn):
+        """ FX18 sets the sound timer to the value in VX """
+        self.sound_timer = self.v[x]
+
+    def add_vx_to_index(self, x, y, n, nn, nnn):
         """ 
-            FX07 sets VX to the current value of the delay timer
-            FX15 sets the delay timer to the value in VX
-            FX18 sets the sound timer to the value in VX
             FX1E: Add to index
                 The index register I will get the value in VX added to it.
+        """
+        self.i = self.i + self.v[x]
+
+    def wait_for_key(self, x, y, n, nn, nnn):
+        """ 
             FX0A: Get key
+                Blocks by re-executing itself until a key is pressed.
+                With several keys held the lowest one is stored in VX.
+        """
+        keys = self.keys
+        if keys:
+            self.v[x] = (keys & -keys).bit_length() - 1
+        else:
+            self.pc -= 2
+
+    def set_index_to_font_vx(self, x, y, n, nn, nnn):
+        """ 
             FX29: Font character
                 Fx29 - LD F, Vx
                 Set I = location of sprite for digit Vx.
                 The value of I is set to the location for the hexadecimal sprite corresponding to the value of Vx
+        """
+        self.i = self.v[x] * 0x5
+
+    def store_bcd_vx(self, x, y, n, nn, nnn):
+        """ 
             Fx33 - LD B, Vx
                 Store BCD representation of Vx in memory locations I, I+1, and I+2.
                 The interpreter takes the decimal value of Vx, and places the hundreds digit in memory at location in I, the tens digit at location I+1, and the ones digit at location I+2.
         """
-        if nn == 0x07:
-            self.v[x] = self.delay_timer
-        elif nn == 0x15:
-            self.delay_timer = self.v[x]
-        elif nn == 0x18:
-            self.sound_timer = self.v[x]
-        elif nn == 0x1E:
-            self.i = self.i + self.v[x]
-        elif nn == 0x0A:
-            self.pc -= 2
-            for key in self.keyboard.keys():
-                if self.keyboard[key]:
-                    self.v[x] = key
-                    self.pc += 2
-        elif nn == 0x29:
-            self.i = self.v[x] * 0x5
-        elif nn == 0x33:
-            self.memory[self.i] = int((self.v[x]) / 100)
-            self.memory[self.i+1] = int(((self.v[x]) / 10) % 10)
-            self.memory[self.i+2] = int((self.v[x] % 100) % 10)
-        elif nn == 0x55:
-            addr = self.i
-            for index in range(x+1):
-                self.memory[addr] = self.v[index]
-                addr += 1
-        elif nn == 0x65:
-            addr = self.i
-            for index in range(x+1):
-                self.v[index] = self.memory[addr]
-                addr += 1
-        else:
-            print(f"Unknow opcode: {self.opcode:04x}")
-        return
+        self.memory[self.i] = int((self.v[x]) / 100)
+        self.memory[self.i+1] = int(((self.v[x]) / 10) % 10)
+        self.memory[self.i+2] = int((self.v[x] % 100) % 10)
+        self.invalidate_decoded(self.i, self.i+3)
+
+    def store_v0_to_vx(self, x, y, n, nn, nnn):
+        """ 
+            Fx55 - LD [I], Vx
+                Store registers V0 through Vx in memory starting at location I.
+        """
+        addr = self.i
+        for index in range(x+1):
+            self.memory[addr] = self.v[index]
+            addr += 1
+        self.invalidate_decoded(self.i, addr)
+
+    def load_v0_to_vx(self, x, y, n, nn, nnn):
+        """ 
+            Fx65 - LD Vx, [I]
+                Read registers V0 through Vx from memory starting at location I.
+        """
+        addr = self.i
+        for index in range(x+1):
+            self.v[index] = self.memory[addr]
+            addr += 1
+
+    def store_v0_to_vx_index_x(self, x, y, n, nn, nnn):
+        """ Fx55 (CHIP-48): as store_v0_to_vx, then I is increased by X. """
+        self.store_v0_to_vx(x, y, n, nn, nnn)
+        self.i += x
+
+    def load_v0_to_vx_index_x(self, x, y, n, nn, nnn):
+        """ Fx65 (CHIP-48): as load_v0_to_vx, then I is increased by X. """
+        self.load_v0_to_vx(x, y, n, nn, nnn)
+        self.i += x
+
+    def store_v0_to_vx_index_x1(self, x, y, n, nn, nnn):
+        """ Fx55 (COSMAC VIP): as store_v0_to_vx, then I is left past the last register, I += X + 1. """
+        self.store_v0_to_vx(x, y, n, nn, nnn)
+        self.i += x + 1
+
+    def load_v0_to_vx_index_x1(self, x, y, n, nn, nnn):
+        """ Fx65 (COSMAC VIP): as load_v0_to_vx, then I is left past the last register, I += X + 1. """
+        self.load_v0_to_vx(x, y, n, nn, nnn)
+        self.i += x + 1
 
     def dump_memory(self):
         Chip8._dump_mem(self.memory)
 
     def dump_vram(self):
-        Chip8._dump_mem(self.vram)
+        Chip8._dump_mem(self.packed_vram())
+
+    def take_dirty_rows(self) -> int:
+        """ Returns the mask of display rows changed since the last call and clears it. """
+        dirty = self.dirty_rows
+        self.dirty_rows = 0
+        return dirty
+
+    def packed_vram(self) -> bytes:
+        """ The display as 256 bytes, 8 per row, leftmost pixel in the high bit of the first byte. """
+        return struct.pack(">32Q", *self.vram)
+
+    @property
+    def vram_pixels(self) -> List[int]:
+        """ Compatibility view of the display, one int per pixel: 0xFFFFFF if set, otherwise 0. """
+        pixels = []
+        for row in self.vram:
+            pixels.extend(0xFFFFFF if row >> (63 - x) & 1 else 0 for x in range(64))
+        return pixels
 
     def draw_vram(self):
-        for y in range(32):
-            for x in range(64):
-                pixel_index = x + (y*64)
-                pixel_value = "██" if self.vram[pixel_index] else "  "
-                print(f"{pixel_value}", end='')
-            print('')
+        for row in self.vram:
+            print(''.join("██" if row >> (63 - x) & 1 else "  " for x in range(64)))
         self.draw_screen = False
 
 
@@ -0,0 +1,648 @@
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+import marshal
+
+from chip8_interpreter.chip8 import STOP_CYCLES, STOP_DRAW, STOP_FRAME, STOP_UNTIL, Chip8
+
+# Generated blocks are called as block(c, budget, stop_draw) and return the
+# number of instructions they executed. Only loops use the budget, they run
+# passes while the executed instructions stay within it. With stop_draw the
+# block exits right after a DXYN or 00E0.
+Block = Callable[[Chip8, int, bool], int]
+# (start, end) of the memory runs a block was compiled from, the first one starts at its entry
+Ranges = Tuple[Tuple[int, int], ...]
+# (block, end of the first of its ranges, instructions in one pass, its ranges)
+CompiledBlock = Tuple[Block, int, int, Ranges]
+
+# Stands for the register writeback in generated code until the block is complete
+WRITEBACK = "<writeback>"
+
+
+def catch_up(c: Chip8, executed: int):
+    """
+    Ends the frames that ended before the instruction a running block is at,
+    executed instructions after its start. Blocks run through the ends of
+    frames and call this before they use a timer, run() ends the rest after
+    the block. c.frame_cycles, the frame position at the start of the block,
+    goes down by a frame for every frame ended.
+    """
+    while c.frame_cycles + executed >= c.instructions_per_frame:
+        c.frame_cycles -= c.instructions_per_frame
+        c.end_frame()
+
+
+def draw_sprite(c: Chip8, x: int, y: int, i: int, n: int) -> int:
+    """ DXYN for blocks, with Vx, Vy and I passed in. Same steps as Chip8.draw_to_vram, returns VF. """
+    lines = c.memory[i:i + n]
+    if len(lines) < n:
+        raise IndexError("bytearray index out of range")
+    rows = Chip8.sprite_rows[x % 64]
+    row_index = y % 32
+    vram = c.vram
+    collision = 0
+    dirty = 0
+    for line in lines:
+        if line:
+            sprite_row = rows[line]
+            pixels = vram[row_index]
+            if pixels & sprite_row:
+                collision = 1
+            vram[row_index] = pixels ^ sprite_row
+            dirty |= 1 << row_index
+        row_index = (row_index + 1) & 31
+    c.dirty_rows |= dirty
+    c.draw_screen = True
+    c.effects += 1
+    return collision
+
+
+def block_globals() -> dict:
+    """ What every generated block refers to, handlers of single instructions are added per block. """
+    return {"catch_up": catch_up, "draw_sprite": draw_sprite}
+
+
+def ranges_of(entry: int, addresses) -> Ranges:
+    """ The memory runs covered by the instructions at addresses, the run of entry first. """
+    runs: List[List[int]] = []
+    for address in sorted(set(addresses)):
+        if runs and address <= runs[-1][1]:
+            runs[-1][1] = max(runs[-1][1], address + 2)
+        else:
+            runs.append([address, address + 2])
+    runs.sort(key=lambda run: not run[0] <= entry < run[1])
+    return tuple((start, end) for start, end in runs)
+
+
+class CachedBlock(NamedTuple):
+    """ A compiled block in a form that can be stored, e.g. by an ArtifactCache. """
+    # The memory runs the block was compiled from
+    ranges: Ranges
+    # Instructions in one pass
+    length: int
+    # Their bytes, the block is only used while memory holds the same bytes
+    source: bytes
+    # The marshalled code object that defines block()
+    code: bytes
+    # Addresses of the instructions the block hands to interpreter handlers
+    handlers: Tuple[int, ...]
+
+
+class BlockCompiler:
+    """
+    Optional execution engine that translates straight-line runs of CHIP-8
+    instructions into Python functions.
+
+    A block starts at a PC and runs until the first instruction that changes
+    control flow in a way not known when compiling (skips, Bnnn, RET from a
+    call made before the block) or halts (0000). Jumps to code not in the
+    block yet and calls are followed, so a block covers several runs of
+    memory. Draws (DXYN, 00E0) are inlined, with an exit after them that is
+    only taken for STOP_DRAW, FX0A with an exit taken while no key is held,
+    stores (FX33, FX55) with one taken when they wrote to compiled code. A
+    skip over a
+    single straight line instruction becomes an if and the block goes on, a
+    skip over a jump, call, RET, wait or store an exit taken unless it skips.
+    A block that jumps back to its own entry is a loop, it runs as many
+    passes as fit in the budget it is called with, one that only jumps to
+    itself takes them all at once. Blocks run through the ends of frames,
+    timer instructions first end the frames that ended before them.
+    Registers and I live in locals inside the block and are written back
+    when it exits. Blocks are cached by entry PC and dropped when memory
+    they were compiled from is written.
+
+    step() has the same effect as calling Chip8.cycle() once for
+    every instruction in one pass of the block. Generated code prints no
+    debug output, run() hands over to the interpreter while debug is on.
+    """
+
+    # Upper bound on the number of instructions in one block
+    max_block_length = 64
+    # Visits of an entry, or of a prefix length at it, before it is compiled.
+    # Code that runs once is interpreted, compiling it costs more. Where a
+    # run or frame ends in a block varies, most prefixes are rare.
+    hot_visits = 2
+    hot_prefix_visits = 8
+
+    # Locals used for V0 - VF inside generated code
+    regnames = [f"v{index:x}" for index in range(16)]
+
+    def __init__(self, chip8: Chip8):
+        self.chip8 = chip8
+        self.blocks: Dict[int, CompiledBlock] = {}
+        # Blocks cut short to fit the rest of a run or frame, by entry PC and length
+        self.prefixes: Dict[Tuple[int, int], CompiledBlock] = {}
+        # Visits of entries and prefixes that are not compiled yet
+        self.visits: Dict[int, int] = {}
+        self.prefix_visits: Dict[Tuple[int, int], int] = {}
+        # One byte per memory address, set when some compiled block covers it
+        self.code_map = bytearray(4096)
+        # Blocks compiled by an earlier process, used instead of translating
+        # again while memory still holds the bytes they were compiled from
+        self.cached: Dict[int, CachedBlock] = {}
+        # With record_blocks set every block translated here is kept in recorded, to be cached
+        self.record_blocks = False
+        self.recorded: Dict[int, CachedBlock] = {}
+        chip8.write_listeners.append(self.invalidate)
+
+    def invalidate(self, start: int, end: int):
+        """ Drops every block compiled from a byte in [start, end). """
+        if not any(self.code_map[start:end]):
+            return
+        for blocks in (self.blocks, self.prefixes):
+            for key in [key for key, block in blocks.items()
+                        if any(low < end and start < high for low, high in block[3])]:
+                del blocks[key]
+
+    def clear(self):
+        self.blocks.clear()
+        self.prefixes.clear()
+        self.visits.clear()
+        self.prefix_visits.clear()
+        self.code_map[:] = bytes(len(self.code_map))
+
+    def step(self) -> int:
+        """ Runs one pass of the block at the current PC and returns the number of instructions executed. """
+        c = self.chip8
+        block = self.blocks.get(c.pc)
+        if block is None:
+            block = self.compile(c.pc)
+        return block[0](c, block[2], False)
+
+    def run(self, max_cycles: int, until=None) -> Tuple[str, int]:
+        """
+        Same contract as Chip8.run: executes up to max_cycles instructions,
+        ending frames on the way, and returns (stop reason, instructions executed).
+        Blocks run through the ends of frames, ticking the timers when they
+        use them, and the frames they ran past are ended after them. With
+        STOP_FRAME or a predicate they stay within the frame. A block longer
+        than the budget runs as prefixes compiled to fewer instructions.
+        Chip8.run interprets entries until they were visited hot_visits
+        times and prefixes until hot_prefix_visits times. STOP_DRAW and
+        predicates are checked at the end of each block, loops run a single
+        pass per block while a predicate is given.
+        """
+        c = self.chip8
+        if c.debug:
+            return c.run(max_cycles, until)
+        blocks = self.blocks
+        frame_length = c.instructions_per_frame
+        frame_cycles = c.frame_cycles
+        stop_frame = until == STOP_FRAME
+        stop_draw = until == STOP_DRAW
+        predicate = until if callable(until) else None
+        within_frame = stop_frame or predicate is not None
+        fast_forward = c.fast_forward and predicate is None
+        reason = STOP_CYCLES
+        executed = 0
+
+        while executed < max_cycles:
+            budget = max_cycles - executed
+            if within_frame and frame_length - frame_cycles < budget:
+                budget = frame_length - frame_cycles
+            pc = c.pc
+            block = blocks.get(pc)
+            if block is None or block[2] > budget:
+                block = self.lookup(pc, budget)
+                if block is None:
+                    # Cold code: one instruction, or the rest of the run for a prefix
+                    c.frame_cycles = frame_cycles
+                    reason, count = c.run(budget if pc in blocks else 1, until)
+                    frame_cycles = c.frame_cycles
+                    executed += count
+                    if reason != STOP_CYCLES:
+                        break
+                    continue
+
+            c.frame_cycles = frame_cycles
+            if predicate is not None:
+                passes = block[2]
+            elif fast_forward and block[2] > 1 and c.idle_pc == pc and c.idle_effects == c.effects:
+                # The last block ended here without effects, a loop may be
+                # idling: single passes until idle_skip can tell, unless the
+                # frame ends within a few passes anyway. A jump to itself is
+                # idle anyway and takes the whole budget at once.
+                passes = frame_length - frame_cycles
+                if passes > 4 * block[2]:
+                    passes = block[2]
+                elif passes > budget:
+                    passes = budget
+            else:
+                passes = budget
+            count = block[0](c, passes, stop_draw)
+            executed += count
+            # Kept current for Chip8.run and idle_skip, which count from it
+            c.cycles += count
+            # The block may have ended frames with catch_up
+            frame_cycles = c.frame_cycles + count
+            if fast_forward and c.pc <= pc and frame_cycles < frame_length:
+                # Same idle loop detection as Chip8.run, at the end of blocks
+                # within the frame, a skip cannot get past its end anyway
+                if c.pc != c.idle_pc or c.effects != c.idle_effects:
+                    c.idle_pc = c.pc
+                    c.idle_effects = c.effects
+                else:
+                    available = frame_length - frame_cycles
+                    if max_cycles - executed < available:
+                        available = max_cycles - executed
+                    if available > 0:
+                        skip = c.idle_skip(c.cycles, available)
+                        executed += skip
+                        c.cycles += skip
+                        frame_cycles += skip
+            if frame_cycles >= frame_length:
+                # Ends the frames the block ran to or past
+                while frame_cycles >= frame_length:
+                    frame_cycles -= frame_length
+                    c.end_frame()
+                if stop_frame:
+                    reason = STOP_FRAME
+                    break
+            if stop_draw and (c.opcode & 0xF000 == 0xD000 or c.opcode == 0x00E0):
+                reason = STOP_DRAW
+                break
+            if predicate is not None and predicate(c):
+                reason = STOP_UNTIL
+                break
+
+        c.frame_cycles = frame_cycles
+        return reason, executed
+
+    def lookup(self, pc: int, budget: int) -> Optional[CompiledBlock]:
+        """
+        The block to run at pc within budget instructions when the block
+        there is not compiled yet or is too long, None while it is cold.
+        """
+        block = self.blocks.get(pc)
+        if block is None:
+            seen = self.visits.get(pc, 0) + 1
+            if seen < self.hot_visits and pc not in self.cached:
+                self.visits[pc] = seen
+                return None
+            block = self.compile(pc)
+        if block[2] <= budget:
+            return block
+        # Prefixes are a power of two long, so there are few of them, the
+        # next ones run the rest of the budget
+        length = 1 << (budget.bit_length() - 1)
+        block = self.prefixes.get((pc, length))
+        if block is None:
+            seen = self.prefix_visits.get((pc, length), 0) + 1
+            if seen < self.hot_prefix_visits:
+                self.prefix_visits[(pc, length)] = seen
+                return None
+            block = self.compile(pc, length)
+        return block
+
+    def compile(self, entry: int, limit: Optional[int] = None) -> CompiledBlock:
+        """ Compiles the block at entry, or with limit its first limit instructions as a prefix. """
+        c = self.chip8
+        memory = c.memory
+        cached = self.cached.get(entry) if limit is None else None
+        if cached is not None and b"".join(memory[start:end] for start, end in cached.ranges) == cached.source:
+            code = marshal.loads(cached.code)
+            namespace = block_globals()
+            namespace.update((f"h_{address:03x}", (c.decoded[address] or c.decode(address))[1])
+                             for address in cached.handlers)
+            ranges, length = cached.ranges, cached.length
+        else:
+            source, namespace, ranges, length = self.translate(entry, limit)
+            code = compile(source, f"<chip8 block {entry:03x}>", "exec")
+            if self.record_blocks and limit is None:
+                handlers = tuple(int(name[2:], 16) for name in namespace if name.startswith("h_"))
+                self.recorded[entry] = CachedBlock(ranges, length, b"".join(memory[start:end] for start, end in ranges),
+                                                   marshal.dumps(code), handlers)
+        namespace["CM"] = self.code_map
+        exec(code, namespace)
+        block = (namespace["block"], ranges[0][1], length, ranges)
+        if limit is None:
+            self.blocks[entry] = block
+            self.visits.pop(entry, None)
+        else:
+            self.prefixes[(entry, limit)] = block
+            self.prefix_visits.pop((entry, limit), None)
+        for start, end in ranges:
+            self.code_map[start:end] = b"\x01" * (end - start)
+        return block
+
+    def translate(self, entry: int, limit: Optional[int] = None) -> Tuple[str, dict, Ranges, int]:
+        """
+        Generates the source of the block starting at entry, at most limit
+        instructions long (max_block_length by default). Jumps to code not
+        in the block yet and calls are followed, and so are the returns of
+        the calls followed.
+        Returns (source, globals for the block, its ranges, instructions in one pass).
+        """
+        c = self.chip8
+        memory = c.memory
+        quirks = c.quirks
+        if limit is None:
+            limit = self.max_block_length
+        namespace = block_globals()
+        # Lines without the indentation of the function body. Exits write the
+        # registers back where WRITEBACK stands, once all writes are known.
+        body: List[str] = []
+        # registers read or written in the block
+        used = set()
+        written = set()
+        # I is kept in a local once an instruction assigns it
+        index_written = False
+        address = entry
+        # Addresses of the instructions in the block, in order
+        addresses: List[int] = []
+        # Return addresses of the calls followed, innermost last
+        returns: List[int] = []
+        count = 0
+        opcode = 0
+        # Opcode of the jump back to entry that makes the block a loop, if any
+        loop_opcode = None
+        terminated = False
+
+        def reg(index):
+            used.add(index)
+            return self.regnames[index]
+
+        def wreg(index):
+            written.add(index)
+            return reg(index)
+
+        def indent(lines):
+            return ["    " + line for line in lines]
+
+        def exit_lines(pc, opcode, executed):
+            # n counts the instructions of earlier loop passes and skipped ones
+            return [WRITEBACK, f"c.pc = {pc}", f"c.opcode = {opcode:#06x}",
+                    f"return n + {executed}" if executed else "return n"]
+
+        def ticked(position):
+            # The timers as they are before the instruction at position in the pass
+            return [f"if c.frame_cycles + n + {position} >= c.instructions_per_frame:",
+                    f"    catch_up(c, n + {position})"]
+
+        def straight(opcode, position):
+            """ Lines of an instruction that does not end a block, at position in the pass, None for the others. """
+            nonlocal index_written
+            x = (opcode >> 8) & 0x0F
+            y = (opcode >> 4) & 0x0F
+            n = opcode & 0x000F
+            nn = opcode & 0x00FF
+            nnn = opcode & 0x0FFF
+            group = opcode & 0xF000
+            if group == 0x6000:
+                return [f"{wreg(x)} = {nn:#04x}"]
+            if group == 0x7000:
+                return [f"{wreg(x)} = ({reg(x)} + {nn:#04x}) & 0xFF"]
+            if group == 0x8000 and n in (0x0, 0x1, 0x2, 0x3, 0x4, 0x5, 0x6, 0x7, 0xE):
+                vx, vy = wreg(x), reg(y)
+                vf = wreg(0xF) if n > 0x3 or quirks.vf_reset else None
+                # Same statement order as the interpreter handlers, so VF aliasing behaves the same
+                lines = {
+                    0x0: [f"{vx} = {vy}"],
+                    0x1: [f"{vx} |= {vy}"],
+                    0x2: [f"{vx} &= {vy}"],
+                    0x3: [f"{vx} ^= {vy}"],
+                    0x4: [f"t = {vx} + {vy}", f"{vx} = t & 0xFF", f"{vf} = 1 if t > 0xFF else 0"],
+                    0x5: [f"{vf} = 1 if {vx} > {vy} else 0", f"{vx} = ({vx} - {vy}) & 0xFF"],
+                    0x6: [f"{vf} = {vx} & 0x1", f"{vx} = ({vx} >> 1) & 0xFF"],
+                    0x7: [f"{vf} = 1 if {vy} > {vx} else 0", f"{vx} = ({vy} - {vx}) & 0xFF"],
+                    0xE: [f"{vf} = {vx} >> 7", f"{vx} = ({vx} << 1) & 0xFF"],
+                }[n]
+                # Same specialized behaviour as the handlers picked by the quirk profile
+                if quirks.vf_reset and n in (0x1, 0x2, 0x3):
+                    lines = lines + [f"{vf} = 0"]
+                elif quirks.shift_vy and n == 0x6:
+                    lines = [f"t = {vy}", f"{vf} = t & 0x1", f"{vx} = t >> 1"]
+                elif quirks.shift_vy and n == 0xE:
+                    lines = [f"t = {vy}", f"{vf} = t >> 7", f"{vx} = (t << 1) & 0xFF"]
+                return lines
+            if group == 0xA000:
+                index_written = True
+                return [f"i = {nnn:#05x}"]
+            if group == 0xC000:
+                return [f"{wreg(x)} = int(c.rng.random()*255) & {nn:#04x}", "c.effects += 1"]
+            if group == 0xF000 and nn == 0x07:
+                return ticked(position) + [f"{wreg(x)} = c.delay_timer"]
+            if group == 0xF000 and nn == 0x15:
+                return ticked(position) + [f"c.delay_timer = {reg(x)}"]
+            if group == 0xF000 and nn == 0x18:
+                return ticked(position) + [f"c.sound_timer = {reg(x)}"]
+            if group == 0xF000 and nn == 0x1E:
+                index_written = True
+                return [f"i = i + {reg(x)}"]
+            if group == 0xF000 and nn == 0x29:
+                index_written = True
+                return [f"i = {reg(x)} * 0x5"]
+            if group == 0xF000 and nn == 0x65:
+                lines = [f"{wreg(index)} = M[i + {index}]" for index in range(x+1)]
+                if quirks.load_store_index != "unchanged":
+                    lines.append(f"i = i + {x + 1 if quirks.load_store_index == 'x+1' else x}")
+                    index_written = True
+                return lines
+            return None
+
+        def draw(opcode):
+            """ 00E0 or DXYN, the same steps as the interpreter handlers. """
+            if opcode == 0x00E0:
+                return ["c.vram[:] = c.blank_vram", "c.dirty_rows = c.all_rows", "c.draw_screen = True",
+                        "c.effects += 1"]
+            # VF is cleared first, so DFYN draws at column 0 like the handler
+            x, y = (opcode >> 8) & 0x0F, (opcode >> 4) & 0x0F
+            vx = "0" if x == 0xF else reg(x)
+            vy = "0" if y == 0xF else reg(y)
+            return [f"{wreg(0xF)} = draw_sprite(c, {vx}, {vy}, i, {opcode & 0x000F})"]
+
+        def skip_condition(opcode):
+            """ When the skip instruction opcode skips, as an expression, None for other instructions. """
+            x = (opcode >> 8) & 0x0F
+            y = (opcode >> 4) & 0x0F
+            nn = opcode & 0x00FF
+            group = opcode & 0xF000
+            if group == 0x3000:
+                return f"{reg(x)} == {nn:#04x}"
+            if group == 0x4000:
+                return f"{reg(x)} != {nn:#04x}"
+            if group == 0x5000:
+                return f"{reg(x)} == {reg(y)}"
+            if group == 0x9000:
+                return f"{reg(x)} != {reg(y)}"
+            if group == 0xE000 and nn == 0x9E:
+                return f"c.keys >> ({reg(x)} & 0xF) & 1"
+            if group == 0xE000 and nn == 0xA1:
+                return f"not c.keys >> ({reg(x)} & 0xF) & 1"
+            return None
+
+        def opcode_at(address):
+            return memory[address] << 8 | memory[address + 1]
+
+        def handled(address, opcode, executed):
+            """ Lines that hand the instruction at address to its interpreter handler and exit. """
+            handler = c.decoded[address] or c.decode(address)
+            namespace[f"h_{address:03x}"] = handler[1]
+            return [WRITEBACK, f"c.pc = {address + 2:#05x}", f"c.opcode = {opcode:#06x}",
+                    f"h_{address:03x}()", f"return n + {executed}"]
+
+        while count < limit and address + 1 < len(memory):
+            opcode = opcode_at(address)
+            nnn = opcode & 0x0FFF
+            group = opcode & 0xF000
+            following = address + 2
+            addresses.append(address)
+            body.append(f"# {address:03x}: {opcode:04x}")
+
+            lines = straight(opcode, count)
+            if lines is not None:
+                body.extend(lines)
+                count += 1
+                address = following
+                continue
+
+            if group == 0xD000 or opcode == 0x00E0:
+                body.extend(draw(opcode))
+                body.append("if stop_draw:")
+                body.extend(indent(exit_lines(f"{following:#05x}", opcode, count + 1)))
+                count += 1
+                address = following
+                continue
+
+            condition = skip_condition(opcode)
+            if condition is not None:
+                # The skip stays inside the block when it skips a single
+                # straight line instruction, a jump or an instruction that
+                # goes to its handler and exits. Unless the jump leaves
+                # a loop, the block goes on after it, the skipped instruction
+                # is not the last one, so c.opcode stays right.
+                room = count + 3 <= limit and following + 5 < len(memory)
+                skipped = opcode_at(following) if following + 1 < len(memory) else None
+                if skipped is not None and skipped & 0xF000 == 0x1000 and (skipped & 0x0FFF) == entry \
+                        and count + 2 <= limit and not returns:
+                    # The loop runs again unless the skip is taken
+                    addresses.append(following)
+                    body.append(f"# {following:03x}: {skipped:04x}")
+                    body.append(f"if {condition}:")
+                    body.extend(indent(exit_lines(f"{following + 2:#05x}", opcode, count + 1)))
+                    count += 2
+                    address = following + 2
+                    loop_opcode = skipped
+                    break
+                if skipped is not None and skipped & 0xF000 == 0x1000 and room:
+                    addresses.append(following)
+                    body.append(f"# {following:03x}: {skipped:04x}")
+                    body.extend([f"if {condition}:", "    n -= 1", "else:"])
+                    body.extend(indent(exit_lines(f"{skipped & 0x0FFF:#05x}", skipped, count + 2)))
+                    count += 2
+                    address = following + 2
+                    continue
+                if skipped is not None and room:
+                    skipped_lines = straight(skipped, count + 1)
+                    if skipped_lines is None and (skipped & 0xF000 == 0x2000 or skipped == 0x00EE
+                                                  or skipped & 0xF0FF in (0xF00A, 0xF033, 0xF055)):
+                        # Calls, returns, waits and stores exit unless skipped
+                        skipped_lines = handled(following, skipped, count + 2)
+                    if skipped_lines is not None:
+                        addresses.append(following)
+                        body.append(f"# {following:03x}: {skipped:04x}")
+                        body.extend([f"if {condition}:", "    n -= 1", "else:"])
+                        body.extend(indent(skipped_lines))
+                        count += 2
+                        address = following + 2
+                        continue
+                body.extend(exit_lines(f"{following + 2:#05x} if {condition} else {following:#05x}", opcode, count + 1))
+            elif group == 0x1000 and nnn == entry and not returns:
+                loop_opcode = opcode
+            elif group == 0x1000 and nnn not in addresses:
+                # The block goes on at the target
+                count += 1
+                address = nnn
+                continue
+            elif group == 0x2000:
+                # The block pushes the return address and goes on in the
+                # subroutine, the handler raises the stack overflow
+                body.append(f"if c.sp == {Chip8.stack_size}:")
+                body.extend(indent(handled(address, opcode, count + 1)))
+                body.extend([f"c.stack[c.sp] = {following:#05x}", "c.sp += 1"])
+                returns.append(following)
+                count += 1
+                address = nnn
+                continue
+            elif opcode == 0x00EE and returns:
+                # The return address is the one pushed in the block
+                body.append("c.sp -= 1")
+                count += 1
+                address = returns.pop()
+                continue
+            elif opcode & 0xF0FF in (0xF033, 0xF055):
+                x = (opcode >> 8) & 0x0F
+                if opcode & 0xFF == 0x33:
+                    length = 3
+                    body.extend([f"M[i] = {reg(x)} // 100", f"M[i + 1] = {reg(x)} // 10 % 10",
+                                 f"M[i + 2] = {reg(x)} % 10"])
+                else:
+                    length = x + 1
+                    body.extend(f"M[i + {index}] = {reg(index)}" for index in range(x + 1))
+                body.extend([f"c.invalidate_decoded(i, i + {length})", f"t = any(CM[i:i + {length}])"])
+                if opcode & 0xFF == 0x55 and quirks.load_store_index != "unchanged":
+                    index_written = True
+                    body.append(f"i = i + {x + 1 if quirks.load_store_index == 'x+1' else x}")
+                # The block goes on unless the store wrote to compiled code, maybe its own
+                body.append("if t:")
+                body.extend(indent(exit_lines(f"{following:#05x}", opcode, count + 1)))
+                count += 1
+                address = following
+                continue
+            elif opcode & 0xF0FF == 0xF00A:
+                # Waits by exiting to itself until a key is held, the lowest one is stored
+                body.append("if not c.keys:")
+                body.extend(indent(exit_lines(f"{address:#05x}", opcode, count + 1)))
+                body.append(f"{wreg((opcode >> 8) & 0x0F)} = (c.keys & -c.keys).bit_length() - 1")
+                count += 1
+                address = following
+                continue
+            elif opcode == 0x0000:
+                body.extend(exit_lines(f"{address:#05x}", opcode, count + 1))
+            elif group == 0x1000:
+                body.extend(exit_lines(f"{nnn:#05x}", opcode, count + 1))
+            elif group == 0xB000:
+                target = reg((opcode >> 8) & 0x0F) if quirks.jump_vx else reg(0)
+                body.extend(exit_lines(f"{nnn:#05x} + {target}", opcode, count + 1))
+            else:
+                # 00EE of calls made before the block and unknown opcodes
+                # go to the interpreter handler with all state written back
+                body.extend(handled(address, opcode, count + 1))
+            count += 1
+            address = following
+            terminated = True
+            break
+
+        writeback = [f"V[{index}] = {self.regnames[index]}" for index in sorted(written)]
+        if index_written:
+            writeback.append("c.i = i")
+
+        # Registers are loaded once on entry and kept in locals
+        source = ["def block(c, budget, stop_draw):", "    V = c.v", "    M = c.memory", "    i = c.i"]
+        source.extend(f"    {self.regnames[index]} = V[{index}]" for index in sorted(used))
+        source.append("    n = 0")
+        if loop_opcode is not None and count == 1:
+            # A jump to itself changes nothing, all passes take no time
+            source.append("    n = budget if budget > 1 else 1")
+            tail = exit_lines(f"{entry:#05x}", loop_opcode, 0)
+        elif loop_opcode is not None:
+            # Passes run while the budget has room for a whole one, keys
+            # cannot change before run() gets control back
+            source.append("    while True:")
+            source.extend(indent(indent(body)))
+            source.extend(indent(indent([f"n += {count}", f"if n + {count} > budget:", "    break"])))
+            tail = exit_lines(f"{entry:#05x}", loop_opcode, 0)
+        elif not terminated:
+            tail = exit_lines(f"{address:#05x}", opcode, count)
+            source.extend(indent(body))
+        else:
+            tail = []
+            source.extend(indent(body))
+        source.extend(indent(tail))
+
+        lines = []
+        for line in source:
+            if line.strip() == WRITEBACK:
+                margin = line[:len(line) - len(line.lstrip())]
+                lines.extend(margin + statement for statement in writeback)
+            else:
+                lines.append(line)
+        return "\n".join(lines) + "\n", namespace, ranges_of(entry, addresses), count
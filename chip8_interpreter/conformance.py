@@ -0,0 +1,209 @@
+from contextlib import redirect_stdout
+from typing import Dict, List, NamedTuple, Optional, Sequence, Tuple
+import json
+import os
+import time
+
+from chip8_interpreter.analysis import analyze
+from chip8_interpreter.bench import default_input_script
+from chip8_interpreter.chip8 import DEFAULT_QUIRKS, Chip8
+from chip8_interpreter.compiler import BlockCompiler
+from chip8_interpreter.headless import InputScript, frame_hash, load_rom
+from chip8_interpreter.replay import InputReplayer
+from chip8_interpreter.scheduler import FIXED, INSTRUCTIONS_PER_FRAME, Scheduler
+
+GOLDEN_VERSION = 1
+DEFAULT_GOLDEN = os.path.join("roms", "golden.json")
+DEFAULT_DUMP_DIR = "conformance-failures"
+
+
+def key_presses(keys: Sequence[int], start: int, hold: int = 100, period: int = 200) -> List[Tuple[int, int]]:
+    """ Input script pressing keys one after the other, each held for hold cycles, one every period cycles. """
+    script = []
+    for number, key in enumerate(keys):
+        script.append((start + number * period, 1 << key))
+        script.append((start + number * period + hold, 0))
+    return script
+
+
+class ConformanceCase(NamedTuple):
+    name: str
+    # Path of the ROM, unused when program is given
+    rom: str
+    # Cycles from power-on at which the display is hashed, ascending
+    checkpoints: Tuple[int, ...]
+    inputs: InputScript = ()
+    seed: int = 1
+    quirks: str = DEFAULT_QUIRKS
+    instructions_per_frame: int = INSTRUCTIONS_PER_FRAME
+    # The ROM itself, for small programs written for one case
+    program: bytes = b""
+    # Addresses analyze() has to find as instructions
+    code: Tuple[int, ...] = ()
+
+
+# Eight nested calls of one loop that only differ in the stack, then RET
+# unwinds them and the program draws V0 = 5. An idle loop check that leaves
+# out the stack takes the calls for a loop and never gets to the draw.
+NESTED_CALLS = (bytes.fromhex("1210 00ee").ljust(0x10, b"\0") + bytes.fromhex("2202") * 8 +
+                bytes.fromhex("6005 f029 6100 d115 122a"))
+
+# 5011 skips because V0 == V1: the engines ignore the low nibble, so the
+# program draws 5 from code only reached by the skip, and the analysis
+# has to take 5011 for a skip to find that code.
+SKIP_5XY1 = bytes.fromhex("6001 6101 5011 1210 6005 1212 0000 0000 6007 f029 6100 d115 1218")
+
+# ROM paths are relative to the repository root, where the suite is run from
+CASES = (
+    ConformanceCase("test_opcode", "roms/test_opcode.ch8", (200, 600, 3000)),
+    ConformanceCase("test_opcode-cosmac-vip", "roms/test_opcode.ch8", (3000,), quirks="cosmac-vip"),
+    ConformanceCase("test_opcode-chip-48", "roms/test_opcode.ch8", (3000,), quirks="chip-48"),
+    ConformanceCase("bx_test", "bx_test.ch8", (150, 3000)),
+    ConformanceCase("ibmlogo", "roms/ibmlogo.ch8", (20, 1000)),
+    # FX0A returns again while a key stays held: holding 2 counts the delay up, 8 down,
+    # then 5 starts it and the display counts down to 0. Checkpoints fall between the presses.
+    ConformanceCase("delay_timer_test", "roms/delay_timer_test.ch8", (1950, 2950, 3550, 3800, 4000, 5000),
+                    key_presses([2] * 12 + [8, 5], 1000)),
+    # Key 5 held, released, then keys 0 and F held together
+    ConformanceCase("keypad_test", "roms/keypad_test.ch8", (1000, 2500, 3200, 4000),
+                    ((2000, 0x0020), (3000, 0), (3500, 0x8001))),
+    ConformanceCase("tetris", "roms/tetris.ch8", (20000, 60000), tuple(default_input_script(60000))),
+    ConformanceCase("trip8", "roms/trip8.ch8", (10000, 40000)),
+    ConformanceCase("octojam2title", "roms/octojam2title.ch8", (5000, 30000)),
+    ConformanceCase("brix", "brixch8.ch8", (20000,), tuple(default_input_script(20000))),
+    ConformanceCase("air", "air.ch8", (20000,), tuple(default_input_script(20000))),
+    ConformanceCase("nested_calls", "", (40, 100), instructions_per_frame=200, program=NESTED_CALLS),
+    ConformanceCase("skip_5xy1", "", (20, 100), program=SKIP_5XY1, code=(0x208, 0x20A)),
+)
+
+
+class Variant(NamedTuple):
+    engine: str
+    fast_forward: bool
+
+    @property
+    def name(self) -> str:
+        return self.engine if self.fast_forward else f"{self.engine}/no-ff"
+
+
+# Idle loop skipping off first: the instruction by instruction interpreter is the reference
+VARIANTS = (
+    Variant("interpreter", False),
+    Variant("interpreter", True),
+    Variant("compiled", False),
+    Variant("compiled", True),
+)
+
+
+class CaseResult(NamedTuple):
+    case: ConformanceCase
+    variant: Variant
+    hashes: Dict[int, str]
+    seconds: float
+    # First checkpoint whose hash differs from the golden one and where its frame was written
+    mismatch: Optional[int] = None
+    dump: Optional[str] = None
+
+
+def load_golden(path: str) -> Dict[str, Dict[int, str]]:
+    """ Golden frame hashes per case and checkpoint, empty when the file does not exist yet. """
+    try:
+        with open(path) as in_file:
+            golden = json.load(in_file)
+    except FileNotFoundError:
+        return {}
+    if golden.get("version") != GOLDEN_VERSION:
+        raise Exception(f"Unsupported golden file version {golden.get('version')}, expected {GOLDEN_VERSION}")
+    return {name: {int(cycle): value for cycle, value in hashes.items()} for name, hashes in golden["cases"].items()}
+
+
+def save_golden(path: str, golden: Dict[str, Dict[int, str]]):
+    cases = {name: {str(cycle): value for cycle, value in sorted(hashes.items())}
+             for name, hashes in sorted(golden.items())}
+    with open(path, "w") as out_file:
+        json.dump({"version": GOLDEN_VERSION, "cases": cases}, out_file, indent=2)
+        out_file.write("\n")
+
+
+def dump_frame(chip8: Chip8, path: str, title: str):
+    """ Writes the display as drawn by draw_vram, and the registers, to a text file. """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path, "w", encoding="utf-8") as out_file, redirect_stdout(out_file):
+        print(title)
+        chip8.draw_vram()
+        chip8.print_registers()
+
+
+def run_case(case: ConformanceCase, rom: bytes, variant: Variant,
+             expected: Optional[Dict[int, str]] = None, dump_dir: Optional[str] = None) -> CaseResult:
+    """
+    Runs case from power-on and hashes the display at every checkpoint.
+    The first checkpoint that differs from expected is written to dump_dir.
+    """
+    chip8 = Chip8(case.seed, case.quirks)
+    chip8.load_program_to_memory(rom)
+    chip8.fast_forward = variant.fast_forward
+    compiler = BlockCompiler(chip8) if variant.engine == "compiled" else None
+    scheduler = Scheduler(chip8, case.instructions_per_frame, FIXED, compiler=compiler,
+                          inputs=InputReplayer(case.inputs) if case.inputs else None)
+    hashes = {}
+    mismatch = None
+    dump = None
+    seconds = 0.0
+    for checkpoint in case.checkpoints:
+        start = time.perf_counter()
+        scheduler.run_cycles(checkpoint - chip8.cycles)
+        seconds += time.perf_counter() - start
+        hashes[checkpoint] = frame_hash(chip8)
+        if expected is None or mismatch is not None or expected.get(checkpoint) == hashes[checkpoint]:
+            continue
+        mismatch = checkpoint
+        if dump_dir:
+            dump = os.path.join(dump_dir, f"{case.name}-{variant.name.replace('/', '-')}-{checkpoint}.txt")
+            dump_frame(chip8, dump, f"{case.name} on {variant.name} at cycle {checkpoint}: "
+                                    f"frame hash {hashes[checkpoint]}, expected {expected.get(checkpoint)}")
+    return CaseResult(case, variant, hashes, seconds, mismatch, dump)
+
+
+def run_suite(cases: Sequence[ConformanceCase] = CASES, variants: Sequence[Variant] = VARIANTS,
+              golden: Optional[Dict[str, Dict[int, str]]] = None, dump_dir: Optional[str] = DEFAULT_DUMP_DIR,
+              report=print) -> Tuple[List[CaseResult], List[str]]:
+    """
+    Runs every case on every variant, compares the frame hashes against
+    golden and returns the results and one line per failure. Without golden
+    the variants are only compared with each other, e.g. to record new hashes.
+    """
+    results = []
+    failures = []
+    for case in cases:
+        if not case.program and not os.path.exists(case.rom):
+            failures.append(f"{case.name}: {case.rom} not found")
+            report(f"FAIL {case.name:24s} {case.rom} not found")
+            continue
+        rom = case.program or load_rom(case.rom)
+        expected = golden.get(case.name) if golden is not None else None
+        if golden is not None and expected is None:
+            failures.append(f"{case.name}: no golden hashes, record them with --update")
+        if case.code:
+            instructions = analyze(rom, quirks=case.quirks).instructions
+            missed = [address for address in case.code if address not in instructions]
+            if missed:
+                failures.append(f"{case.name}: analysis misses the code at {', '.join(f'{a:03x}' for a in missed)}")
+                report(f"FAIL {case.name:24s} analysis misses code")
+        reference = None
+        for variant in variants:
+            result = run_case(case, rom, variant, expected, dump_dir)
+            results.append(result)
+            if reference is None:
+                reference = result
+            failure = None
+            if result.mismatch is not None:
+                where = f", frame written to {result.dump}" if result.dump else ""
+                failure = f"{case.name} on {variant.name}: frame at cycle {result.mismatch} differs from the golden hash{where}"
+            elif result.hashes != reference.hashes:
+                failure = f"{case.name} on {variant.name}: frames differ from {reference.variant.name}"
+            if failure is not None:
+                failures.append(failure)
+            report(f"{'FAIL' if failure else 'ok':4s} {case.name:24s} {variant.name:18s} "
+                   f"{len(case.checkpoints)} checkpoints {result.seconds * 1e3:8.2f} ms")
+    return results, failures
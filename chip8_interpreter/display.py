@@ -0,0 +1,21 @@
+from typing import Tuple
+
+# RGB bytes for the 8 pixels of every possible byte of a packed display row
+PIXEL_ON = b"\xff\xff\xff"
+PIXEL_OFF = b"\x00\x00\x00"
+BYTE_TO_RGB = [b"".join(PIXEL_ON if byte & (0x80 >> bit) else PIXEL_OFF for bit in range(8)) for byte in range(256)]
+
+# Bytes of one display row in an RGB frame buffer
+RGB_ROW = 64 * 3
+
+
+def upload_rows(frame_buffer: bytearray, vram, dirty_rows: int):
+    """ Writes the display rows set in dirty_rows into a 64x32 RGB frame buffer. """
+    for y in range(32):
+        if dirty_rows >> y & 1:
+            frame_buffer[y*RGB_ROW:(y+1)*RGB_ROW] = b"".join(BYTE_TO_RGB[byte] for byte in vram[y].to_bytes(8, "big"))
+
+
+def dirty_band(dirty_rows: int) -> Tuple[int, int]:
+    """ First row and the row after the last of the smallest band holding every dirty row. """
+    return (dirty_rows & -dirty_rows).bit_length() - 1, dirty_rows.bit_length()
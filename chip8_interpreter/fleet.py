@@ -0,0 +1,122 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from chip8_interpreter.cache import ArtifactCache, prepare, save_artifacts
+from chip8_interpreter.chip8 import DEFAULT_QUIRKS, Chip8
+from chip8_interpreter.compiler import BlockCompiler
+from chip8_interpreter.headless import InputScript, frame_hash, load_rom, run_headless, state_hash
+from chip8_interpreter.scheduler import INSTRUCTIONS_PER_FRAME
+
+
+class FleetJob(NamedTuple):
+    rom: str
+    cycles: int
+    seed: Optional[int] = None
+    inputs: InputScript = ()
+    engine: str = "interpreter"
+    instructions_per_frame: int = INSTRUCTIONS_PER_FRAME
+    # Save state file to start from instead of power-on
+    state: Optional[str] = None
+    quirks: str = DEFAULT_QUIRKS
+
+
+class FleetResult(NamedTuple):
+    # Position of the job in the jobs given to run_fleet
+    position: int
+    rom: str
+    seed: Optional[int]
+    cycles: int
+    seconds: float
+    state_hash: str
+    frame_hash: str
+
+    @property
+    def ips(self) -> float:
+        return self.cycles / self.seconds if self.seconds else 0.0
+
+
+# Per worker process state, filled by _init_worker.
+# ROM images and save states are sent once per worker instead of once per job, and every
+# worker keeps one machine per ROM so decoded instructions and compiled
+# blocks carry over from one job to the next.
+_roms: Dict[str, bytes] = {}
+_states: Dict[str, bytes] = {}
+_machines: Dict[Tuple[str, str, str], Tuple[Chip8, Optional[BlockCompiler], bytes]] = {}
+# Shared artifact cache of the fleet, if any
+_cache: List[Optional[ArtifactCache]] = [None]
+
+
+def _init_worker(roms: Dict[str, bytes], states: Dict[str, bytes], cache: Optional[ArtifactCache] = None):
+    _roms.clear()
+    _roms.update(roms)
+    _states.clear()
+    _states.update(states)
+    _machines.clear()
+    _cache[0] = cache
+
+
+def _power_on(rom: str, engine: str, quirks: str) -> Tuple[Chip8, Optional[BlockCompiler]]:
+    """ Returns this worker's machine for rom, in the state of a fresh Chip8 with the ROM loaded. """
+    prepared = _machines.get((rom, engine, quirks))
+    if prepared is None:
+        machine = Chip8(quirks=quirks)
+        machine.load_program_to_memory(_roms[rom])
+        compiler = BlockCompiler(machine) if engine == "compiled" else None
+        cache = _cache[0]
+        if cache is not None:
+            # The first job of a ROM in this worker starts from what an earlier worker prepared
+            rom_map, artifacts = prepare(machine, _roms[rom], compiler, cache)
+            save_artifacts(cache, _roms[rom], machine, rom_map, artifacts, compiler)
+        _machines[(rom, engine, quirks)] = (machine, compiler, bytes(machine.memory))
+        return machine, compiler
+
+    machine, compiler, image = prepared
+    machine.reset()
+    memory = machine.memory
+    if memory != image:
+        # Only drop the decoded instructions for bytes the last job wrote
+        for address in range(len(image)):
+            if memory[address] != image[address]:
+                memory[address] = image[address]
+                machine.invalidate_decoded(address, address + 1)
+    machine.vram[:] = Chip8.blank_vram
+    machine.dirty_rows = Chip8.all_rows
+    machine.draw_screen = False
+    machine.set_keys(0)
+    return machine, compiler
+
+
+def run_job(position: int, job: FleetJob) -> FleetResult:
+    machine, compiler = _power_on(job.rom, job.engine, job.quirks)
+    if job.state is not None:
+        # Restores the RNG state as well, a seed given with the job still overrides it
+        machine.restore(_states[job.state])
+    if job.seed is not None:
+        machine.rng.seed(job.seed)
+    result = run_headless(machine, job.cycles, compiler, job.instructions_per_frame, job.inputs)
+    return FleetResult(position, job.rom, job.seed, result.cycles, result.seconds,
+                       state_hash(machine), frame_hash(machine))
+
+
+def run_fleet(jobs: Iterable[FleetJob], workers: Optional[int] = None,
+              cache: Optional[ArtifactCache] = None) -> Iterator[FleetResult]:
+    """
+    Runs jobs on a pool of worker processes and yields results as they finish,
+    not in submission order. FleetResult.position tells which of jobs a result belongs to.
+    Each ROM and save state file is read once here and shipped to every worker once.
+    With a cache, workers prepare every ROM from it before its first job.
+    """
+    jobs = list(jobs)
+    roms = {}
+    states = {}
+    for job in jobs:
+        if job.rom not in roms:
+            roms[job.rom] = load_rom(job.rom)
+        if job.state is not None and job.state not in states:
+            with open(job.state, "rb") as in_file:
+                states[job.state] = in_file.read()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(roms, states, cache)) as executor:
+        futures = [executor.submit(run_job, position, job) for position, job in enumerate(jobs)]
+        for future in as_completed(futures):
+            yield future.result()
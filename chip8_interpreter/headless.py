@@ -0,0 +1,110 @@
+from typing import TYPE_CHECKING, List, NamedTuple, Optional, Sequence, Tuple
+import hashlib
+import struct
+import time
+
+from chip8_interpreter.audio import SoundTimerWatch
+from chip8_interpreter.chip8 import STOP_FRAME, Chip8
+from chip8_interpreter.compiler import BlockCompiler
+from chip8_interpreter.replay import InputReplayer
+from chip8_interpreter.scheduler import FIXED, INSTRUCTIONS_PER_FRAME, Scheduler
+
+if TYPE_CHECKING:
+    # Only imported by --share, multiprocessing takes a while to import
+    from chip8_interpreter.shared import SharedMachine
+
+
+class RunResult(NamedTuple):
+    cycles: int
+    seconds: float
+
+    @property
+    def ips(self) -> float:
+        return self.cycles / self.seconds if self.seconds else 0.0
+
+
+def load_rom(path: str) -> bytes:
+    with open(path, "rb") as in_file:
+        rom_data = in_file.read()
+    if not rom_data:
+        raise Exception(f"Could not load rom {path}")
+    return rom_data
+
+
+def frame_bytes(chip8: Chip8) -> bytes:
+    """ The display packed to one bit per pixel, 8 bytes per row, leftmost pixel in the high bit. """
+    return chip8.packed_vram()
+
+
+def frame_hash(chip8: Chip8) -> str:
+    return hashlib.sha1(frame_bytes(chip8)).hexdigest()
+
+
+def state_hash(chip8: Chip8) -> str:
+    """ Hash of everything the program can observe: memory, display, registers, stack and timers. """
+    digest = hashlib.sha1(chip8.memory)
+    digest.update(frame_bytes(chip8))
+    digest.update(bytes(chip8.v))
+    digest.update(struct.pack(">HHBBB", chip8.pc, chip8.i & 0xFFFF, chip8.sp & 0xFF,
+                              chip8.delay_timer, chip8.sound_timer))
+    digest.update(struct.pack(f">{chip8.sp}H", *chip8.stack[:chip8.sp]))
+    return digest.hexdigest()
+
+
+# An input script is a list of (cycle, key mask) pairs sorted by cycle.
+# Bit k of the mask is set while key k is held, starting at that cycle.
+InputScript = Sequence[Tuple[int, int]]
+
+
+def load_input_script(path: str) -> List[Tuple[int, int]]:
+    """ Reads an input script, one '<cycle> <hex key mask>' pair per line. '#' starts a comment. """
+    script = []
+    with open(path) as in_file:
+        for line in in_file:
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            cycle, mask = line.split()
+            script.append((int(cycle), int(mask, 16)))
+    script.sort()
+    return script
+
+
+def run_headless(chip8: Chip8, cycles: int, compiler: Optional[BlockCompiler] = None,
+                 instructions_per_frame: int = INSTRUCTIONS_PER_FRAME,
+                 inputs: InputScript = (), beeps: Optional[SoundTimerWatch] = None,
+                 shared: Optional["SharedMachine"] = None) -> RunResult:
+    """
+    Runs chip8 for cycles instructions without a display, using the block
+    compiler when one is given, as fast as possible.
+    Emulated time advances one 60Hz frame every instructions_per_frame
+    instructions, so the timers tick once per frame independent of wall time.
+    Key masks from inputs are applied before the instruction at their cycle,
+    counted from the start of this run, so runs can continue from a save state.
+    With beeps the run stops at every frame end to update it, and closes it
+    at the end, so its intervals cover the whole run. With shared the
+    registers are published for observers in other processes, after every
+    batch of frames, or every frame together with beeps.
+    """
+    replayer = InputReplayer(inputs, chip8.cycles) if inputs else None
+    scheduler = Scheduler(chip8, instructions_per_frame, FIXED, compiler=compiler, inputs=replayer)
+    start = time.perf_counter()
+    if beeps is None and shared is None:
+        executed = scheduler.run_cycles(cycles)
+    elif beeps is None:
+        executed = shared.run(scheduler, cycles)
+    else:
+        executed = 0
+        while executed < cycles:
+            if shared is not None:
+                shared.begin()
+            reason, count = scheduler.run(cycles - executed, STOP_FRAME)
+            executed += count
+            if reason == STOP_FRAME:
+                beeps.update()
+                if shared is not None:
+                    shared.publish()
+        beeps.close()
+        if shared is not None:
+            shared.publish()
+    return RunResult(executed, time.perf_counter() - start)
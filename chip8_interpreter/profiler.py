@@ -0,0 +1,182 @@
+from collections import defaultdict
+from typing import Callable, DefaultDict, Dict, List
+import time
+
+from chip8_interpreter.chip8 import Chip8
+
+OPCODE_CLASSES = {
+    0x1000: "1NNN", 0x2000: "2NNN", 0x3000: "3XNN", 0x4000: "4XNN", 0x5000: "5XY0", 0x6000: "6XNN",
+    0x7000: "7XNN", 0x9000: "9XY0", 0xA000: "ANNN", 0xB000: "BNNN", 0xC000: "CXNN", 0xD000: "DXYN",
+}
+
+# How the keys of each dispatch table turn into instruction class labels
+TABLE_LABELS: Dict[str, Callable[[int], str]] = {
+    "optable": OPCODE_CLASSES.__getitem__,
+    "optable_0": lambda key: f"{key:04X}",
+    "optable_8": lambda key: f"8XY{key:X}",
+    "optable_e": lambda key: f"EX{key:02X}",
+    "optable_f": lambda key: f"FX{key:02X}",
+}
+
+
+def instrument_tables(chip8: Chip8, wrap: Callable[[str, Callable], Callable]) -> Dict[str, Dict[int, Callable]]:
+    """
+    Replaces every handler in the dispatch tables of chip8 with wrap(label, handler)
+    and drops the decoded instructions so they are decoded again with the wrappers.
+    Returns the original tables for restore_tables().
+    """
+    saved = {}
+    for name, label in TABLE_LABELS.items():
+        table = getattr(chip8, name)
+        saved[name] = dict(table)
+        # In place, the group tables hold references to these dicts
+        for key, handler in table.items():
+            table[key] = wrap(label(key), handler)
+    chip8.invalidate_decoded(0, len(chip8.memory))
+    return saved
+
+
+def restore_tables(chip8: Chip8, saved: Dict[str, Dict[int, Callable]]):
+    for name, table in saved.items():
+        getattr(chip8, name).update(table)
+    chip8.invalidate_decoded(0, len(chip8.memory))
+
+
+class Profiler:
+    """
+    Counts instructions per class (8XY4, FX0A, ...) and per address, samples
+    the time spent in every handler and follows CALL/RET to record the
+    subroutine stack and its maximum depth.
+
+    install() swaps every handler in the Chip8 dispatch tables for an
+    instrumented wrapper and drops the decoded instructions, so they are
+    decoded again with the wrappers. uninstall() puts the original handlers
+    back. While no profiler is installed the interpreter runs its normal
+    tables, there is no check for profiling anywhere on the hot path.
+
+    Only instructions dispatched through the tables are seen: profile the
+    interpreter, a BlockCompiler runs most instructions inline.
+    """
+
+    def __init__(self, chip8: Chip8, sample_every: int = 16):
+        self.chip8 = chip8
+        # Every sample_every-th call of a handler is timed
+        self.sample_every = sample_every
+        # label: [calls, timed calls, seconds in timed calls]
+        self.classes: Dict[str, List[float]] = {}
+        self.pc_counts = [0] * len(chip8.memory)
+        # Instructions executed per subroutine stack, ';' separated entry addresses
+        self.folded: DefaultDict[str, int] = defaultdict(int)
+        self.stack: List[int] = []
+        self.stack_key = "main"
+        self.max_depth = 0
+        self.saved: Dict[str, Dict[int, Callable]] = {}
+        self.fast_forward = chip8.fast_forward
+
+    def __enter__(self) -> "Profiler":
+        self.install()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.uninstall()
+
+    @property
+    def installed(self) -> bool:
+        return bool(self.saved)
+
+    @property
+    def instructions(self) -> int:
+        return sum(self.pc_counts)
+
+    def install(self):
+        if self.installed:
+            return
+        # Skipped idle loops would not be counted
+        self.fast_forward = self.chip8.fast_forward
+        self.chip8.fast_forward = False
+        self.saved = instrument_tables(self.chip8, self._instrument)
+
+    def uninstall(self):
+        if not self.installed:
+            return
+        restore_tables(self.chip8, self.saved)
+        self.saved = {}
+        self.chip8.fast_forward = self.fast_forward
+
+    def _instrument(self, label: str, handler: Callable) -> Callable:
+        chip8 = self.chip8
+        stats = self.classes.setdefault(label, [0, 0, 0.0])
+        pc_counts = self.pc_counts
+        folded = self.folded
+        sample_every = self.sample_every
+        perf_counter = time.perf_counter
+        profiler = self
+
+        def profiled(x, y, n, nn, nnn):
+            pc_counts[chip8.pc - 2] += 1
+            folded[profiler.stack_key] += 1
+            stats[0] += 1
+            if stats[0] % sample_every:
+                handler(x, y, n, nn, nnn)
+            else:
+                start = perf_counter()
+                handler(x, y, n, nn, nnn)
+                stats[2] += perf_counter() - start
+                stats[1] += 1
+
+        if label == "2NNN":
+            def profiled_call(x, y, n, nn, nnn):
+                profiled(x, y, n, nn, nnn)
+                profiler.enter(nnn)
+            return profiled_call
+        if label == "00EE":
+            def profiled_return(x, y, n, nn, nnn):
+                profiled(x, y, n, nn, nnn)
+                profiler.leave()
+            return profiled_return
+        return profiled
+
+    def enter(self, address: int):
+        self.stack.append(address)
+        self.stack_key += f";sub_{address:03x}"
+        self.max_depth = max(self.max_depth, len(self.stack))
+
+    def leave(self):
+        if self.stack:
+            self.stack.pop()
+            self.stack_key = ";".join(["main"] + [f"sub_{address:03x}" for address in self.stack])
+
+    def report(self, top: int = 20) -> str:
+        """ Instruction classes by estimated time, then the top most executed addresses. """
+        total = self.instructions or 1
+        lines = [f"{self.instructions} instructions, max call depth {self.max_depth}, "
+                 f"1 in {self.sample_every} calls timed", "",
+                 f"{'class':6s} {'count':>12s} {'%':>6s} {'us/call':>8s} {'est. ms':>9s}"]
+        rows = []
+        for label, (calls, timed, seconds) in self.classes.items():
+            if not calls:
+                continue
+            per_call = seconds / timed if timed else 0.0
+            rows.append((per_call * calls, label, calls, per_call, timed))
+        for estimate, label, calls, per_call, timed in sorted(rows, reverse=True):
+            if not timed:
+                # Too few calls to have been sampled
+                lines.append(f"{label:6s} {calls:12d} {calls / total:6.1%} {'-':>8s} {'-':>9s}")
+                continue
+            lines.append(f"{label:6s} {calls:12d} {calls / total:6.1%} {per_call * 1e6:8.2f} {estimate * 1e3:9.2f}")
+
+        lines += ["", f"{'address':7s} {'opcode':6s} {'count':>12s} {'%':>6s}"]
+        memory = self.chip8.memory
+        hot = sorted(range(len(self.pc_counts)), key=self.pc_counts.__getitem__, reverse=True)[:top]
+        for address in hot:
+            count = self.pc_counts[address]
+            if not count:
+                break
+            lines.append(f"{address:04x}    {memory[address] << 8 | memory[address + 1]:04x}   {count:12d} {count / total:6.1%}")
+        return "\n".join(lines)
+
+    def write_folded(self, path: str):
+        """ Writes the stacks in the folded format read by flamegraph.pl and speedscope, weighted by instructions. """
+        with open(path, "w") as out_file:
+            for stack, count in sorted(self.folded.items()):
+                out_file.write(f"{stack} {count}\n")
@@ -0,0 +1,127 @@
+from typing import List, NamedTuple, Sequence, Tuple
+import hashlib
+import struct
+
+from chip8_interpreter.chip8 import Chip8
+
+# Input log file, big endian:
+#   header: magic, version, seed, instructions per frame, sha1 of the ROM,
+#           cycles the session ran, number of events
+#   then one record per event: cycles since the previous event, key mask
+LOG_MAGIC = b"CH8I"
+LOG_VERSION = 1
+LOG_HEADER = struct.Struct(">4sHQH20sQI")
+LOG_EVENT = struct.Struct(">IH")
+
+
+class InputLog(NamedTuple):
+    seed: int
+    instructions_per_frame: int
+    rom_hash: bytes
+    cycles: int
+    # (cycle, key mask) pairs sorted by cycle, the mask applies from that cycle on
+    events: Sequence[Tuple[int, int]]
+
+
+def rom_hash(rom: bytes) -> bytes:
+    return hashlib.sha1(rom).digest()
+
+
+def save_input_log(path: str, log: InputLog):
+    records = [LOG_HEADER.pack(LOG_MAGIC, LOG_VERSION, log.seed, log.instructions_per_frame,
+                               log.rom_hash, log.cycles, len(log.events))]
+    previous = 0
+    for cycle, mask in log.events:
+        records.append(LOG_EVENT.pack(cycle - previous, mask))
+        previous = cycle
+    with open(path, "wb") as out_file:
+        out_file.write(b"".join(records))
+
+
+def load_input_log(path: str) -> InputLog:
+    with open(path, "rb") as in_file:
+        data = in_file.read()
+    if len(data) < LOG_HEADER.size or data[:4] != LOG_MAGIC:
+        raise Exception(f"{path} is not a CHIP-8 input log")
+    magic, version, seed, instructions_per_frame, rom_sha1, cycles, count = LOG_HEADER.unpack_from(data)
+    if version != LOG_VERSION:
+        raise Exception(f"Unsupported input log version {version}, expected {LOG_VERSION}")
+    if len(data) != LOG_HEADER.size + count * LOG_EVENT.size:
+        raise Exception(f"Truncated input log {path}")
+    events = []
+    cycle = 0
+    for delta, mask in LOG_EVENT.iter_unpack(data[LOG_HEADER.size:]):
+        cycle += delta
+        events.append((cycle, mask))
+    return InputLog(seed, instructions_per_frame, rom_sha1, cycles, events)
+
+
+class InputRecorder:
+    """
+    Applies key masks to a machine and logs every change with the cycle it
+    happened at, so the session can be replayed exactly by InputReplayer.
+    The machine should be created with the same seed that is passed here.
+    """
+
+    def __init__(self, chip8: Chip8, seed: int, rom: bytes):
+        self.chip8 = chip8
+        self.seed = seed
+        self.rom_hash = rom_hash(rom)
+        self.events: List[Tuple[int, int]] = []
+        self.mask = chip8.keys
+
+    def update(self, mask: int):
+        """ Sets the keys of the machine, call with the current key mask before running it. """
+        cycle = self.chip8.cycles
+        events = self.events
+        if events and events[-1][0] >= cycle:
+            # Several changes at one cycle, or the machine was rewound: the
+            # events that are not in the past any more are replaced
+            while events and events[-1][0] >= cycle:
+                events.pop()
+            self.mask = events[-1][1] if events else 0
+        if mask != self.mask:
+            events.append((cycle, mask))
+            self.mask = mask
+        # Setting the keys forgets the idle loop, so the same mask every frame
+        # would keep fast-forward from ever skipping one
+        if mask != self.chip8.keys:
+            self.chip8.set_keys(mask)
+
+    def log(self) -> InputLog:
+        return InputLog(self.seed, self.chip8.instructions_per_frame, self.rom_hash,
+                        self.chip8.cycles, list(self.events))
+
+    def save(self, path: str):
+        save_input_log(path, self.log())
+
+
+class InputReplayer:
+    """
+    Feeds (cycle, key mask) events back into a machine. A Scheduler given a
+    replayer splits its runs at event cycles and calls apply_due() there, so
+    every mask is set right before the instruction at its cycle.
+    offset is added to the event cycles, e.g. the cycle count a run starts at.
+    """
+
+    def __init__(self, events: Sequence[Tuple[int, int]], offset: int = 0):
+        self.events = events
+        self.offset = offset
+        self.position = 0
+        self.next_cycle = self._cycle_at(0)
+
+    def _cycle_at(self, position: int) -> float:
+        if position < len(self.events):
+            return self.events[position][0] + self.offset
+        return float("inf")
+
+    @property
+    def finished(self) -> bool:
+        return self.position >= len(self.events)
+
+    def apply_due(self, chip8: Chip8):
+        """ Sets the keys of every event at or before the current cycle. """
+        while self.next_cycle <= chip8.cycles:
+            chip8.set_keys(self.events[self.position][1])
+            self.position += 1
+            self.next_cycle = self._cycle_at(self.position)
@@ -0,0 +1,112 @@
+from collections import deque
+from typing import Deque, Optional
+import re
+import struct
+
+from chip8_interpreter.chip8 import Chip8
+
+# A delta is a list of runs: (offset, length) header followed by length XOR bytes
+RUN_HEADER = struct.Struct(">HH")
+# Runs of changed bytes, zero gaps shorter than the run header are kept inside the run
+CHANGED_RUN = re.compile(rb"[^\x00](?:[^\x00]|\x00{1,3}(?=[^\x00]))*")
+
+
+def xor_bytes(a: bytes, b: bytes) -> bytes:
+    return (int.from_bytes(a, "big") ^ int.from_bytes(b, "big")).to_bytes(len(a), "big")
+
+
+def encode_delta(old: bytes, new: bytes) -> bytes:
+    """ XOR of two save states with the unchanged (zero) stretches left out. """
+    changes = xor_bytes(old, new)
+    runs = []
+    for match in CHANGED_RUN.finditer(changes):
+        runs.append(RUN_HEADER.pack(match.start(), match.end() - match.start()))
+        runs.append(match.group())
+    return b"".join(runs)
+
+
+def apply_delta(state: bytes, delta: bytes) -> bytes:
+    """ Undoes or redoes encode_delta: returns the other state of the pair. """
+    changes = bytearray(len(state))
+    position = 0
+    while position < len(delta):
+        offset, length = RUN_HEADER.unpack_from(delta, position)
+        position += RUN_HEADER.size
+        changes[offset:offset+length] = delta[position:position+length]
+        position += length
+    return xor_bytes(state, changes)
+
+
+class RewindBuffer:
+    """
+    Ring buffer of past machine states, recorded every interval_frames frames.
+
+    Only the newest state is kept in full, every older one is stored as the
+    run-length encoded XOR delta to the state recorded after it. Between
+    CHIP-8 frames few bytes of memory and display change, so a delta is
+    usually a few dozen bytes instead of a whole save state. Once the deltas
+    use more than budget bytes the oldest are dropped.
+    """
+
+    def __init__(self, chip8: Chip8, interval_frames: int = 6, budget: int = 1 << 20):
+        self.chip8 = chip8
+        self.interval_frames = interval_frames
+        self.budget = budget
+        self.latest: Optional[bytes] = None
+        # Oldest first, deltas[-1] leads from latest to the state before it
+        self.deltas: Deque[bytes] = deque()
+        self.nbytes = 0
+        self.last_frame = -interval_frames
+        # Emulated cycle of the latest capture
+        self.last_cycle = -1
+
+    def __len__(self) -> int:
+        """ Number of states that can be rewound to. """
+        return len(self.deltas) + (self.latest is not None)
+
+    def clear(self):
+        self.latest = None
+        self.deltas.clear()
+        self.nbytes = 0
+        self.last_frame = -self.interval_frames
+        self.last_cycle = -1
+
+    def record(self) -> bool:
+        """ Captures the machine if interval_frames frames passed since the last capture. Call once per frame. """
+        if self.chip8.frames - self.last_frame < self.interval_frames:
+            return False
+        self.capture()
+        return True
+
+    def capture(self):
+        state = self.chip8.snapshot()
+        if self.latest is not None:
+            delta = encode_delta(state, self.latest)
+            self.deltas.append(delta)
+            self.nbytes += len(delta)
+            while self.nbytes > self.budget and self.deltas:
+                self.nbytes -= len(self.deltas.popleft())
+        self.latest = state
+        self.last_frame = self.chip8.frames
+        self.last_cycle = self.chip8.cycles
+
+    def rewind(self) -> bool:
+        """
+        Restores the machine one recorded state back and forgets the state it
+        was in. Returns False when there is nothing older left to go back to.
+        """
+        if self.latest is None:
+            return False
+        if self.chip8.cycles != self.last_cycle:
+            # Ran past the newest capture, go back to it first
+            self.chip8.restore(self.latest)
+            return True
+        if not self.deltas:
+            return False
+        delta = self.deltas.pop()
+        self.nbytes -= len(delta)
+        self.latest = apply_delta(self.latest, delta)
+        self.chip8.restore(self.latest)
+        self.last_frame = self.chip8.frames
+        self.last_cycle = self.chip8.cycles
+        return True
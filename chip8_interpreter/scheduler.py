@@ -0,0 +1,131 @@
+from typing import Optional, Tuple
+import time
+
+from chip8_interpreter.chip8 import INSTRUCTIONS_PER_FRAME, STOP_CYCLES, STOP_FRAME, Chip8
+from chip8_interpreter.compiler import BlockCompiler
+from chip8_interpreter.replay import InputReplayer
+
+FRAME_RATE = 60
+
+REALTIME = "realtime"
+FIXED = "fixed"
+UNTHROTTLED = "unthrottled"
+MODES = (REALTIME, FIXED, UNTHROTTLED)
+
+
+class Scheduler:
+    """
+    Drives a Chip8 in emulated 60Hz frames.
+
+    Every frame runs instructions_per_frame instructions and then ticks the
+    delay and sound timers once, so the timers follow emulated time and the
+    CPU speed is set by instructions_per_frame instead of the host loop.
+    Execution goes through Chip8.run, or BlockCompiler.run when a compiler
+    is given, in batches of whole frames. With an InputReplayer the batches
+    are split at the cycles of its events so keys change at the exact cycle.
+
+    advance() decides how many frames to run depending on the mode:
+        realtime     frames follow the wall clock (times speed), missed frames
+                     are caught up, at most max_catchup_frames per call
+        fixed        exactly one frame per call, e.g. once per presented frame
+        unthrottled  as many frames as fit in slice_seconds of wall time
+    """
+
+    def __init__(self, chip8: Chip8, instructions_per_frame: int = INSTRUCTIONS_PER_FRAME,
+                 mode: str = REALTIME, speed: float = 1.0, compiler: Optional[BlockCompiler] = None,
+                 inputs: Optional[InputReplayer] = None):
+        if mode not in MODES:
+            raise Exception(f"Unknown scheduler mode {mode}, expected one of {', '.join(MODES)}")
+        self.chip8 = chip8
+        chip8.instructions_per_frame = instructions_per_frame
+        self.engine = compiler if compiler is not None else chip8
+        self.mode = mode
+        self.speed = speed
+        self.compiler = compiler
+        self.inputs = inputs
+        self.max_catchup_frames = 10
+        self.slice_seconds = 1 / FRAME_RATE
+        self.start_time: Optional[float] = None
+
+    @property
+    def instructions_per_frame(self) -> int:
+        return self.chip8.instructions_per_frame
+
+    @property
+    def frames(self) -> int:
+        return self.chip8.frames
+
+    @property
+    def cycles(self) -> int:
+        return self.chip8.cycles
+
+    def run(self, cycles: int, until=None) -> Tuple[str, int]:
+        """ engine.run, applying the replayed inputs at their cycles. """
+        inputs = self.inputs
+        if inputs is None:
+            return self.engine.run(cycles, until)
+        chip8 = self.chip8
+        executed = 0
+        while True:
+            inputs.apply_due(chip8)
+            budget = cycles - executed
+            if inputs.next_cycle - chip8.cycles < budget:
+                budget = inputs.next_cycle - chip8.cycles
+            reason, count = self.engine.run(budget, until)
+            executed += count
+            if reason != STOP_CYCLES or executed >= cycles:
+                return reason, executed
+
+    def run_cycles(self, cycles: int) -> int:
+        """ Executes cycles instructions, ticking the timers at every frame boundary crossed. """
+        return self.run(cycles)[1]
+
+    def run_frame(self):
+        """ Runs the rest of the current frame. """
+        self.run(self.chip8.instructions_per_frame, STOP_FRAME)
+
+    def reset_clock(self):
+        """ Restarts real time pacing from the current frame, e.g. after a pause. """
+        self.start_time = None
+
+    def frames_due(self, now: float) -> int:
+        if self.start_time is None:
+            self.start_time = now - self.frames / (FRAME_RATE * self.speed)
+        target = int((now - self.start_time) * FRAME_RATE * self.speed) + 1
+        due = target - self.frames
+        if due > self.max_catchup_frames:
+            # Too far behind, drop the frames that cannot be caught up
+            due = self.max_catchup_frames
+            self.start_time = now - (self.frames + due - 1) / (FRAME_RATE * self.speed)
+        return max(due, 0)
+
+    def advance(self, now: Optional[float] = None) -> int:
+        """ Runs the frames that are due according to the mode and returns how many ran. """
+        if self.mode == FIXED:
+            self.run_frame()
+            return 1
+
+        if now is None:
+            now = time.perf_counter()
+        if self.mode == REALTIME:
+            due = self.frames_due(now)
+            for _ in range(due):
+                self.run_frame()
+            return due
+
+        deadline = now + self.slice_seconds
+        ran = 0
+        while True:
+            self.run_frame()
+            ran += 1
+            if time.perf_counter() >= deadline:
+                return ran
+
+    def time_to_next_frame(self, now: Optional[float] = None) -> float:
+        """ Seconds until the next frame is due in realtime mode, 0 in the other modes. """
+        if self.mode != REALTIME or self.start_time is None:
+            return 0.0
+        if now is None:
+            now = time.perf_counter()
+        next_frame = self.start_time + self.frames / (FRAME_RATE * self.speed)
+        return max(next_frame - now, 0.0)
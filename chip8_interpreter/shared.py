@@ -0,0 +1,232 @@
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+from typing import NamedTuple, Optional, Tuple
+import struct
+import time
+
+from chip8_interpreter.chip8 import Chip8
+from chip8_interpreter.scheduler import Scheduler
+
+SHARED_MAGIC = b"C8SM"
+SHARED_VERSION = 1
+
+# Layout of the segment. The header holds the sequence counter of the
+# seqlock and the flag readers set while they wait, the register file and
+# V are written by publish(), the display and the memory are the machine's
+# own storage.
+HEADER_FORMAT = struct.Struct("<4sHBxQ")
+WAITING_OFFSET = 6
+SEQUENCE_FORMAT = struct.Struct("<Q")
+SEQUENCE_OFFSET = 8
+# pc, i, opcode, sp, delay timer, sound timer, keys, stack, cycles, frames, skipped, instructions per frame
+REGISTER_FORMAT = struct.Struct("<HHHBBBxH16HQQQI")
+REGISTER_OFFSET = HEADER_FORMAT.size
+V_OFFSET = 128
+# Display rows as 64 bit ints in the byte order of the host, like Chip8.vram
+VRAM_OFFSET = V_OFFSET + 16
+MEMORY_OFFSET = VRAM_OFFSET + 32 * 8
+SEGMENT_SIZE = MEMORY_OFFSET + 4096
+
+# Wall time of one batch of SharedMachine.run(), so readers see new state about this often
+PUBLISH_INTERVAL = 0.001
+# How long publish() holds the machine for readers that are waiting
+READER_WAIT = 0.001
+# Sleeps of a reader between tries: it first only yields, then sleeps from RETRY_SLEEP doubling up to MAX_RETRY_SLEEP
+RETRY_SLEEP = 0.00005
+MAX_RETRY_SLEEP = 0.001
+
+# Segments created by this process, which its resource tracker has to keep
+_created = set()
+
+
+class SharedMachine:
+    """
+    Moves the memory and display of chip8 into a shared memory segment, so
+    other processes can attach to it by name and read the machine without
+    anything being pickled or sent to them. The instructions keep writing
+    the same buffers as before, through memoryviews of the segment instead
+    of bytearrays.
+
+    The registers are copied to the segment by publish(). V stays a
+    bytearray: it is written by most instructions, and memoryview item
+    access is slower. A sequence counter in the header makes it a
+    seqlock: it is odd from begin() until the next publish(), while the
+    machine runs, and even in between, when memory, display and registers
+    belong to the same instant. Readers retry until they see the same even
+    value before and after their copy. A reader that finds the machine
+    running sets the waiting flag, and the next publish() waits up to
+    READER_WAIT for it to finish its copy. Without readers, publishing
+    costs one register copy and no waiting.
+
+    A BlockCompiler looks the buffers up when a block runs, so one may be
+    created before or after sharing.
+    """
+
+    def __init__(self, chip8: Chip8, name: Optional[str] = None):
+        self.chip8 = chip8
+        self.segment = SharedMemory(name, create=True, size=SEGMENT_SIZE)
+        _created.add(self.segment.name)
+        buffer = self.segment.buf
+        HEADER_FORMAT.pack_into(buffer, 0, SHARED_MAGIC, SHARED_VERSION, 0, 0)
+        self.sequence = 0
+        self._views = (buffer[VRAM_OFFSET:MEMORY_OFFSET], buffer[MEMORY_OFFSET:SEGMENT_SIZE])
+        vram, memory = self._views
+        vram[:] = chip8.vram.cast('B')
+        memory[:] = chip8.memory
+        chip8.vram, chip8.memory = vram.cast('Q'), memory
+        self.publish()
+
+    @property
+    def name(self) -> str:
+        return self.segment.name
+
+    def _set_sequence(self, sequence: int):
+        self.sequence = sequence
+        SEQUENCE_FORMAT.pack_into(self.segment.buf, SEQUENCE_OFFSET, sequence)
+
+    def begin(self):
+        """ Marks the machine as running, readers wait for the next publish(). """
+        if not self.sequence & 1:
+            self._set_sequence(self.sequence + 1)
+
+    def publish(self):
+        """ Copies the registers to the segment and marks everything consistent. """
+        self.begin()
+        c = self.chip8
+        buffer = self.segment.buf
+        REGISTER_FORMAT.pack_into(buffer, REGISTER_OFFSET, c.pc, c.i & 0xFFFF, c.opcode, c.sp,
+                                  c.delay_timer, c.sound_timer, c.keys, *c.stack,
+                                  c.cycles, c.frames, c.skipped, c.instructions_per_frame)
+        buffer[V_OFFSET:VRAM_OFFSET] = c.v
+        self._set_sequence(self.sequence + 1)
+        if buffer[WAITING_OFFSET]:
+            deadline = time.perf_counter() + READER_WAIT
+            while buffer[WAITING_OFFSET] and time.perf_counter() < deadline:
+                time.sleep(0)
+
+    def run(self, scheduler: Scheduler, cycles: int) -> int:
+        """
+        Runs cycles instructions on scheduler in batches of whole frames and
+        publishes after every batch. The batches grow or shrink to take about
+        PUBLISH_INTERVAL, so an unthrottled machine neither stops after every
+        frame nor keeps readers waiting for long.
+        """
+        chip8 = self.chip8
+        frames = 1
+        executed = 0
+        while executed < cycles:
+            self.begin()
+            start = time.perf_counter()
+            budget = frames * chip8.instructions_per_frame - chip8.frame_cycles
+            count = scheduler.run_cycles(min(budget, cycles - executed))
+            elapsed = time.perf_counter() - start
+            self.publish()
+            if not count:
+                break
+            executed += count
+            if elapsed < PUBLISH_INTERVAL / 2:
+                frames *= 2
+            elif elapsed > PUBLISH_INTERVAL and frames > 1:
+                frames //= 2
+        return executed
+
+    def close(self):
+        """ Gives the machine private copies of its buffers back and removes the segment. """
+        c = self.chip8
+        c.vram = memoryview(bytearray(c.vram.cast('B'))).cast('Q')
+        c.memory = bytearray(c.memory)
+        for view in self._views:
+            view.release()
+        self.segment.close()
+        self.segment.unlink()
+        _created.discard(self.segment.name)
+
+
+class SharedSnapshot(NamedTuple):
+    sequence: int
+    pc: int
+    i: int
+    opcode: int
+    sp: int
+    delay_timer: int
+    sound_timer: int
+    keys: int
+    stack: Tuple[int, ...]
+    cycles: int
+    frames: int
+    skipped: int
+    instructions_per_frame: int
+    v: bytes
+    # Display rows, leftmost pixel in the high bit like Chip8.vram
+    vram: Tuple[int, ...]
+    memory: bytes
+
+    def display_lines(self):
+        return [''.join("██" if row >> (63 - x) & 1 else "  " for x in range(64)) for row in self.vram]
+
+    def register_lines(self):
+        return [" PC    I   SP  DT  ST  V0  V1  V2  V3  V4  V5  V6  V7  V8  V9  VA  VB  VC  VD  VE  VF",
+                f"{self.pc:04x}  {self.i:04x}  {self.sp:02x}  {self.delay_timer:02x}  {self.sound_timer:02x}  " +
+                "  ".join(f"{value:02x}" for value in self.v)]
+
+
+class SharedMachineView:
+    """
+    Attaches to the segment of a SharedMachine by name, read only. Any
+    number of views, in any number of processes, can attach to one machine.
+    """
+
+    def __init__(self, name: str):
+        try:
+            try:
+                self.segment = SharedMemory(name, track=False)
+            except TypeError:
+                # Before Python 3.13 every attach is tracked, and the tracker would
+                # remove the machine's segment when this process exits. It
+                # registers the POSIX name, with the leading slash.
+                self.segment = SharedMemory(name)
+                if self.segment.name not in _created:
+                    resource_tracker.unregister("/" + self.segment.name, "shared_memory")
+        except FileNotFoundError:
+            raise Exception(f"No shared machine named {name}, is it running with --share?") from None
+        magic, version, _, _ = HEADER_FORMAT.unpack_from(self.segment.buf, 0)
+        if magic != SHARED_MAGIC:
+            self.segment.close()
+            raise Exception(f"{name} is not a shared CHIP-8 machine")
+        if version != SHARED_VERSION:
+            self.segment.close()
+            raise Exception(f"Unsupported shared machine version {version}, expected {SHARED_VERSION}")
+
+    def sequence(self) -> int:
+        """ Changes whenever the machine runs, without copying anything. """
+        return SEQUENCE_FORMAT.unpack_from(self.segment.buf, SEQUENCE_OFFSET)[0]
+
+    def read(self, timeout: float = 1.0) -> Optional[SharedSnapshot]:
+        """ A consistent copy of the machine, None if none could be taken within timeout seconds. """
+        buffer = self.segment.buf
+        deadline = time.perf_counter() + timeout
+        delay = 0.0
+        while True:
+            before = SEQUENCE_FORMAT.unpack_from(buffer, SEQUENCE_OFFSET)[0]
+            if not before & 1:
+                data = bytes(buffer[REGISTER_OFFSET:SEGMENT_SIZE])
+                if SEQUENCE_FORMAT.unpack_from(buffer, SEQUENCE_OFFSET)[0] == before:
+                    buffer[WAITING_OFFSET] = 0
+                    break
+            # Ask the machine to hold still at its next publish()
+            buffer[WAITING_OFFSET] = 1
+            if time.perf_counter() > deadline:
+                buffer[WAITING_OFFSET] = 0
+                return None
+            # The machine usually publishes within a batch, yield first and
+            # back off to short sleeps if it takes longer
+            time.sleep(delay)
+            delay = min(max(delay * 2, RETRY_SLEEP), MAX_RETRY_SLEEP)
+        fields = REGISTER_FORMAT.unpack_from(data)
+        v = data[V_OFFSET - REGISTER_OFFSET:VRAM_OFFSET - REGISTER_OFFSET]
+        vram = tuple(memoryview(data[VRAM_OFFSET - REGISTER_OFFSET:MEMORY_OFFSET - REGISTER_OFFSET]).cast('Q'))
+        return SharedSnapshot(before, *fields[:7], fields[7:23], *fields[23:], v, vram,
+                              data[MEMORY_OFFSET - REGISTER_OFFSET:])
+
+    def close(self):
+        self.segment.close()
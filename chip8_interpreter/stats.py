@@ -0,0 +1,62 @@
+from collections import deque
+from typing import Deque, Dict, List, NamedTuple, Optional, Tuple
+import time
+
+
+class TimingSummary(NamedTuple):
+    count: int
+    mean_ms: float
+    p95_ms: float
+    max_ms: float
+
+
+class Timings:
+    """
+    Named series of durations, e.g. frame times or input latency. Every
+    series keeps its last limit samples, so it can run for a whole session.
+    """
+
+    def __init__(self, limit: int = 10000):
+        self.limit = limit
+        self.series: Dict[str, Deque[float]] = {}
+
+    def add(self, name: str, seconds: float):
+        samples = self.series.get(name)
+        if samples is None:
+            samples = self.series[name] = deque(maxlen=self.limit)
+        samples.append(seconds)
+
+    def summary(self, name: str) -> Optional[TimingSummary]:
+        samples = self.series.get(name)
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        return TimingSummary(len(ordered), sum(ordered) / len(ordered) * 1e3,
+                             ordered[int(len(ordered) * 0.95)] * 1e3, ordered[-1] * 1e3)
+
+    def report(self) -> str:
+        lines = [f"{'':20s} {'count':>7s} {'mean ms':>9s} {'p95 ms':>9s} {'max ms':>9s}"]
+        for name in self.series:
+            summary = self.summary(name)
+            if summary is not None:
+                lines.append(f"{name:20s} {summary.count:7d} {summary.mean_ms:9.3f} {summary.p95_ms:9.3f} {summary.max_ms:9.3f}")
+        return "\n".join(lines)
+
+
+class PhaseTimer:
+    """ Wall time of consecutive phases, e.g. of startup. Every mark() ends the phase started by the one before. """
+
+    def __init__(self, start: Optional[float] = None):
+        self.start = time.perf_counter() if start is None else start
+        self.last = self.start
+        self.phases: List[Tuple[str, float]] = []
+
+    def mark(self, name: str):
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    def report(self) -> str:
+        lines = [f"{name:20s} {seconds * 1e3:9.2f} ms" for name, seconds in self.phases]
+        lines.append(f"{'total':20s} {(self.last - self.start) * 1e3:9.2f} ms")
+        return "\n".join(lines)
@@ -0,0 +1,239 @@
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple
+import mmap
+import queue
+import struct
+import threading
+
+from chip8_interpreter.chip8 import Chip8
+from chip8_interpreter.profiler import instrument_tables, restore_tables
+
+# Trace file: header (magic, version, record size), then one fixed size
+# little endian record per executed instruction with the state after it:
+#   cycle, pc, opcode, I, V0-VF, delay timer, sound timer, sp, flags, key mask
+TRACE_MAGIC = b"CH8T"
+TRACE_VERSION = 1
+TRACE_HEADER = struct.Struct("<4sHH")
+TRACE_RECORD = struct.Struct("<QHHH16sBBBBH")
+
+# Record flags
+FLAG_DRAW = 0x01
+
+
+class TraceRecord(NamedTuple):
+    cycle: int
+    pc: int
+    opcode: int
+    i: int
+    v: bytes
+    delay_timer: int
+    sound_timer: int
+    sp: int
+    flags: int
+    keys: int
+
+    def __str__(self) -> str:
+        registers = " ".join(f"{value:02x}" for value in self.v)
+        return (f"{self.cycle:12d}  {self.pc:04x}  {self.opcode:04x}  I={self.i:04x}  V={registers}  "
+                f"DT={self.delay_timer:02x} ST={self.sound_timer:02x} SP={self.sp:x} "
+                f"keys={self.keys:04x}{' draw' if self.flags & FLAG_DRAW else ''}")
+
+
+class TraceWriter:
+    """
+    Appends trace records to a preallocated buffer split in chunks. A full
+    chunk is handed to a background thread that writes it to the file and
+    gives it back, so the emulation only packs records into memory. When
+    the writer falls behind, append() waits for a free chunk instead of
+    dropping records. When writing fails, the thread keeps giving chunks
+    back unwritten, and the error is raised by the next append() that
+    hands over a chunk, or by close().
+    """
+
+    def __init__(self, path: str, chunk_records: int = 1 << 16, chunks: int = 4):
+        self.chunk_size = chunk_records * TRACE_RECORD.size
+        self.buffer = bytearray(self.chunk_size * chunks)
+        self.free: "queue.Queue[int]" = queue.Queue()
+        self.full: "queue.Queue[Optional[Tuple[int, int]]]" = queue.Queue()
+        for chunk in range(chunks):
+            self.free.put(chunk)
+        self.records = 0
+        self.error: Optional[BaseException] = None
+        self.out_file = open(path, "wb")
+        self.out_file.write(TRACE_HEADER.pack(TRACE_MAGIC, TRACE_VERSION, TRACE_RECORD.size))
+        self.thread = threading.Thread(target=self._flush_chunks, name="trace writer", daemon=True)
+        self.thread.start()
+        self._next_chunk()
+
+    def _next_chunk(self):
+        self.chunk = self.free.get()
+        self.offset = self.chunk * self.chunk_size
+        self.end = self.offset + self.chunk_size
+
+    def _flush_chunks(self):
+        view = memoryview(self.buffer)
+        while True:
+            item = self.full.get()
+            if item is None:
+                break
+            chunk, length = item
+            start = chunk * self.chunk_size
+            if self.error is None:
+                try:
+                    self.out_file.write(view[start:start+length])
+                except BaseException as error:
+                    self.error = error
+            self.free.put(chunk)
+
+    def append(self, *fields):
+        TRACE_RECORD.pack_into(self.buffer, self.offset, *fields)
+        self.offset += TRACE_RECORD.size
+        self.records += 1
+        if self.offset == self.end:
+            self.full.put((self.chunk, self.chunk_size))
+            self._next_chunk()
+            if self.error is not None:
+                raise self.error
+
+    def close(self):
+        length = self.offset - self.chunk * self.chunk_size
+        self.full.put((self.chunk, length))
+        self.full.put(None)
+        self.thread.join()
+        self.out_file.close()
+        if self.error is not None:
+            raise self.error
+
+
+class Tracer:
+    """
+    Records every instruction the interpreter executes into a trace file.
+
+    Like Profiler, install() swaps the handlers in the dispatch tables for
+    wrappers that write a record after the instruction ran, and uninstall()
+    puts the originals back, so there is no cost while not tracing.
+    Cycles are counted from chip8.cycles at install(). Instructions with
+    unknown opcodes are not dispatched through the tables and not recorded.
+    """
+
+    def __init__(self, chip8: Chip8, path: str, chunk_records: int = 1 << 16):
+        self.chip8 = chip8
+        self.path = path
+        self.chunk_records = chunk_records
+        self.writer: Optional[TraceWriter] = None
+        self.saved: Dict[str, Dict[int, Callable]] = {}
+        self.fast_forward = chip8.fast_forward
+        self.cycle = 0
+
+    def __enter__(self) -> "Tracer":
+        self.install()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.uninstall()
+
+    def install(self):
+        if self.writer is not None:
+            return
+        self.writer = TraceWriter(self.path, self.chunk_records)
+        self.cycle = self.chip8.cycles
+        # Every instruction is recorded, idle loops are not skipped
+        self.fast_forward = self.chip8.fast_forward
+        self.chip8.fast_forward = False
+        self.saved = instrument_tables(self.chip8, self._instrument)
+
+    def uninstall(self):
+        """ Restores the handlers and flushes and closes the trace file. """
+        if self.writer is None:
+            return
+        restore_tables(self.chip8, self.saved)
+        self.saved = {}
+        self.chip8.fast_forward = self.fast_forward
+        writer, self.writer = self.writer, None
+        writer.close()
+
+    def _instrument(self, label: str, handler: Callable) -> Callable:
+        chip8 = self.chip8
+        append = self.writer.append
+        tracer = self
+        flags = FLAG_DRAW if label in ("DXYN", "00E0") else 0
+
+        def traced(x, y, n, nn, nnn):
+            pc = chip8.pc - 2
+            handler(x, y, n, nn, nnn)
+            append(tracer.cycle, pc, chip8.opcode, chip8.i & 0xFFFF, chip8.v, chip8.delay_timer,
+                   chip8.sound_timer, chip8.sp, flags, chip8.keys)
+            tracer.cycle += 1
+
+        return traced
+
+
+class TraceFile:
+    """ A trace file mapped into memory, records are unpacked on access only. """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as in_file:
+            self.map = mmap.mmap(in_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < TRACE_HEADER.size:
+            raise Exception(f"{path} is not a CHIP-8 trace")
+        magic, version, record_size = TRACE_HEADER.unpack_from(self.map)
+        if magic != TRACE_MAGIC:
+            raise Exception(f"{path} is not a CHIP-8 trace")
+        if version != TRACE_VERSION or record_size != TRACE_RECORD.size:
+            raise Exception(f"Unsupported trace version {version} in {path}, expected {TRACE_VERSION}")
+        self.records = (len(self.map) - TRACE_HEADER.size) // TRACE_RECORD.size
+
+    def __len__(self) -> int:
+        return self.records
+
+    def __getitem__(self, index: int) -> TraceRecord:
+        if not 0 <= index < self.records:
+            raise IndexError(index)
+        return TraceRecord(*TRACE_RECORD.unpack_from(self.map, TRACE_HEADER.size + index * TRACE_RECORD.size))
+
+    def close(self):
+        self.map.close()
+
+
+def first_difference(a: TraceFile, b: TraceFile, block_records: int = 1 << 15) -> Optional[int]:
+    """
+    Index of the first record that differs between two traces, or the
+    length of the shorter one when it is a prefix of the other. None when
+    both are identical. Compares block_records records at a time straight
+    from the mapped files, memory use does not depend on the trace length.
+    """
+    common = min(len(a), len(b))
+    block = block_records * TRACE_RECORD.size
+    start = TRACE_HEADER.size
+    end = TRACE_HEADER.size + common * TRACE_RECORD.size
+    while start < end:
+        stop = min(start + block, end)
+        if a.map[start:stop] != b.map[start:stop]:
+            # Narrow down inside the block, one record at a time
+            for offset in range(start, stop, TRACE_RECORD.size):
+                if a.map[offset:offset+TRACE_RECORD.size] != b.map[offset:offset+TRACE_RECORD.size]:
+                    return (offset - TRACE_HEADER.size) // TRACE_RECORD.size
+        start = stop
+    if len(a) != len(b):
+        return common
+    return None
+
+
+def diff_report(path_a: str, path_b: str, context: int = 5) -> Tuple[Optional[int], List[str]]:
+    """ First differing record of two trace files and the lines describing it, with context records before it. """
+    a, b = TraceFile(path_a), TraceFile(path_b)
+    try:
+        index = first_difference(a, b)
+        if index is None:
+            return None, [f"traces are identical, {len(a)} records"]
+        lines = [f"first difference at record {index}"]
+        for name, trace in ((path_a, a), (path_b, b)):
+            lines.append(f"--- {name} ({len(trace)} records)")
+            for position in range(max(index - context, 0), min(index + 1, len(trace))):
+                lines.append(f"{'>' if position == index else ' '} {trace[position]}")
+            if index >= len(trace):
+                lines.append("> end of trace")
+        return index, lines
+    finally:
+        a.close()
+        b.close()
@@ -0,0 +1,285 @@
+from typing import Callable, Optional
+import numpy as np
+
+from chip8_interpreter.chip8 import Chip8
+
+
+class VectorChip8:
+    """
+    Lockstep engine that runs a batch of CHIP-8 machines with NumPy.
+
+    All state has a leading batch dimension. step() executes one instruction
+    on every machine: the machines are grouped by opcode class and each group
+    runs as a handful of array operations, so the cost per step barely
+    depends on the number of machines.
+
+    Differences from Chip8.cycle:
+        Memory addresses past 0xFFF wrap around instead of raising.
+        Stack errors raise the message of Chip8 for the first machine that
+        hit one, prefixed with its index, after other opcode groups of the
+        same step may already have run.
+        Cxkk draws from self.random, a numpy generator by default, so it does
+        not follow the sequence of Chip8.rng.
+        Unknown opcodes are ignored without printing.
+        Only the "modern" quirk profile is implemented.
+    """
+
+    def __init__(self, count: int, seed: Optional[int] = None):
+        self.count = count
+        self.rows = np.arange(count)
+        self.memory = np.zeros((count, 4096), dtype=np.uint8)
+        self.v = np.zeros((count, 16), dtype=np.uint8)
+        self.i = np.zeros(count, dtype=np.int64)
+        self.pc = np.full(count, 0x200, dtype=np.int64)
+        self.opcode = np.zeros(count, dtype=np.int64)
+        self.delay_timer = np.zeros(count, dtype=np.int64)
+        self.sound_timer = np.zeros(count, dtype=np.int64)
+        self.stack = np.zeros((count, Chip8.stack_size), dtype=np.int64)
+        self.sp = np.zeros(count, dtype=np.int64)
+        # One byte per pixel, 0 or 1
+        self.vram = np.zeros((count, 32, 64), dtype=np.uint8)
+        self.keyboard = np.zeros((count, 16), dtype=bool)
+        self.draw_screen = np.zeros(count, dtype=bool)
+
+        generator = np.random.default_rng(seed)
+        # Returns size floats in [0, 1)
+        self.random: Callable[[int], np.ndarray] = generator.random
+
+        self.memory[:, :len(Chip8.fontset)] = np.frombuffer(Chip8.fontset, dtype=np.uint8)
+
+        self.grouptable = {
+            0x0: self.opcode_group_0,
+            0x1: self.jump_to_address_nnn,
+            0x2: self.call_at_nnn,
+            0x3: self.skip_ins_vx_eq_nn,
+            0x4: self.skip_ins_vx_neq_nn,
+            0x5: self.skip_ins_vx_eq_vy,
+            0x6: self.set_vx_to_nn,
+            0x7: self.add_nn_to_vx,
+            0x8: self.opcode_group_8,
+            0x9: self.skip_ins_vx_neq_vy,
+            0xA: self.set_index_to_nnn,
+            0xB: self.jump_to_address_nnn_v0,
+            0xC: self.rnd_vx_nn,
+            0xD: self.draw_to_vram,
+            0xE: self.opcode_group_e,
+            0xF: self.opcode_group_f,
+        }
+
+    def load_program_to_memory(self, program: bytes, machines=None):
+        """ Loads program at 0x200 into every machine, or only into the given machine indexes. """
+        target = slice(None) if machines is None else machines
+        self.memory[target, 0x200:0x200+len(program)] = np.frombuffer(bytes(program), dtype=np.uint8)
+
+    def step(self):
+        """ Executes one instruction on every machine, like Chip8.cycle(). """
+        rows = self.rows
+        pc = self.pc
+        opcode = (self.memory[rows, pc % 4096].astype(np.int64) << 8) | self.memory[rows, (pc + 1) % 4096]
+        self.opcode = opcode
+        self.pc = pc + 2
+
+        group = opcode >> 12
+        present = np.bincount(group, minlength=16)
+        for key in np.nonzero(present)[0]:
+            idx = rows if present[key] == self.count else np.nonzero(group == key)[0]
+            op = opcode[idx]
+            self.grouptable[key](idx, op, (op >> 8) & 0xF, (op >> 4) & 0xF, op & 0xF, op & 0xFF, op & 0xFFF)
+
+    def run(self, cycles: int):
+        for _ in range(cycles):
+            self.step()
+
+    def run_frame(self, instructions_per_frame: int):
+        """ Runs one emulated 60Hz frame: the instructions, then one timer tick. """
+        self.run(instructions_per_frame)
+        self.update_timers()
+
+    def update_timers(self):
+        self.delay_timer[self.delay_timer > 0] -= 1
+        self.sound_timer[self.sound_timer > 0] -= 1
+
+    def set_keys(self, keyboard: np.ndarray):
+        """ Sets the key state of every machine from a (count, 16) array of booleans. """
+        self.keyboard[:] = keyboard
+
+    def to_chip8(self, index: int) -> Chip8:
+        """ Copies the state of one machine into a new Chip8 instance. """
+        chip8 = Chip8()
+        chip8.memory[:] = self.memory[index].tobytes()
+        chip8.invalidate_decoded(0, len(chip8.memory))
+        chip8.v[:] = self.v[index].tobytes()
+        chip8.i = int(self.i[index])
+        chip8.pc = int(self.pc[index])
+        chip8.opcode = int(self.opcode[index])
+        chip8.delay_timer = int(self.delay_timer[index])
+        chip8.sound_timer = int(self.sound_timer[index])
+        chip8.sp = int(self.sp[index])
+        chip8.stack[:] = [int(address) for address in self.stack[index]]
+        for row, packed in enumerate(np.packbits(self.vram[index], axis=1)):
+            chip8.vram[row] = int.from_bytes(packed.tobytes(), "big")
+        chip8.draw_screen = bool(self.draw_screen[index])
+        chip8.set_keys(sum(1 << key for key in range(16) if self.keyboard[index, key]))
+        return chip8
+
+    # Handlers get the machine indexes of the group and the decoded operands of each of them
+
+    def _skip_where(self, idx, condition):
+        self.pc[idx[condition]] += 2
+
+    def opcode_group_0(self, idx, op, x, y, n, nn, nnn):
+        """ 00E0 - CLS, 00EE - RET, 0000 - HALT. 0nnn is ignored. """
+        cls = idx[op == 0x00E0]
+        self.vram[cls] = 0
+        self.draw_screen[cls] = True
+
+        ret = idx[op == 0x00EE]
+        empty = ret[self.sp[ret] == 0]
+        if len(empty):
+            machine = empty[0]
+            raise Exception(f"machine {machine}: Stack underflow: RET at {self.pc[machine] - 2:04x} with an empty stack")
+        self.sp[ret] -= 1
+        self.pc[ret] = self.stack[ret, self.sp[ret]]
+
+        halt = idx[op == 0x0000]
+        self.pc[halt] -= 2
+
+    def jump_to_address_nnn(self, idx, op, x, y, n, nn, nnn):
+        self.pc[idx] = nnn
+
+    def call_at_nnn(self, idx, op, x, y, n, nn, nnn):
+        full = np.nonzero(self.sp[idx] == Chip8.stack_size)[0]
+        if len(full):
+            machine = idx[full[0]]
+            raise Exception(f"machine {machine}: Stack overflow: CALL {nnn[full[0]]:03x} at {self.pc[machine] - 2:04x} "
+                            f"with {self.sp[machine]} return addresses on the stack")
+        self.stack[idx, self.sp[idx]] = self.pc[idx]
+        self.sp[idx] += 1
+        self.pc[idx] = nnn
+
+    def skip_ins_vx_eq_nn(self, idx, op, x, y, n, nn, nnn):
+        self._skip_where(idx, self.v[idx, x] == nn)
+
+    def skip_ins_vx_neq_nn(self, idx, op, x, y, n, nn, nnn):
+        self._skip_where(idx, self.v[idx, x] != nn)
+
+    def skip_ins_vx_eq_vy(self, idx, op, x, y, n, nn, nnn):
+        self._skip_where(idx, self.v[idx, x] == self.v[idx, y])
+
+    def skip_ins_vx_neq_vy(self, idx, op, x, y, n, nn, nnn):
+        self._skip_where(idx, self.v[idx, x] != self.v[idx, y])
+
+    def set_vx_to_nn(self, idx, op, x, y, n, nn, nnn):
+        self.v[idx, x] = nn
+
+    def add_nn_to_vx(self, idx, op, x, y, n, nn, nnn):
+        self.v[idx, x] = (self.v[idx, x] + nn) & 0xFF
+
+    def opcode_group_8(self, idx, op, x, y, n, nn, nnn):
+        """
+        8xy0 - 8xyE. Writes happen in the same order as in Chip8, reading the
+        registers again after VF is written, so x or y being F behaves the same.
+        """
+        v = self.v
+        for kind in np.unique(n):
+            sel = n == kind
+            i, xs, ys = idx[sel], x[sel], y[sel]
+            if kind == 0x0:
+                v[i, xs] = v[i, ys]
+            elif kind == 0x1:
+                v[i, xs] = v[i, xs] | v[i, ys]
+            elif kind == 0x2:
+                v[i, xs] = v[i, xs] & v[i, ys]
+            elif kind == 0x3:
+                v[i, xs] = v[i, xs] ^ v[i, ys]
+            elif kind == 0x4:
+                total = v[i, xs].astype(np.int64) + v[i, ys]
+                v[i, xs] = total & 0xFF
+                v[i, 0xF] = total > 0xFF
+            elif kind == 0x5:
+                v[i, 0xF] = v[i, xs] > v[i, ys]
+                v[i, xs] = (v[i, xs].astype(np.int64) - v[i, ys]) & 0xFF
+            elif kind == 0x6:
+                v[i, 0xF] = v[i, xs] & 0x1
+                v[i, xs] = v[i, xs] >> 1
+            elif kind == 0x7:
+                v[i, 0xF] = v[i, ys] > v[i, xs]
+                v[i, xs] = (v[i, ys].astype(np.int64) - v[i, xs]) & 0xFF
+            elif kind == 0xE:
+                v[i, 0xF] = v[i, xs] >> 7
+                v[i, xs] = (v[i, xs].astype(np.int64) << 1) & 0xFF
+
+    def set_index_to_nnn(self, idx, op, x, y, n, nn, nnn):
+        self.i[idx] = nnn
+
+    def jump_to_address_nnn_v0(self, idx, op, x, y, n, nn, nnn):
+        self.pc[idx] = nnn + self.v[idx, 0]
+
+    def rnd_vx_nn(self, idx, op, x, y, n, nn, nnn):
+        self.v[idx, x] = (self.random(len(idx)) * 255).astype(np.int64) & nn
+
+    def draw_to_vram(self, idx, op, x, y, n, nn, nnn):
+        """ Dxyn for all machines of the group at once, as a (machines, rows, 8 columns) operation. """
+        self.v[idx, 0xF] = 0
+        sprite_x_pos = self.v[idx, x].astype(np.int64)
+        sprite_y_pos = self.v[idx, y].astype(np.int64)
+
+        offsets = np.arange(max(int(n.max()), 1))
+        active = offsets[None, :] < n[:, None]
+        sprite_lines = self.memory[idx[:, None], (self.i[idx][:, None] + offsets[None, :]) % 4096]
+        bits = (sprite_lines[:, :, None] >> (7 - np.arange(8))[None, None, :]) & 1
+        bits = (bits * active[:, :, None]).astype(np.uint8)
+
+        # Flat pixel indexes into the whole batch
+        pixel_y = (sprite_y_pos[:, None] + offsets[None, :]) % 32
+        pixel_x = (sprite_x_pos[:, None] + np.arange(8)[None, :]) % 64
+        flat = (idx[:, None, None] * 2048 + pixel_y[:, :, None] * 64 + pixel_x[:, None, :]).ravel()
+        bits = bits.ravel()
+        vram = self.vram.reshape(-1)
+        pixels = vram[flat]
+        self.v[idx, 0xF] = (pixels & bits).reshape(len(idx), -1).any(axis=1)
+        vram[flat] = pixels ^ bits
+        self.draw_screen[idx] = True
+
+    def opcode_group_e(self, idx, op, x, y, n, nn, nnn):
+        """ Ex9E - SKP Vx, ExA1 - SKNP Vx """
+        pressed = self.keyboard[idx, self.v[idx, x] & 0xF]
+        self._skip_where(idx, (nn == 0x9E) & pressed)
+        self._skip_where(idx, (nn == 0xA1) & ~pressed)
+
+    def opcode_group_f(self, idx, op, x, y, n, nn, nnn):
+        v = self.v
+        for kind in np.unique(nn):
+            sel = nn == kind
+            i, xs = idx[sel], x[sel]
+            if kind == 0x07:
+                v[i, xs] = self.delay_timer[i]
+            elif kind == 0x0A:
+                # Same as Chip8: the lowest pressed key ends up in Vx,
+                # machines without a pressed key wait on the instruction
+                keys = self.keyboard[i]
+                held = keys.any(axis=1)
+                v[i[held], xs[held]] = np.argmax(keys[held], axis=1)
+                self.pc[i[~held]] -= 2
+            elif kind == 0x15:
+                self.delay_timer[i] = v[i, xs]
+            elif kind == 0x18:
+                self.sound_timer[i] = v[i, xs]
+            elif kind == 0x1E:
+                self.i[i] += v[i, xs]
+            elif kind == 0x29:
+                self.i[i] = v[i, xs].astype(np.int64) * 0x5
+            elif kind == 0x33:
+                value = v[i, xs]
+                address = self.i[i]
+                self.memory[i, address % 4096] = value // 100
+                self.memory[i, (address + 1) % 4096] = (value // 10) % 10
+                self.memory[i, (address + 2) % 4096] = value % 10
+            elif kind == 0x55:
+                for index in range(int(xs.max()) + 1):
+                    store = index <= xs
+                    self.memory[i[store], (self.i[i[store]] + index) % 4096] = v[i[store], index]
+            elif kind == 0x65:
+                for index in range(int(xs.max()) + 1):
+                    load = index <= xs
+                    v[i[load], index] = self.memory[i[load], (self.i[i[load]] + index) % 4096]
@@ -1,137 +1,395 @@
+import time
+# Start of the launcher, for --startup-profile
+MODULE_START = time.perf_counter()
+
+import argparse
 import random
 import os
-import pygame
-from pygame import constants as pygamec
+import sys
+
+from typing import TYPE_CHECKING, List, Optional
+
+from chip8_interpreter.audio import MixerBeeper, SoundTimerWatch
+from chip8_interpreter.chip8 import DEFAULT_QUIRKS, QUIRK_PROFILES, Chip8
+from chip8_interpreter.display import dirty_band, upload_rows
+from chip8_interpreter.headless import load_rom
+from chip8_interpreter.replay import InputRecorder, InputReplayer, load_input_log, rom_hash
+from chip8_interpreter.rewind import RewindBuffer
+from chip8_interpreter.scheduler import FIXED, FRAME_RATE, INSTRUCTIONS_PER_FRAME, MODES, REALTIME, Scheduler
+from chip8_interpreter.stats import PhaseTimer, Timings
 
-from chip8_interpreter.chip8 import Chip8
+if TYPE_CHECKING:
+    from chip8_interpreter.shared import SharedMachine
 
-WIDTH = 640
-HEIGHT = 480
-WINDOW = pygame.display.set_mode((WIDTH, HEIGHT))
-pygame.display.set_caption("ChipPy Python CHIP8 Emulator")
+# pygame and asyncio are imported by import_window_modules() once a window
+# is opened, not when the launcher starts: --help, argument and ROM errors
+# never wait for them, and the ROM is loaded before they are imported.
+pygame = None
+pygamec = None
+asyncio = None
 
+DEFAULT_ROM = "roms/octojam2title.ch8"
+# Size of one CHIP-8 pixel in the window
+DEFAULT_SCALE = 10
+# Program space, 0x200 - 0xFFF
+MAX_ROM_SIZE = 4096 - 0x200
 
 # 123C
 # 456D
 # 789E
 # A0BF
 KEYMAP = {
-    pygamec.K_1: 0x01, pygamec.K_2: 0x02, pygamec.K_3: 0x03, pygamec.K_4: 0x0C,
-    pygamec.K_q: 0x04, pygamec.K_w: 0x05, pygamec.K_e: 0x06, pygamec.K_r: 0x0D,
-    pygamec.K_a: 0x07, pygamec.K_s: 0x08, pygamec.K_d: 0x09, pygamec.K_f: 0x0E,
-    pygamec.K_z: 0x0A, pygamec.K_x: 0x00, pygamec.K_c: 0x0B, pygamec.K_v: 0x0F
+    "K_1": 0x01, "K_2": 0x02, "K_3": 0x03, "K_4": 0x0C,
+    "K_q": 0x04, "K_w": 0x05, "K_e": 0x06, "K_r": 0x0D,
+    "K_a": 0x07, "K_s": 0x08, "K_d": 0x09, "K_f": 0x0E,
+    "K_z": 0x0A, "K_x": 0x00, "K_c": 0x0B, "K_v": 0x0F
 }
+# Held down to run the emulation backwards
+REWIND_KEY = "K_BACKSPACE"
 
-def main():
-    # Initialize interpreter
-    mychip8 = Chip8()
+# Times per second the keyboard is polled and the window is presented
+INPUT_RATE = 240
+PRESENT_RATE = FRAME_RATE
+
+
+def import_window_modules():
+    global pygame, pygamec, asyncio
+    if pygame is None:
+        os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+        import asyncio as asyncio_module
+        import pygame as pygame_module
+        from pygame import constants as pygame_constants
+        pygame, pygamec, asyncio = pygame_module, pygame_constants, asyncio_module
 
-    #Load program from file
-    #with open("roms/ibmlogo.ch8", "rb") as in_file:
-    #    rom_data = in_file.read()
 
-    #with open("roms/test_opcode.ch8", "rb") as in_file:
-    #    rom_data = in_file.read()
+def load_program(path: str) -> bytes:
+    """ Reads a ROM and checks that it fits in program memory before anything else is set up. """
+    rom_data = load_rom(path)
+    if len(rom_data) > MAX_ROM_SIZE:
+        raise Exception(f"{path} is {len(rom_data)} bytes, at most {MAX_ROM_SIZE} fit in memory")
+    return rom_data
+
+
+def run_session(rom_path: str = DEFAULT_ROM, instructions_per_frame: int = INSTRUCTIONS_PER_FRAME,
+                mode: str = REALTIME, speed: float = 1.0, seed: Optional[int] = None,
+                record: Optional[str] = None, replay: Optional[str] = None,
+                quirks: str = DEFAULT_QUIRKS, scale: int = DEFAULT_SCALE,
+                startup: Optional[PhaseTimer] = None, startup_profile: bool = False, mute: bool = False,
+                share: Optional[str] = None, rom_data: Optional[bytes] = None):
+    """
+    record: write the key presses of the session to this input log on exit
+    replay: play the session back from this input log, live keys are ignored
+    startup: phases of the startup are marked on it, up to the first frame
+    startup_profile: print the startup phases to stderr once the first frame is presented
+    mute: print the beep intervals on exit instead of playing them
+    share: keep the machine in a shared memory segment of this name, for python -m chip8_interpreter watch
+    rom_data: the ROM, already read from rom_path by load_program()
+    """
+    if startup is None:
+        startup = PhaseTimer()
+    if rom_data is None:
+        rom_data = load_program(rom_path)
+
+    recorder = None
+    replayer = None
+    if replay:
+        log = load_input_log(replay)
+        if log.rom_hash != rom_hash(rom_data):
+            raise Exception(f"{replay} was recorded with a different rom")
+        seed, instructions_per_frame = log.seed, log.instructions_per_frame
+        replayer = InputReplayer(log.events)
+    elif record and seed is None:
+        # A recorded session needs a known seed to be replayed
+        seed = random.randrange(1 << 32)
+    startup.mark("rom load")
+
+    # Initialize interpreter
+    mychip8 = Chip8(seed, quirks)
+    mychip8.load_program_to_memory(rom_data)
+    if record:
+        recorder = InputRecorder(mychip8, seed, rom_data)
+    scheduler = Scheduler(mychip8, instructions_per_frame, mode, speed, inputs=replayer)
+    startup.mark("machine setup")
 
-    #with open("roms/bx_test.ch8", "rb") as in_file:
-    #    rom_data = in_file.read()
-    
-    #with open("roms/brixch8.ch8", "rb") as in_file:
-    #    rom_data = in_file.read()
+    import_window_modules()
+    startup.mark("pygame import")
+    window = pygame.display.set_mode((64 * scale, 32 * scale))
+    pygame.display.set_caption("ChipPy Python CHIP8 Emulator")
+    startup.mark("window setup")
 
-    #with open("roms/delay_timer_test.ch8", "rb") as in_file:
-    #    rom_data = in_file.read()
+    shared = None
+    if share:
+        # multiprocessing is only imported when sharing
+        from chip8_interpreter.shared import SharedMachine
+        shared = SharedMachine(mychip8, share)
+    try:
+        run_frontend(mychip8, scheduler, window, recorder, replayer, log.cycles if replayer else None,
+                     startup, startup_profile, mute, shared)
+    finally:
+        if shared is not None:
+            shared.close()
 
-    #with open("roms/keypad_test.ch8", "rb") as in_file:
-    #    rom_data = in_file.read()
+    if recorder:
+        recorder.save(record)
+        print(f"recorded {len(recorder.events)} input events over {mychip8.cycles} cycles to {record}, seed {seed}")
 
-    #with open("roms/trip8.ch8", "rb") as in_file:
-    #    rom_data = in_file.read()
 
-    with open("roms/octojam2title.ch8", "rb") as in_file:
-        rom_data = in_file.read()
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="ChipPy Python CHIP8 Emulator. Press u to run, p to pause, "
+                                                 "space to step, backspace to rewind, k to quit.")
+    parser.add_argument("rom", nargs="?", default=DEFAULT_ROM, help=f"ROM to run (default: {DEFAULT_ROM})")
+    parser.add_argument("--scale", type=int, default=DEFAULT_SCALE, help="window pixels per CHIP-8 pixel")
+    parser.add_argument("--speed", type=float, default=1.0, help="emulation speed, 2 runs twice as fast")
+    parser.add_argument("--quirks", choices=list(QUIRK_PROFILES), default=DEFAULT_QUIRKS,
+                        help="interpreter behaviour to emulate")
+    parser.add_argument("--ipf", type=int, default=INSTRUCTIONS_PER_FRAME, help="instructions per 60Hz frame")
+    parser.add_argument("--mode", choices=MODES, default=REALTIME, help="how emulated frames follow real time")
+    parser.add_argument("--seed", type=int, help="seed for the random number generator")
+    parser.add_argument("--record", help="write the key presses of the session to this input log on exit")
+    parser.add_argument("--replay", help="play a session back from an input log, live keys are ignored")
+    parser.add_argument("--startup-profile", action="store_true",
+                        help="print the time spent in imports, ROM load, window setup and up to the first frame")
+    parser.add_argument("--mute", action="store_true", help="do not play the beep, print when it would sound on exit")
+    parser.add_argument("--share", metavar="NAME",
+                        help="keep memory, display and registers in a shared memory segment of this name, "
+                             "watch it with python -m chip8_interpreter watch NAME")
+    return parser
 
 
+def main(argv: Optional[List[str]] = None) -> int:
+    startup = PhaseTimer(MODULE_START)
+    startup.mark("imports")
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.scale < 1:
+        parser.error(f"--scale must be at least 1, got {args.scale}")
+    startup.mark("arguments")
+    try:
+        rom_data = load_program(args.rom)
+    except OSError as error:
+        parser.error(f"cannot read ROM {args.rom}: {error.strerror}")
+    except Exception as error:
+        parser.error(str(error))
+    run_session(args.rom, args.ipf, args.mode, args.speed, args.seed, args.record, args.replay,
+                args.quirks, args.scale, startup, args.startup_profile, args.mute, args.share, rom_data)
+    return 0
 
-    if rom_data:
-        mychip8.load_program_to_memory(rom_data)
-    else:
-        raise Exception("Could not load rom")
 
-    #Set up pygame
-    run = True
-    run_chip8 = False
-    cycle_chip8 = False
-    FPS = 480
-    clock = pygame.time.Clock()
-    chip8_screen = pygame.Surface((64, 32))
+class FrontendState:
+    """ What the input, emulation and presentation tasks share. They all run on one thread, between awaits. """
 
-    def redraw_window(draw_chip8_screen: bool = False):
-        if draw_chip8_screen:
-            pygame.transform.scale(chip8_screen, (WIDTH, HEIGHT), WINDOW)
-            #WINDOW.blit(chip8_screen, (0,0))
-        pygame.display.update()
+    def __init__(self, chip8: Chip8, scheduler: Scheduler, window, recorder: Optional[InputRecorder],
+                 replayer: Optional[InputReplayer], replay_cycles: Optional[int],
+                 startup: PhaseTimer, startup_profile: bool, shared: Optional["SharedMachine"] = None):
+        self.chip8 = chip8
+        self.scheduler = scheduler
+        self.window = window
+        self.recorder = recorder
+        self.replayer = replayer
+        self.replay_cycles = replay_cycles
+        # One state every 6 frames, one step back per displayed frame while rewinding
+        self.rewind = RewindBuffer(chip8)
+        self.quit = False
+        self.running = False
+        self.step = False
+        self.rewinding = False
+        self.key_mask = 0
+        # When the last key change was pushed to the machine and its cycle count then,
+        # cleared once a frame that ran after it is presented
+        self.input_time: Optional[float] = None
+        self.input_cycle = 0
+        self.timings = Timings()
+        self.startup = startup
+        self.startup_profile = startup_profile
+        # Follows the sound timer once per emulation batch, plays or logs the beep
+        self.beeper: SoundTimerWatch = SoundTimerWatch(chip8)
+        # Published after every emulation batch, observers read it while the tasks wait
+        self.shared = shared
 
-    def draw_vram_to_surface(target_surface, vram: bytearray):
-        width = target_surface.get_width()
-        height = target_surface.get_height()
-        if not len(vram) ==  (width*height):
-            raise Exception(f"surface must be same size as vram, surface len(): {width*height}, vram len(), {len(vram)}")
 
-        with pygame.PixelArray(target_surface) as pixel_array:
-            for y in range(height):
-                for x in range(width):
-                    pixel_array[x][y] = vram[x + (y*width)]
-    
+def run_frontend(chip8: Chip8, scheduler: Scheduler, window, recorder: Optional[InputRecorder] = None,
+                 replayer: Optional[InputReplayer] = None, replay_cycles: Optional[int] = None,
+                 startup: Optional[PhaseTimer] = None, startup_profile: bool = False, mute: bool = False,
+                 shared: Optional["SharedMachine"] = None):
+    """
+    Runs the window as three asyncio tasks on one thread: input polls the
+    events and pushes key mask changes to the machine, emulation runs the
+    frames the scheduler says are due and presentation shows the dirty rows
+    at the display refresh rate. A slow present only delays the next
+    emulation batch, which then catches up the frames that became due,
+    so the emulation speed does not depend on the rendering.
+    The beep follows the sound timer after every emulation batch, muted
+    or without an audio device its intervals are printed on exit instead.
+    Prints the frame time, input latency and audio call statistics on exit.
+    """
+    state = FrontendState(chip8, scheduler, window, recorder, replayer, replay_cycles,
+                          startup or PhaseTimer(), startup_profile, shared)
+    if not mute:
+        try:
+            state.beeper = MixerBeeper(chip8, state.timings)
+        except pygame.error as error:
+            print(f"no audio, beeps are printed on exit: {error}")
+        state.startup.mark("audio setup")
+    pygame.draw.rect(window, 255, window.get_rect())
+    try:
+        asyncio.run(_run_tasks(state))
+    finally:
+        state.beeper.close()
+        if isinstance(state.beeper, MixerBeeper):
+            print(f"audio output latency {state.beeper.output_latency * 1e3:.1f} ms")
+        else:
+            print("\n".join(state.beeper.report() or ["no beeps"]))
+        print(state.timings.report())
 
-    bg = WINDOW.get_rect()
-    pygame.draw.rect(WINDOW, 255, bg)
 
+async def _run_tasks(state: FrontendState):
+    await asyncio.gather(_input_task(state), _emulation_task(state), _presentation_task(state))
 
-    while run:
-        ticks = clock.tick(FPS)
 
+async def _input_task(state: FrontendState):
+    chip8 = state.chip8
+    keymap = {getattr(pygamec, name): chip8_key for name, chip8_key in KEYMAP.items()}
+    rewind_key = getattr(pygamec, REWIND_KEY)
+    while not state.quit:
         for event in pygame.event.get():
             if event.type == pygamec.QUIT:
-                run = False
+                state.quit = True
             elif event.type == pygamec.KEYDOWN:
                 if event.key == pygamec.K_p:
                     print("stopping emulator...")
-                    run_chip8 = False
+                    state.running = False
                 if event.key == pygamec.K_u:
                     print("running emulator...")
-                    run_chip8 = True
+                    state.running = True
+                    # Start counting real time from now, not from when it was paused
+                    state.scheduler.reset_clock()
                 if event.key == pygamec.K_SPACE:
-                    cycle_chip8 = True
+                    state.step = True
                 if event.key == pygamec.K_k:
-                    run = False
+                    state.quit = True
                 if event.key == pygamec.K_l:
-                    mychip8.draw_vram()
-                    mychip8.dump_memory()
+                    chip8.draw_vram()
+                    chip8.dump_memory()
                 if event.key == pygamec.K_j:
-                    mychip8.toggle_debug()
-        
+                    chip8.toggle_debug()
+                if event.key == pygamec.K_i:
+                    print(state.timings.report())
+
         pressed_keys = pygame.key.get_pressed()
-        for key in KEYMAP.keys():
+        key_mask = 0
+        for key, chip8_key in keymap.items():
             if pressed_keys[key]:
-                mychip8.keyboard[KEYMAP[key]] = True
+                key_mask |= 1 << chip8_key
+        state.rewinding = bool(pressed_keys[rewind_key]) and not state.replayer
+        if key_mask != state.key_mask and not state.replayer:
+            # Live keys are ignored while replaying
+            state.key_mask = key_mask
+            if state.recorder:
+                state.recorder.update(key_mask)
             else:
-                mychip8.keyboard[KEYMAP[key]] = False
-        
-        #if mychip8.sound_timer > 0:
-        #    print("beep")
-            
-        if run_chip8 or cycle_chip8:
-            mychip8.cycle(ticks)
-            cycle_chip8 = False
-            if mychip8.debug:
-                mychip8.print_registers()
-        
-        if mychip8.draw_screen:
-            draw_vram_to_surface(chip8_screen, mychip8.vram)
-        
-        redraw_window(mychip8.draw_screen)
-
-
-# Run Main
-main()
+                chip8.set_keys(key_mask)
+            if state.running:
+                state.input_time = time.perf_counter()
+                state.input_cycle = chip8.cycles
+        await asyncio.sleep(1 / INPUT_RATE)
+
+
+async def _emulation_task(state: FrontendState):
+    chip8 = state.chip8
+    scheduler = state.scheduler
+    timings = state.timings
+    shared = state.shared
+    while not state.quit:
+        start = time.perf_counter()
+        if shared is not None:
+            shared.begin()
+        if state.running and state.rewinding:
+            state.rewind.rewind()
+            state.beeper.update(False)
+            # Emulated time went backwards, pace from the restored frame
+            scheduler.reset_clock()
+            if shared is not None:
+                shared.publish()
+            await asyncio.sleep(1 / PRESENT_RATE)
+            continue
+        if state.running:
+            if state.recorder:
+                # Log the mask at the cycle the machine is at, also after a rewind
+                state.recorder.update(state.key_mask)
+            if scheduler.advance(start):
+                state.rewind.record()
+                timings.add("emulation batch", time.perf_counter() - start)
+                if chip8.debug:
+                    chip8.print_registers()
+            if state.replay_cycles is not None and chip8.cycles >= state.replay_cycles:
+                print(f"replay finished at cycle {chip8.cycles}")
+                state.running = False
+        elif state.step:
+            # Single step one instruction
+            scheduler.run_cycles(1)
+            state.step = False
+            if chip8.debug:
+                chip8.print_registers()
+        # Paused machines do not beep
+        state.beeper.update(state.running)
+        if shared is not None:
+            shared.publish()
+
+        if not state.running:
+            await asyncio.sleep(1 / INPUT_RATE)
+        elif scheduler.mode == FIXED:
+            # One frame per presented frame
+            await asyncio.sleep(1 / PRESENT_RATE)
+        else:
+            # 0 when unthrottled, just lets the other tasks run
+            await asyncio.sleep(scheduler.time_to_next_frame())
+
+
+async def _presentation_task(state: FrontendState):
+    chip8 = state.chip8
+    timings = state.timings
+    # The chip8 screen surface shares its pixels with frame_buffer, rows
+    # are written straight into the buffer and never copied pixel by pixel.
+    window = state.window
+    width = window.get_width()
+    frame_buffer = bytearray(64 * 32 * 3)
+    chip8_screen = pygame.image.frombuffer(frame_buffer, (64, 32), "RGB")
+    row_height = window.get_height() // 32
+    period = 1 / PRESENT_RATE
+    deadline = time.perf_counter()
+    last_frame = None
+    while not state.quit:
+        start = time.perf_counter()
+        # Frames where nothing changed are neither scaled nor presented
+        dirty_rows = chip8.take_dirty_rows()
+        if dirty_rows:
+            upload_rows(frame_buffer, chip8.vram, dirty_rows)
+            top, bottom = dirty_band(dirty_rows)
+            band = pygame.Rect(0, top * row_height, width, (bottom - top) * row_height)
+            window.blit(pygame.transform.scale(chip8_screen.subsurface((0, top, 64, bottom - top)), band.size), band)
+            pygame.display.update(band)
+        chip8.draw_screen = False
+        end = time.perf_counter()
+
+        timings.add("present", end - start)
+        if last_frame is not None:
+            timings.add("frame time", start - last_frame)
+        else:
+            state.startup.mark("first frame")
+            if state.startup_profile:
+                print(state.startup.report(), file=sys.stderr)
+        last_frame = start
+        if state.input_time is not None and chip8.cycles > state.input_cycle:
+            # The machine ran with the new keys, this frame is the first that can show it
+            timings.add("input latency", end - state.input_time)
+            state.input_time = None
+
+        deadline += period
+        if deadline < end:
+            # Missed the refresh, wait for the next one instead of presenting twice in a row
+            deadline = end + period - (end - deadline) % period
+        await asyncio.sleep(deadline - time.perf_counter())
+
+
+if __name__ == "__main__":
+    sys.exit(main())